@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2014-2018 GEM Foundation and G. Weatherill
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of the reader of the numeric blocks of the ASCII record files
+(smtk.parsers.base_database_parser.read_numeric_block) against
+np.genfromtxt, on:
+
+ - the ASA sample files of tests/parsers/data (109 header lines, three
+   columns, one read per column as in the ASA parser)
+ - an ESM file (64 header lines, one column), written from the first ASA
+   file as there is no ESM ASCII sample in the tests
+
+For each file the mean read time (over `--repeats`) is reported.
+
+Usage: python benchmarks/ascii_reader.py [repeats]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from smtk.parsers.base_database_parser import read_numeric_block
+
+ASA_PATH = os.path.join(os.path.dirname(__file__), "..", "tests", "parsers",
+                        "data", "correct_ASA_files")
+
+
+def timeit(func, repeats):
+    """
+    Returns the mean time (s) of a call to `func`
+    """
+    start = time.time()
+    for _ in range(repeats):
+        func()
+    return (time.time() - start) / repeats
+
+
+def write_esm_file(filename, values):
+    """
+    Writes the values to a file with the 64 header lines of the ESM format
+    """
+    with open(filename, "w") as f:
+        for i in range(64):
+            f.write("HEADER_%02d: \n" % i)
+        for value in values:
+            f.write("%.6E\n" % value)
+
+
+def get_cases(tmp_dir):
+    """
+    Returns the list of tuples (label, genfromtxt reader, block reader)
+    """
+    cases = []
+    for fname in sorted(os.listdir(ASA_PATH)):
+        ifile = os.path.join(ASA_PATH, fname)
+
+        def genfromtxt(ifile=ifile):
+            for column in range(3):
+                np.genfromtxt(ifile, skip_header=109, usecols=column,
+                              delimiter="", encoding="iso-8859-1")
+
+        def block(ifile=ifile):
+            for column in range(3):
+                read_numeric_block(ifile, skip_header=109, usecols=column)
+        cases.append(("ASA " + fname, genfromtxt, block))
+    values = read_numeric_block(os.path.join(ASA_PATH, fname), 109)
+    esm_file = os.path.join(tmp_dir, "ESM.HNE.ACC.ASC")
+    write_esm_file(esm_file, values.flatten())
+    cases.append(("ESM (%s steps)" % values.size,
+                  lambda: np.genfromtxt(esm_file, skip_header=64),
+                  lambda: read_numeric_block(esm_file, skip_header=64)))
+    return cases
+
+
+def main(repeats):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        results = [(label, timeit(genfromtxt, repeats),
+                    timeit(block, repeats))
+                   for label, genfromtxt, block in get_cases(tmp_dir)]
+    finally:
+        shutil.rmtree(tmp_dir)
+    print("%32s %16s %16s %8s" % ("File", "genfromtxt (ms)", "block (ms)",
+                                  "Speedup"))
+    for label, genfromtxt_time, block_time in results:
+        print("%32s %16.2f %16.2f %8.1f" % (label, 1000. * genfromtxt_time,
+                                            1000. * block_time,
+                                            genfromtxt_time / block_time))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2014-2018 GEM Foundation and G. Weatherill
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of the storage layouts of the record hdf5 files (see
+smtk.sm_utils.HDF5Layout), on the two test databases:
+
+ - "ESM flatfile": scalar IMs and spectra of the ESM sample flatfile, read
+   as observation matrix (PGA, PGV and SA)
+ - "L'Aquila records": time series and spectra of the Sigma records of the
+   hazard tests, read as time series
+
+For each layout the total size of the record files and the mean read time
+(over `--repeats`) are reported.
+
+Usage: python benchmarks/hdf5_layout.py [repeats]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import h5py
+
+from smtk.sm_utils import HDF5Layout
+from smtk.sm_database import load_database
+from smtk.sm_database_builder import SMDatabaseBuilder
+from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
+from smtk.parsers.sigma_database_parser import SigmaDatabaseMetadataReader,\
+    SigmaRecordParser, SigmaSpectraParser
+
+TESTS_PATH = os.path.join(os.path.dirname(__file__), "..", "tests")
+
+ESM_FLATFILE = os.path.join(TESTS_PATH, "file_samples",
+                            "esm_sa_flatfile_2018.csv")
+
+SIGMA_RECORDS = os.path.join(TESTS_PATH, "hazard", "data",
+                             "LAquila_Good_Records")
+
+LAYOUTS = [("contiguous (default)", HDF5Layout()),
+           ("chunked", HDF5Layout(chunks=True)),
+           ("gzip + shuffle", HDF5Layout("gzip", 4, shuffle=True)),
+           ("lzf + shuffle", HDF5Layout("lzf", shuffle=True)),
+           ("compound scalars", HDF5Layout(compound_scalars=True)),
+           ("lzf + compound", HDF5Layout("lzf", shuffle=True,
+                                         compound_scalars=True))]
+
+IMTS = ["PGA", "PGV", "SA(0.1)", "SA(0.2)", "SA(0.5)", "SA(1.0)"]
+
+
+def get_storage_size(database):
+    """
+    Returns the total size (bytes) of the record files of a database
+    """
+    return sum(os.path.getsize(rec.datafile) for rec in database)
+
+
+def timeit(func, repeats):
+    """
+    Returns the mean time (s) of a call to `func`
+    """
+    start = time.time()
+    for _ in range(repeats):
+        func()
+    return (time.time() - start) / repeats
+
+
+def build_esm(db_dir, layout):
+    """
+    Builds the database of the ESM flatfile and returns the function
+    reading its observations
+    """
+    ESMFlatfileParser.autobuild("000", "BENCHMARK", db_dir, ESM_FLATFILE,
+                                layout=layout)
+    database = load_database(db_dir)
+    database.cache_observations = False
+
+    def read():
+        database.get_observation_matrix(IMTS, database.records, "Geometric")
+    return database, read
+
+
+def build_sigma(db_dir, layout):
+    """
+    Builds the database of the L'Aquila records and returns the function
+    reading their time series
+    """
+    builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, db_dir,
+                                layout=layout)
+    builder.build_database("001", "BENCHMARK", SIGMA_RECORDS)
+    builder.parse_records(SigmaRecordParser, SigmaSpectraParser)
+    database = load_database(db_dir)
+
+    def read():
+        for rec in database:
+            with h5py.File(rec.datafile, "r") as fle:
+                for comp in ["X", "Y", "V"]:
+                    loc = "Time Series/%s/Original Record/Acceleration" % comp
+                    if loc in fle:
+                        fle[loc][:]
+    return database, read
+
+
+def main(repeats):
+    results = []
+    for db_label, build in [("ESM flatfile", build_esm),
+                            ("L'Aquila records", build_sigma)]:
+        for label, layout in LAYOUTS:
+            tmp_dir = tempfile.mkdtemp()
+            try:
+                database, read = build(os.path.join(tmp_dir, "db"), layout)
+                results.append((db_label, label, len(database),
+                                get_storage_size(database),
+                                timeit(read, repeats)))
+            finally:
+                shutil.rmtree(tmp_dir)
+    print("%18s %22s %8s %12s %12s" % ("Database", "Layout", "Records",
+                                       "Size (kB)", "Read (ms)"))
+    for db_label, label, nrecs, size, read_time in results:
+        print("%18s %22s %8g %12.1f %12.2f" % (db_label, label, nrecs,
+                                               size / 1024.,
+                                               1000. * read_time))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2014-2018 GEM Foundation and G. Weatherill
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of the memory held per record by a loaded database:
+
+ - "dict objects": the record metadata as plain `__dict__` objects, i.e. the
+   layout of the record classes before the introduction of `__slots__`
+ - "slots objects": all records built as the compact record classes
+ - "lazy, not accessed": the database loaded from the columnar metadata with
+   no record accessed yet
+
+Usage: python benchmarks/record_memory.py [ESM flatfile]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import tracemalloc
+from types import SimpleNamespace
+
+from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
+from smtk.sm_database import load_database
+
+DEFAULT_FLATFILE = os.path.join(os.path.dirname(__file__), "..", "tests",
+                                "parsers", "data",
+                                "esm_flatfile_sample_file.csv")
+
+
+def as_dict_objects(value):
+    """
+    Copies the object graph replacing every metadata object with an
+    equivalent plain `__dict__` object
+    """
+    if isinstance(value, list):
+        return [as_dict_objects(val) for val in value]
+    if hasattr(value, "_get_attributes"):
+        attrs = value._get_attributes()
+    elif hasattr(value, "__dict__") and not isinstance(value, type):
+        attrs = vars(value)
+    else:
+        return value
+    return SimpleNamespace(**dict((key, as_dict_objects(val))
+                                  for key, val in attrs.items()))
+
+
+def measure(build):
+    """
+    Returns the objects created by `build` and the memory they hold
+    """
+    start = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    return objects, tracemalloc.get_traced_memory()[0] - start
+
+
+def main(flatfile):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db_dir = os.path.join(tmp_dir, "db")
+        ESMFlatfileParser.autobuild("000", "BENCHMARK", db_dir, flatfile,
+                                    metadata_format="hdf5")
+        nrecs = len(load_database(db_dir))
+        tracemalloc.start()
+        # All records built as dict based objects
+        _, dict_mem = measure(lambda: [as_dict_objects(rec)
+                                       for rec in load_database(db_dir)])
+        # All records built as compact objects
+        _, slots_mem = measure(lambda: list(load_database(db_dir)))
+        # Lazy database with no record accessed
+        _, lazy_mem = measure(lambda: load_database(db_dir))
+        tracemalloc.stop()
+        print("Records: %g" % nrecs)
+        for label, mem in [("dict objects", dict_mem),
+                           ("slots objects", slots_mem),
+                           ("lazy, not accessed", lazy_mem)]:
+            print("%20s: %10.1f bytes/record" % (label, mem / nrecs))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FLATFILE)
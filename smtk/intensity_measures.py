@@ -541,6 +541,170 @@ def rotipp(acceleration_x, time_step_x, acceleration_y, time_step_y, periods,
     return spec
 
 
+class HorizontalResponse(object):
+    """
+    Responses of the SDOF oscillators to the two horizontal components of a
+    record, computed once and shared by all the horizontal combinations
+    (ordinary combinations, GMRotDpp, GMRotIpp and RotDpp at any percentile).
+
+    The oscillator response is linear in the input motion, so that the
+    response to the pair rotated by an angle is the rotation of the
+    responses to the original pair: the rotated spectra are taken from the
+    shared responses rather than by integrating the rotated time series
+    :param dict sax:
+        Response spectrum of the x-component (as `get_response_spectrum`)
+    :param dict say:
+        Response spectrum of the y-component
+    """
+    GMROTD_ANGLES = np.arange(0., 90., 1.)
+
+    ROTD_ANGLES = np.arange(0., 180., 1.)
+
+    def __init__(self, acceleration_x, time_step_x, acceleration_y,
+                 time_step_y, periods, damping=0.05, units="cm/s/s",
+                 method="Nigam-Jennings"):
+        """
+        :param numpy.ndarray acceleration_x:
+            Acceleration time-series of x-component of record
+        :param float time_step_x:
+            Time step of x-time series (s)
+        :param numpy.ndarray acceleration_y:
+            Acceleration time-series of y-component of record
+        :param float time_step_y:
+            Time step of y-time series (s)
+        """
+        if np.fabs(time_step_x - time_step_y) > 1E-10:
+            raise ValueError("Record pair must have the same time-step!")
+        self.periods = periods
+        self.omega = (2. * np.pi) / np.asarray(periods, dtype=float)
+        self.time_step = time_step_x
+        self.sax, ts_x, x_a, x_v, x_d = get_response_spectrum(
+            acceleration_x, time_step_x, periods, damping, units, method)
+        self.say, ts_y, y_a, y_v, y_d = get_response_spectrum(
+            acceleration_y, time_step_y, periods, damping, units, method)
+        # Oscillator responses and ground motion of the equalised pair, as
+        # tuples (x, y)
+        self.response = {
+            "Acceleration": equalise_series(x_a, y_a),
+            "Velocity": equalise_series(x_v, y_v),
+            "Displacement": equalise_series(x_d, y_d)}
+        self.ground = dict(
+            (key, equalise_series(ts_x[key], ts_y[key]))
+            for key in ["Acceleration", "Velocity", "Displacement"])
+        self._gm_per_angle = None
+
+    def get_spectrum_pair(self):
+        """
+        Returns the response spectra of the x and y components
+        """
+        return self.sax, self.say
+
+    def _rotate(self, values, theta):
+        """
+        Returns the x-component of the pair of `values` rotated by angle
+        theta (decimal degrees)
+        """
+        theta = np.radians(theta)
+        return np.cos(theta) * values[0] + np.sin(theta) * values[1]
+
+    def get_rotated_spectrum(self, theta):
+        """
+        Returns the response spectrum of the x-component of the pair
+        rotated by the angle theta (decimal degrees), with the same keys as
+        that of `get_response_spectrum`
+        """
+        spectrum = {"Period": self.periods}
+        for key in ["Acceleration", "Velocity", "Displacement"]:
+            spectrum[key] = np.max(np.fabs(
+                self._rotate(self.response[key], theta)), axis=0)
+        spectrum["Pseudo-Velocity"] = self.omega * spectrum["Displacement"]
+        spectrum["Pseudo-Acceleration"] = (self.omega ** 2.) *\
+            spectrum["Displacement"]
+        for key, ground_key in [("PGA", "Acceleration"),
+                                ("PGV", "Velocity"),
+                                ("PGD", "Displacement")]:
+            spectrum[key] = np.max(np.fabs(
+                self._rotate(self.ground[ground_key], theta)))
+        return spectrum
+
+    def get_geometric_mean_per_angle(self):
+        """
+        Returns the geometric mean of the peak oscillator accelerations of
+        the pair rotated by each of `GMROTD_ANGLES`, as array of shape
+        [Number Angles, Number Periods]
+        """
+        if self._gm_per_angle is None:
+            self._gm_per_angle = np.zeros([len(self.GMROTD_ANGLES),
+                                           len(self.periods)])
+            for iloc, theta in enumerate(self.GMROTD_ANGLES):
+                # The y-component rotated by theta is the x-component
+                # rotated by theta + 90
+                self._gm_per_angle[iloc, :] = np.sqrt(
+                    np.max(np.fabs(self._rotate(
+                        self.response["Acceleration"], theta)), axis=0) *
+                    np.max(np.fabs(self._rotate(
+                        self.response["Acceleration"], theta + 90.)), axis=0))
+        return self._gm_per_angle
+
+    def gmrotdpp(self, percentile):
+        """
+        Returns the rotationally-dependent geometric mean, as `gmrotdpp`
+        """
+        if (percentile > 100. + 1E-9) or (percentile < 0.):
+            raise ValueError(
+                "Percentile for GMRotDpp must be between 0. and 100.")
+        max_a_theta = self.get_geometric_mean_per_angle()
+        return {"angles": self.GMROTD_ANGLES,
+                "periods": self.periods,
+                "GMRotDpp": np.percentile(max_a_theta, percentile, axis=0),
+                "GeoMeanPerAngle": max_a_theta}
+
+    def gmrotipp(self, percentile):
+        """
+        Returns the rotationally-independent geometric mean, as `gmrotipp`
+        """
+        gmrot = self.gmrotdpp(percentile)
+        min_loc, _ = _get_gmrotd_penalty(gmrot["GMRotDpp"],
+                                         gmrot["GeoMeanPerAngle"])
+        target_angle = gmrot["angles"][min_loc]
+        gmroti = geometric_mean_spectrum(
+            self.get_rotated_spectrum(target_angle),
+            self.get_rotated_spectrum(target_angle + 90.))
+        gmroti["GMRotD{:.2f}".format(percentile)] = gmrot["GMRotDpp"]
+        return gmroti
+
+    def rotdpp(self, percentile):
+        """
+        Returns the rotationally dependent spectrum RotDpp, as `rotdpp`
+        """
+        theta_set = self.ROTD_ANGLES
+        max_a_theta = np.zeros([len(theta_set), len(self.periods) + 1])
+        max_v_theta = np.zeros_like(max_a_theta)
+        max_d_theta = np.zeros_like(max_a_theta)
+        for iloc, theta in enumerate(theta_set):
+            displacement = np.max(np.fabs(
+                self._rotate(self.response["Displacement"], theta)), axis=0)
+            max_a_theta[iloc, 0] = np.max(np.fabs(
+                self._rotate(self.ground["Acceleration"], theta)))
+            max_a_theta[iloc, 1:] = (self.omega ** 2.) * displacement
+            max_v_theta[iloc, 0] = np.max(np.fabs(
+                self._rotate(self.ground["Velocity"], theta)))
+            max_v_theta[iloc, 1:] = self.omega * displacement
+            max_d_theta[iloc, 0] = np.max(np.fabs(
+                self._rotate(self.ground["Displacement"], theta)))
+            max_d_theta[iloc, 1:] = displacement
+        rotadpp = np.percentile(max_a_theta, percentile, axis=0)
+        rotvdpp = np.percentile(max_v_theta, percentile, axis=0)
+        rotddpp = np.percentile(max_d_theta, percentile, axis=0)
+        output = {"Pseudo-Acceleration": rotadpp[1:],
+                  "Pseudo-Velocity": rotvdpp[1:],
+                  "Displacement": rotddpp[1:],
+                  "PGA": rotadpp[0],
+                  "PGV": rotvdpp[0],
+                  "PGD": rotddpp[0]}
+        return output, max_a_theta, max_v_theta, max_d_theta, theta_set
+
+
 ARIAS_FACTOR = pi / (2.0 * (constants.g * 100.))
 
 
@@ -37,6 +37,7 @@ from smtk.sm_database import *
 from smtk.sm_utils import convert_accel_units, get_time_vector
 from smtk.parsers.base_database_parser import (get_float,
                                                get_int,
+                                               read_numeric_block,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader)
 
@@ -64,37 +65,73 @@ def _get_info_from_archive_name(aname):
     ])
 
 
+# Number of header lines of an ASA file (the component names are given on
+# line 107 and the time series start on line 110)
+ASA_HEADER_LINES = 109
+
+# The components are definied using the following names
+COMPONENT_NAMES = {'X': ['ENE', 'N90E', 'N90E;', 'N90W', 'N90W;',
+                         'S90E', 'S90W', 'E--W', 'S9OE'],
+                   'Y': ['ENN', 'N00E', 'N00E;', 'NOOE;', 'N00W',
+                         'NOOW;', 'S00E', 'S00W', 'N--S', 'NOOE'],
+                   'V': ['ENZ', 'V', 'V;+', '+V', 'Z', 'VERT']}
+
+
+def _get_metadata_from_lines(lines):
+    """
+    Pulls the metadata from lines 7 - 80 of the header of an ASA file and
+    returns a cleaned version as a dictionary
+    """
+    metadata = {}
+    # Exclude lines with "==", websites, and with lenghts < 42
+    exclude = ["==", "www"]
+    for line in lines[7:81]:
+        if not any(x in line for x in exclude) and len(line) > 41:
+            # Delete newlines at end and split on ":"
+            row = (line.rstrip("\n")).split(":")
+            if len(row) > 2:
+                # The character ":" occurs somewhere in the datastring
+                if len(row[0].strip()) != 0:
+                    metadata[row[0].strip()] = ":".join(row[1:]).strip()
+            else:
+                # Parse as normal
+                if len(row[0].strip()) != 0:
+                    metadata[row[0].strip()] = row[1].strip()
+                    recentkey = row[0].strip()
+                elif len(row[0].strip()) == 0:
+                    # When values continue on a new line
+                    metadata[recentkey] = (
+                        metadata[recentkey] + ' ' + row[1].strip())
+    return metadata
+
+
 def _get_metadata_from_file(file_str):
     """
     Pulls the metadata from lines 7 - 80 of ASA file and returns a cleaned
     version as an ordered dictionary. Note that every file contains
     the metadata corresponding to all 3 components.
     """
+    with open(file_str, encoding='iso-8859-1') as f:
+        lines = [f.readline() for _ in range(81)]
+    return _get_metadata_from_lines(lines)
 
-    metadata = {}
-    for i in range(7, 81):
-        # Exclude lines with "==", websites, and with lenghts < 42
-        exclude = ["==", "www"]
-        with open(file_str, encoding='iso-8859-1') as f:
-            lines = f.readlines()
-            if not any(x in lines[i] for x in exclude) and\
-                len(lines[i]) > 41:
-                # Delete newlines at end and split on ":"
-                row = ((lines[i]).rstrip("\n")).split(":")
-                if len(row) > 2:
-                    # The character ":" occurs somewhere in the datastring
-                    if len(row[0].strip()) != 0:
-                        metadata[row[0].strip()] = ":".join(row[1:]).strip()
-                else:
-                    # Parse as normal
-                    if len(row[0].strip()) != 0:
-                        metadata[row[0].strip()] = row[1].strip()
-                        recentkey = row[0].strip()
-                    elif len(row[0].strip()) == 0:
-                        # When values continue on a new line
-                        metadata[recentkey] = (
-                            metadata[recentkey] + ' ' + row[1].strip())
-    return metadata
+
+def read_asa_file(file_str):
+    """
+    Reads an ASA file in a single pass
+    :returns:
+        The metadata dictionary, the list of the component names (line 107)
+        and the time series as a matrix (one column per component)
+    """
+    with open(file_str, encoding='iso-8859-1') as f:
+        lines = [f.readline() for _ in range(ASA_HEADER_LINES)]
+        try:
+            data = read_numeric_block(f)
+        except ValueError:
+            raise ValueError(
+                "Check %s has 3 equal length time-series columns"
+                % file_str)
+    return _get_metadata_from_lines(lines), lines[107].split(), data
 
 
 class ASADatabaseMetadataReader(SMDatabaseReader):
@@ -104,9 +141,9 @@ class ASADatabaseMetadataReader(SMDatabaseReader):
     """
     ORGANIZER = []
 
-    def parse(self):
+    def iter_records(self):
         """
-        Parses the record
+        Yields the record of each file
         """
         self.database = GroundMotionDatabase(self.id, self.name)
         self._sort_files()
@@ -114,9 +151,8 @@ class ASADatabaseMetadataReader(SMDatabaseReader):
         for file_dict in self.ORGANIZER:
             # metadata for all componenets comes from the same file
             metadata = _get_metadata_from_file(file_dict["Time-Series"]["X"])
-            self.database.records.append(self.parse_metadata(metadata,
-                                                             file_dict))
-        return self.database
+            yield self.interner.intern_record(
+                self.parse_metadata(metadata, file_dict))
 
     def _sort_files(self):
         """
@@ -442,34 +478,32 @@ class ASATimeSeriesParser(SMTimeSeriesReader):
             ("V", {"Original": {}, "SDOF": {}})])
 
         target_names = list(time_series.keys())
+        # All 3 components are read together, once per file
+        parsed = {}
         for iloc, ifile in enumerate(self.input_files):
             if not os.path.exists(ifile):
                 continue
-            else:
-                component2parse = target_names[iloc]
-                time_series[target_names[iloc]]["Original"] = \
-                    self._parse_time_history(ifile, component2parse)
+            if ifile not in parsed:
+                parsed[ifile] = self._parse_time_histories(ifile)
+            time_series[target_names[iloc]]["Original"] = \
+                parsed[ifile][target_names[iloc]]
         return time_series
 
     def _parse_time_history(self, ifile, component2parse):
         """
         Parses the time history and returns the time history of the specified
-        component. All 3 components are provided in every ASA file. Note that
-        components are defined with various names, and are not always
-        given in the same order
+        component
         """
+        return self._parse_time_histories(ifile)[component2parse]
 
-        # The components are definied using the following names
-        comp_names = {'X': ['ENE', 'N90E', 'N90E;', 'N90W', 'N90W;',
-                            'S90E', 'S90W', 'E--W', 'S9OE'],
-                      'Y': ['ENN', 'N00E', 'N00E;', 'NOOE;', 'N00W',
-                            'NOOW;', 'S00E', 'S00W', 'N--S', 'NOOE'],
-                      'V': ['ENZ', 'V', 'V;+', '+V', 'Z', 'VERT']}
-
-        # Read component names, which are given on line 107
-        o = open(ifile, "r", encoding='iso-8859-1')
-        r = o.readlines()
-        components = list(r[107].split())
+    def _parse_time_histories(self, ifile):
+        """
+        Parses the time histories of the 3 components provided in every ASA
+        file, reading the file once, and returns them in a dictionary keyed
+        by component ("X", "Y" and "V"). Note that components are defined
+        with various names, and are not always given in the same order
+        """
+        metadata, components, data = read_asa_file(ifile)
 
         # Check if any component names are repeated
         if any(components.count(x) > 1 for x in components):
@@ -481,71 +515,41 @@ class ASATimeSeriesParser(SMTimeSeriesReader):
             raise ValueError(
                 "More than 3 components %s in record %s"
                 % (components, ifile))
-
-        # Get acceleration data from correct column
-        column = None
-        for i in comp_names[component2parse]:
-            if i == components[0]:
-                column = 0
-                try:
-                    accel = np.genfromtxt(ifile, skip_header=109,
-                        usecols=column, delimiter='', encoding='iso-8859-1')
-                except:
-                    raise ValueError(
-                        "Check %s has 3 equal length time-series columns"
-                        % ifile)
-                break
-            elif i == components[1]:
-                column = 1
-                try:
-                    accel = np.genfromtxt(ifile, skip_header=109,
-                        usecols=column, delimiter='', encoding='iso-8859-1')
-                except:
-                    raise ValueError(
-                        "Check %s has 3 equal length time-series columns"
-                        % ifile)
-                break
-            elif i == components[2]:
-                column = 2
-                try:
-                    accel = np.genfromtxt(ifile, skip_header=109,
-                        usecols=column, delimiter='', encoding='iso-8859-1')
-                except:
-                    raise ValueError(
-                        "Check %s has 3 equal length time-series columns"
-                        % ifile)
-                break
-        if column is None:
-                raise ValueError(
-                    "None of the components %s were found to be \n\
-                    the %s component of file %s" %
-                    (components, component2parse, ifile))
-
-        # Build the metadata dictionary again
-        metadata = _get_metadata_from_file(ifile)
-
-        # Get units
-        units_provided = metadata["UNIDADES DE LOS DATOS"]
-        units = units_provided[units_provided.find("(") + 1:
-                               units_provided.find(")")]
+        if data.ndim != 2 or data.shape[1] != len(components):
+            raise ValueError(
+                "Check %s has 3 equal length time-series columns" % ifile)
 
         # Get time step, naming is not consistent so allow for variation
         for i in metadata:
             if 'INTERVALO DE MUESTREO, C1' in i:
                 self.time_step = get_float(metadata[i].split("/")[1])
 
-        # Get number of time steps, use len(accel) because
-        # sometimes "NUM. TOTAL DE MUESTRAS, C1-C6" is wrong
-        self.number_steps = len(accel)
-
-        output = {
-            "Acceleration": convert_accel_units(accel, self.units),
-            "Time": get_time_vector(self.time_step, self.number_steps),
-            "Time-step": self.time_step,
-            "Number Steps": self.number_steps,
-            "Units": self.units,
-            "PGA": max(abs(accel)),
-            "PGD": None
-        }
-
+        output = OrderedDict()
+        for component2parse in ["X", "Y", "V"]:
+            # Get acceleration data from correct column
+            column = None
+            for i in COMPONENT_NAMES[component2parse]:
+                if i in components:
+                    column = components.index(i)
+                    break
+            if column is None:
+                raise ValueError(
+                    "None of the components %s were found to be \n\
+                    the %s component of file %s" %
+                    (components, component2parse, ifile))
+            accel = data[:, column]
+
+            # Get number of time steps, use len(accel) because
+            # sometimes "NUM. TOTAL DE MUESTRAS, C1-C6" is wrong
+            self.number_steps = len(accel)
+
+            output[component2parse] = {
+                "Acceleration": convert_accel_units(accel, self.units),
+                "Time": get_time_vector(self.time_step, self.number_steps),
+                "Time-step": self.time_step,
+                "Number Steps": self.number_steps,
+                "Units": self.units,
+                "PGA": max(abs(accel)),
+                "PGD": None
+            }
         return output
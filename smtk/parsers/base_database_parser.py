@@ -21,8 +21,16 @@
 Abstract base class for a strong motion database reader
 """
 import os
+import io
+import re
+import csv
 import abc
+import copy
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 from openquake.baselib.python3compat import with_metaclass
+from smtk.sm_database import MetadataInterner
 
 
 def get_float(xval):
@@ -85,9 +93,160 @@ def get_positive_int(xval):
         return None
 
 
+# Fortran style exponents: "1.0D+02", "1.0d-1" or "1.0D2". Exponents without
+# letter ("1.0-02") are not supported, as they cannot be told apart from
+# adjacent negative values of fixed width columns ("1.0-2.0")
+FORTRAN_EXPONENT = re.compile(r"(?<=[0-9.])[dD](?=[+-]?[0-9])")
+
+
+def read_numeric_block(ifile, skip_header=0, usecols=None,
+                       encoding="iso-8859-1"):
+    """
+    Reads a block of whitespace-separated floats following a header of
+    known length, as a faster replacement of `np.genfromtxt` (the block is
+    parsed by the C reader of `np.loadtxt`). Fortran style exponents are
+    supported. As for `np.genfromtxt` a single column (or an integer
+    `usecols`) is returned as a vector, else as a 2D array
+    :param ifile:
+        Path to the file, or open text file (the header is counted from
+        its current position)
+    :param int skip_header:
+        Number of header lines to skip
+    :param usecols:
+        Column (int) or columns (list) to return (default all)
+    :param str encoding:
+        Encoding of the file (only relevant to the header)
+    """
+    if isinstance(ifile, str):
+        with open(ifile, "r", encoding=encoding) as f:
+            return read_numeric_block(f, skip_header, usecols, encoding)
+    for _ in range(skip_header):
+        ifile.readline()
+    start = ifile.tell()
+    try:
+        data = np.loadtxt(ifile, ndmin=2)
+    except ValueError:
+        # Fortran style exponents (or invalid block)
+        ifile.seek(start)
+        text = FORTRAN_EXPONENT.sub("E", ifile.read())
+        try:
+            data = np.loadtxt(io.StringIO(text), ndmin=2)
+        except ValueError as err:
+            raise ValueError("Invalid numeric block in %s (%s)"
+                             % (getattr(ifile, "name", ifile), str(err)))
+    if usecols is not None:
+        data = data[:, usecols]
+    if data.ndim == 2 and data.shape[1] == 1:
+        return data[:, 0]
+    return data
+
+
+class FlatfileColumns(object):
+    """
+    Columnar view of a csv flatfile, read in one pass: numeric columns are
+    converted (and validated) as whole columns rather than cell by cell,
+    and the rows are only turned into dictionaries (as by
+    `csv.DictReader`) when the record objects are built
+    :param list headers:
+        Headers of the flatfile
+    :param numpy.ndarray data:
+        Values of the cells as strings, (rows x columns)
+    """
+    def __init__(self, filename, delimiter=","):
+        with open(filename, "r") as f:
+            reader = csv.reader(f, delimiter=delimiter)
+            self.headers = next(reader)
+            rows = [row for row in reader if row]
+        ncols = len(self.headers)
+        self.data = np.full([len(rows), ncols], "", dtype=object)
+        for irow, row in enumerate(rows):
+            # Short rows are padded, extra fields are ignored
+            self.data[irow, :min(len(row), ncols)] = row[:ncols]
+        # For repeated headers the last column is used, as csv.DictReader
+        self._index = dict((header, i)
+                           for i, header in enumerate(self.headers))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __contains__(self, header):
+        return header in self._index
+
+    def get_column(self, header):
+        """
+        Returns the strings of a column
+        """
+        return self.data[:, self._index[header]]
+
+    def get_floats(self, headers):
+        """
+        Returns the values of a column (or of a list of columns, as matrix)
+        as floats, with nan for the missing and invalid values
+        """
+        if isinstance(headers, str):
+            return self.get_floats([headers])[:, 0]
+        values = np.char.strip(self.data[:, [self._index[header]
+                                             for header in headers]]
+                               .astype(str))
+        values[values == ""] = "nan"
+        try:
+            return values.astype(float)
+        except ValueError:
+            # Invalid values in some cells
+            output = np.full(values.shape, np.nan)
+            for i, value in np.ndenumerate(values):
+                try:
+                    output[i] = float(value)
+                except ValueError:
+                    pass
+            return output
+
+    def get_missing(self, header):
+        """
+        Returns the boolean mask of the empty cells of a column
+        """
+        return np.char.strip(self.get_column(header).astype(str)) == ""
+
+    def get_row(self, irow):
+        """
+        Returns a row as dictionary of the strings of each header
+        """
+        return dict(zip(self.headers, self.data[irow]))
+
+    def take(self, rows):
+        """
+        Returns the block of the given rows (indices), as a new instance
+        """
+        block = copy.copy(self)
+        block.data = self.data[rows]
+        return block
+
+
+# Copy of the parser used by the worker processes of a chunked parsing (see
+# `SMDatabaseReader._iter_parsed_blocks`)
+_PARSE_WORKER = None
+
+
+def _init_parse_worker(parser):
+    """
+    Initialises a worker process of a chunked parsing
+    """
+    global _PARSE_WORKER
+    _PARSE_WORKER = parser
+
+
+def _parse_block_job(block):
+    """
+    Parses a block of flatfile rows in a worker process
+    """
+    return _PARSE_WORKER._parse_block(block)
+
+
 class SMDatabaseReader(with_metaclass(abc.ABCMeta)):
     """
-    Abstract base class for strong motion database parser
+    Abstract base class for strong motion database parser. Parsers should
+    pass each new record through `self.interner.intern_record` so that
+    records of the same event or site share the same objects
     """
 
     def __init__(self, db_id, db_name, filename, record_folder=None):
@@ -98,16 +257,76 @@ class SMDatabaseReader(with_metaclass(abc.ABCMeta)):
         self.name = db_name
         self.filename = filename
         self.database = None
+        self.interner = MetadataInterner()
         if record_folder:
             self.record_folder = record_folder
         else:
             self.record_folder = self.filename
 
-    @abc.abstractmethod
-    def parse(self):
+    def iter_records(self, *args, **kwargs):
+        """
+        Generator yielding the records of the database one at a time, as
+        they are parsed. Before the first record it sets `self.database` to
+        an empty database (holding the database-level data, e.g. the site
+        ids), to which the records are not appended. Parsers implementing
+        only `parse` yield the records of the parsed database
+        """
+        if type(self).parse is SMDatabaseReader.parse:
+            raise NotImplementedError("%s implements neither parse nor "
+                                      "iter_records" % self.__class__.__name__)
+        database = self.parse(*args, **kwargs)
+        records = list(database.records)
+        database.records = []
+        for record in records:
+            yield record
+
+    def parse(self, *args, **kwargs):
+        """
+        Parses the database, collecting the records yielded by
+        `iter_records` (called with the given arguments)
+        """
+        for record in self.iter_records(*args, **kwargs):
+            self.database.records.append(record)
+        return self.database
+
+    def _parse_block(self, block):
+        """
+        Parses a block of flatfile rows (instance of :class:
+        FlatfileColumns) and returns the list of the results of each row.
+        Implemented by the parsers supporting the chunked parsing
+        """
+        raise NotImplementedError("Chunked parsing not supported by %s"
+                                  % self.__class__.__name__)
+
+    def _iter_parsed_blocks(self, columns, rows, workers, chunk_size=1000):
         """
-        Parses the database
+        Splits the given rows of a flatfile into blocks of `chunk_size`
+        rows, parses the blocks in a pool of `workers` processes (see
+        `_parse_block`) and yields the results of each row, in the order
+        of the rows. The workers get a copy of the parser without the
+        database
         """
+        worker = copy.copy(self)
+        worker.database = None
+        worker.interner = MetadataInterner()
+        starts = iter(range(0, len(rows), chunk_size))
+        pending = deque()
+        with ProcessPoolExecutor(workers, initializer=_init_parse_worker,
+                                 initargs=(worker,)) as pool:
+            try:
+                for start in starts:
+                    pending.append(pool.submit(
+                        _parse_block_job,
+                        columns.take(rows[start:start + chunk_size])))
+                    if len(pending) > 2 * workers:
+                        for result in pending.popleft().result():
+                            yield result
+                while pending:
+                    for result in pending.popleft().result():
+                        yield result
+            finally:
+                for future in pending:
+                    future.cancel()
 
 
 class SMTimeSeriesReader(with_metaclass(abc.ABCMeta)):
@@ -34,6 +34,7 @@ from openquake.hazardlib.geo.geodetic import geodetic_distance
 from smtk.sm_utils import convert_accel_units, get_time_vector
 from smtk.sm_database import *
 from smtk.parsers.base_database_parser import (get_float, get_int,
+                                               read_numeric_block,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader,
                                                SMSpectraReader)
@@ -130,20 +131,17 @@ class ESMDatabaseMetadataReader(SMDatabaseReader):
     Reader for the metadata database of the European Strong Motion Database
     """
     ORGANIZER = []
-    def parse(self):
+    def iter_records(self):
         """
-        Parses the record
+        Yields the record of each set of files
         """
-        file_list = os.listdir(self.filename)
-        num_files = len(file_list)
         self.database = GroundMotionDatabase(self.id, self.name)
         self._sort_files()
         assert (len(self.ORGANIZER) > 0)
         for file_dict in self.ORGANIZER:
             metadata = _get_xyz_metadata(file_dict)
-            self.database.records.append(self.parse_metadata(metadata,
-                                                             file_dict))
-        return self.database
+            yield self.interner.intern_record(
+                self.parse_metadata(metadata, file_dict))
 
     def _sort_files(self):
         """
@@ -464,7 +462,7 @@ class ESMTimeSeriesParser(SMTimeSeriesReader):
         self.time_step = _to_float(metadata["SAMPLING_INTERVAL_S"])
         self.units = metadata["UNITS"]
         # Get acceleration data
-        accel = np.genfromtxt(ifile, skip_header=64)
+        accel = read_numeric_block(ifile, skip_header=64)
         if "DIS" in ifile:
             pga = None
             pgd = np.fabs(_to_float(metadata["PGD_" +
@@ -506,7 +504,7 @@ class ESMSpectraParser(SMSpectraReader):
             if not os.path.exists(ifile):
                 continue
             metadata = _get_metadata_from_file(ifile)
-            data = np.genfromtxt(ifile, skip_header=64)
+            data = read_numeric_block(ifile, skip_header=64)
 
             units = metadata["UNITS"]
             if "s^2" in units:
@@ -531,7 +529,7 @@ class ESMSpectraParser(SMSpectraReader):
             sd_file = ifile.replace("SA.ASC", "SD.ASC")
             if os.path.exists(sd_file):
                 # SD data
-                sd_data = np.genfromtxt(sd_file, skip_header=64)
+                sd_data = read_numeric_block(sd_file, skip_header=64)
                 # Units should be cm
                 sm_record[target_names[iloc]]["Spectra"]["Response"]\
                     ["Displacement"] = {"damping_05": sd_data[:, 1],
@@ -40,13 +40,15 @@ import smtk.trellis.configure as rcfg
 # from smtk.sm_database import *
 from smtk.sm_database import GroundMotionDatabase, GroundMotionRecord,\
     Earthquake, Magnitude, Rupture, FocalMechanism, GCMTNodalPlanes,\
-    Component, RecordSite, RecordDistance
+    Component, RecordSite, RecordDistance, save_database, build_im_store
+import smtk.sm_utils as utils
 from smtk.sm_utils import convert_accel_units
 from ..sm_oq_utils import MECHANISM_TYPE, DIP_TYPE
 from smtk.parsers import valid
 from smtk.parsers.base_database_parser import (get_float, get_int,
                                                get_positive_float,
                                                get_positive_int,
+                                               FlatfileColumns,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader,
                                                SMSpectraReader)
@@ -98,52 +100,321 @@ COUNTRY_CODES = {"AL": "Albania", "AM": "Armenia", "AT": "Austria",
                  "UA": "Ukraine", "UZ": "Uzbekistan", "XK": "Kosovo"}
 
 
+class ESMColumnPlan(object):
+    """
+    Mapping of the ground motion columns of an ESM flatfile, derived once
+    from the headers, so that each row is decoded by direct lookups
+    :param list headers:
+        Headers of the flatfile
+    :param scalars:
+        For each component, list of the tuples (IM, header) of its scalar
+        IMs
+    :param spectra:
+        For each component, tuple of the headers of its spectral ordinates
+        (sorted by period) and of the sorted periods
+    """
+    IMTS = ["U", "V", "W", "rotD00", "rotD100", "rotD50"]
+    SCALAR_IMTS = ["pga", "pgv", "pgd", "T90", "housner", "ia", "CAV"]
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.scalars = OrderedDict()
+        self.spectra = OrderedDict()
+        for imt in self.IMTS:
+            self.scalars[imt] = [
+                (scalar, header) for header in headers
+                for scalar in self.SCALAR_IMTS
+                if header == "{:s}_{:s}".format(imt, scalar)]
+            key = "{:s}_T".format(imt)
+            # Not a spectral period but T90
+            spectra_headers = [header for header in headers
+                               if key in header and
+                               header != "{:s}90".format(key)]
+            periods = np.array([
+                float(header.replace(key, "").replace("_", "."))
+                for header in spectra_headers])
+            idx = np.argsort(periods)
+            self.spectra[imt] = ([spectra_headers[i] for i in idx],
+                                 periods[idx])
+
+    def decode(self, row):
+        """
+        Returns the dictionaries of the scalars and spectra of the
+        components of a row (see
+        `ESMFlatfileParser._retreive_ground_motion_from_row`)
+        """
+        scalars = OrderedDict()
+        spectra = OrderedDict()
+        for imt in self.IMTS:
+            scalar_dict = {}
+            for scalar, header in self.scalars[imt]:
+                value = row[header].strip()
+                scalar_dict[scalar] = np.fabs(float(value)) if value\
+                    else None
+            scalars[imt] = scalar_dict
+            headers, periods = self.spectra[imt]
+            values = np.full(len(headers), np.nan)
+            for i, header in enumerate(headers):
+                value = row[header].strip()
+                if value:
+                    values[i] = np.fabs(float(value))
+            spectra[imt] = {"Periods": periods, "Values": values}
+        return scalars, spectra
+
+
+class ESMGroundMotion(object):
+    """
+    Ground motion of all the rows of an ESM flatfile, converted by columns
+    :param plan:
+        Column plan as instance of :class: ESMColumnPlan
+    :param dict scalars:
+        For each component, matrix of the absolute values of the scalar IMs
+        (rows x IMs, nan if missing)
+    :param dict spectra:
+        For each component, matrix of the absolute values of the spectral
+        ordinates (rows x periods, nan if missing)
+    """
+    def __init__(self, plan, columns):
+        self.plan = plan
+        self.scalars = OrderedDict()
+        self.spectra = OrderedDict()
+        for imt in plan.IMTS:
+            self.scalars[imt] = np.fabs(columns.get_floats(
+                [header for _, header in plan.scalars[imt]]))
+            self.spectra[imt] = np.fabs(columns.get_floats(
+                plan.spectra[imt][0]))
+
+    def get_row(self, irow):
+        """
+        Returns the dictionaries of the scalars and spectra of the
+        components of a row, as `ESMColumnPlan.decode`
+        """
+        scalars = OrderedDict()
+        spectra = OrderedDict()
+        for imt in self.plan.IMTS:
+            scalars[imt] = dict(
+                (scalar, None if np.isnan(value) else value)
+                for (scalar, _), value in zip(self.plan.scalars[imt],
+                                              self.scalars[imt][irow]))
+            spectra[imt] = {"Periods": self.plan.spectra[imt][1],
+                            "Values": self.spectra[imt][irow]}
+        return scalars, spectra
+
+
+# Kinds of the numeric metadata columns, converted as by the functions of
+# smtk.parsers.valid
+LATITUDE, LONGITUDE, POSITIVE, STRIKE, DIP, RAKE, MAGNITUDE, OPTIONAL,\
+    INTEGER = range(9)
+
+METADATA_COLUMNS = OrderedDict([
+    ("ev_latitude", LATITUDE), ("ev_longitude", LONGITUDE),
+    ("ev_depth_km", POSITIVE), ("EMEC_Mw", MAGNITUDE), ("Mw", MAGNITUDE),
+    ("Ms", MAGNITUDE), ("ML", MAGNITUDE),
+    ("strike_1", OPTIONAL), ("dip_1", OPTIONAL), ("rake_1", OPTIONAL),
+    ("strike_2", OPTIONAL), ("dip_2", OPTIONAL), ("rake_2", OPTIONAL),
+    ("es_strike", STRIKE), ("es_dip", DIP), ("es_rake", RAKE),
+    ("es_z_top", POSITIVE), ("es_length", POSITIVE), ("es_width", POSITIVE),
+    ("epi_dist", POSITIVE), ("epi_az", POSITIVE), ("JB_dist", POSITIVE),
+    ("rup_dist", POSITIVE), ("Rx_dist", OPTIONAL), ("Ry0_dist", POSITIVE),
+    ("st_longitude", LONGITUDE), ("st_latitude", LATITUDE),
+    ("st_elevation", OPTIONAL), ("vs30_m_sec", OPTIONAL),
+    ("vs30_m_sec_WA", OPTIONAL), ("slope_deg", OPTIONAL),
+    ("sensor_depth_m", OPTIONAL), ("late_triggered_flag_01", INTEGER),
+    ("U_azimuth_deg", OPTIONAL), ("V_azimuth_deg", OPTIONAL),
+    ("U_hp", OPTIONAL), ("V_hp", OPTIONAL), ("W_hp", OPTIONAL),
+    ("U_lp", OPTIONAL), ("V_lp", OPTIONAL), ("W_lp", OPTIONAL)])
+
+
+class ESMMetadata(object):
+    """
+    Numeric metadata of all the rows of an ESM flatfile, converted and
+    validated by columns (as the functions of smtk.parsers.valid): values
+    out of range are None (False for the coordinates)
+    :param dict values:
+        Array of the values of each column of `METADATA_COLUMNS` in the
+        flatfile (nan if missing or out of range)
+    :param numpy.ndarray errors:
+        Boolean mask of the rows that cannot be parsed (invalid numbers,
+        missing coordinates or epicentral distance)
+    :param dict event_times:
+        Date-time of each distinct event time string (False if invalid)
+    """
+    def __init__(self, columns):
+        self.values = OrderedDict()
+        self.errors = np.zeros(len(columns), dtype=bool)
+        # The rupture columns are only used by the events with a source
+        has_source = np.logical_not(columns.get_missing("event_source_id"))
+        for header, kind in METADATA_COLUMNS.items():
+            if header not in columns:
+                continue
+            values = columns.get_floats(header)
+            missing = columns.get_missing(header)
+            invalid = np.isnan(values) & np.logical_not(missing)
+            with np.errstate(invalid="ignore"):
+                if kind in (LATITUDE, LONGITUDE):
+                    limit = 90.0 if kind == LATITUDE else 180.0
+                    errors = missing | invalid
+                    values[(values == 0.0) | (np.fabs(values) > limit)] =\
+                        np.nan
+                elif kind in (OPTIONAL, INTEGER):
+                    errors = np.zeros(len(columns), dtype=bool)
+                    if np.any(invalid):
+                        print("Invalid values of %s in %s rows - ignored"
+                              % (header, np.sum(invalid)))
+                else:
+                    errors = invalid
+                    if kind == POSITIVE:
+                        values[values < 0.0] = np.nan
+                    elif kind == STRIKE:
+                        values[(values <= 0.0) | (values > 360.0)] = np.nan
+                    elif kind == DIP:
+                        values[(values <= 0.0) | (values > 90.0)] = np.nan
+                    elif kind == RAKE:
+                        values[(values == 0.0) |
+                               (np.fabs(values) > 180.0)] = np.nan
+            if header.startswith("es_"):
+                errors &= has_source
+            if header == "epi_dist":
+                errors |= np.isnan(values)
+            if np.any(errors):
+                print("Invalid values of %s in %s rows" % (header,
+                                                           np.sum(errors)))
+            self.errors |= errors
+            self.values[header] = values
+        self._times = columns.get_column("event_time")
+        self.event_times = dict(
+            (value, valid.date_time(value, "%Y-%m-%d %H:%M:%S"))
+            for value in set(self._times))
+
+    def get_row(self, irow):
+        """
+        Returns the dictionary of the converted metadata of a row
+        """
+        row = {"event_time": self.event_times[self._times[irow]]}
+        for header, values in self.values.items():
+            kind = METADATA_COLUMNS[header]
+            value = values[irow]
+            if np.isnan(value):
+                row[header] = False if kind in (LATITUDE, LONGITUDE)\
+                    else None
+            elif kind == INTEGER:
+                row[header] = int(value)
+            else:
+                row[header] = float(value)
+        return row
+
+
 class ESMFlatfileParser(SMDatabaseReader):
     """
     Parses the ESM metadata from the flatfile to a set of metadata objects
     """
     M_PRECEDENCE = ["EMEC_Mw", "Mw", "Ms", "ML"]
     BUILD_FINITE_DISTANCES = False
+    # Storage layout of the record hdf5 files
+    layout = utils.DEFAULT_HDF5_LAYOUT
+    # Mapping of the ground motion columns (see ESMColumnPlan)
+    column_plan = None
 
-    def parse(self, location="./"):
+    def iter_records(self, location="./", workers=None, chunk_size=1000):
         """
-
+        Parses the flatfile, writing the hdf5 file of each record, and
+        yields the records. With a pool of workers the hdf5 file of a
+        yielded record may still be pending: all of the files are written
+        when the generator is exhausted (or closed)
+        :param int workers:
+            Number of processes parsing blocks of `chunk_size` rows (default
+            None: the rows are parsed sequentially). The hdf5 files are then
+            written by a dedicated thread and the records are merged in the
+            order of the rows, with shared events and sites
+        :param int chunk_size:
+            Number of rows of each block
         """
-        headers = getline(self.filename, 1).rstrip("\n").split(";")
+        # Read in csv, by columns
+        columns = FlatfileColumns(self.filename, delimiter=";")
+        headers = columns.headers
         for hdr in HEADERS:
             if hdr not in headers:
                 raise ValueError("Required header %s is missing in file"
                                  % hdr)
-        # Read in csv
-        reader = csv.DictReader(open(self.filename, "r"), delimiter=";")
-        metadata = []
+        self.column_plan = ESMColumnPlan(headers)
         self.database = GroundMotionDatabase(self.id, self.name)
-        counter = 0
-        for row in reader:
-            if self._sanitise(row, reader):
-                # Build the metadata
-                record = self._parse_record(row)
-                if record:
-                    # Parse the strong motion
-                    record = self._parse_ground_motion(
-                        os.path.join(location, "records"),
-                        row, record, headers)
-                    self.database.records.append(record)
-
-                else:
+        location = os.path.join(location, "records")
+        if workers and workers > 1 and len(columns) > chunk_size:
+            results = self._iter_parsed_blocks(
+                columns, np.arange(len(columns)), workers, chunk_size)
+            writer = utils.BackgroundWriter(self._parse_ground_motion)
+        else:
+            results = self._iter_block(columns)
+            writer = None
+        try:
+            for counter, (record, ground_motion) in enumerate(results):
+                if not record:
                     print("Record with sequence number %s is null/invalid"
-                          % "{:s}-{:s}".format(row["event_id"],
-                                               row["station_code"]))
-            if (counter % 100) == 0:
-                print("Processed record %s - %s" % (str(counter),
-                                                    record.id))
+                          % ground_motion)
+                    continue
+                record = self.interner.intern_record(record)
+                # Parse the strong motion
+                if writer is None:
+                    self._parse_ground_motion(location, None, record,
+                                              headers, ground_motion)
+                else:
+                    writer.put(location, None, record, headers,
+                               ground_motion)
+                if (counter % 100) == 0:
+                    print("Processed record %s - %s" % (str(counter),
+                                                        record.id))
+                yield record
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def _iter_block(self, block):
+        """
+        Yields for each row of a block of the flatfile the tuple of the
+        record and of its ground motion (see :class: ESMGroundMotion), or
+        None and the id of the row if the record is invalid
+        """
+        if self.column_plan is None or\
+                self.column_plan.headers != block.headers:
+            self.column_plan = ESMColumnPlan(block.headers)
+        # Metadata and ground motion values of all rows, converted once by
+        # columns
+        metadata = ESMMetadata(block)
+        ground_motion = ESMGroundMotion(self.column_plan, block)
+        for irow in range(len(block)):
+            row = block.get_row(irow)
+            # Build the metadata
+            record = None if metadata.errors[irow] else\
+                self._parse_record(row, metadata.get_row(irow))
+            if record:
+                yield record, ground_motion.get_row(irow)
+            else:
+                yield None, "{:s}-{:s}".format(row["event_id"],
+                                               row["station_code"])
 
-            counter += 1
+    def _parse_block(self, block):
+        """
+        Parses a block of the flatfile in a worker process (see `_iter_block`)
+        """
+        return list(self._iter_block(block))
 
     @classmethod
-    def autobuild(cls, dbid, dbname, output_location, flatfile_location):
+    def autobuild(cls, dbid, dbname, output_location, flatfile_location,
+                  metadata_format="pkl", layout=None, im_store=False,
+                  workers=None):
         """
         Quick and dirty full database builder!
+        :param str metadata_format:
+            Format of the metadata file: "pkl" (default), "json" or "hdf5"
+            (columnar binary)
+        :param layout:
+            Storage layout of the record hdf5 files, as instance of :class:
+            smtk.sm_utils.HDF5Layout (default contiguous and uncompressed)
+        :param bool im_store:
+            If True the consolidated IM store of the records is also built
+            (see :class:`smtk.sm_database.IMStore`)
+        :param int workers:
+            Number of processes parsing the flatfile (see `iter_records`)
         """
         if os.path.exists(output_location):
             raise IOError("Target database directory %s already exists!"
@@ -153,14 +424,18 @@ class ESMFlatfileParser(SMDatabaseReader):
         os.mkdir(os.path.join(output_location, "records"))
         # Create an instance of the parser class
         database = cls(dbid, dbname, flatfile_location)
+        if layout is not None:
+            database.layout = layout
         # Parse the records
         print("Parsing Records ...")
-        database.parse(location=output_location)
+        database.parse(location=output_location, workers=workers)
         # Save itself to file
-        metadata_file = os.path.join(output_location, "metadatafile.pkl")
-        print("Storing metadata to file %s" % metadata_file)
-        with open(metadata_file, "wb+") as f:
-            pickle.dump(database.database, f)
+        metadata_file = save_database(database.database, output_location,
+                                      metadata_format)
+        print("Stored metadata to file %s" % metadata_file)
+        if im_store:
+            build_im_store(database.database, output_location,
+                           layout=database.layout)
         return database
 
     def _sanitise(self, row, reader):
@@ -169,19 +444,24 @@ class ESMFlatfileParser(SMDatabaseReader):
         """
         return True
 
-    def _parse_record(self, metadata):
+    def _parse_record(self, metadata, values):
+        """
+        Builds the record of a row from its strings (`metadata`) and its
+        converted numeric values (see :class: ESMMetadata)
+        """
         # Waveform ID not provided in file so concatenate Event and Station ID
         wfid = "_".join([metadata["event_id"], metadata["network_code"],
                          metadata["station_code"], metadata["location_code"]])
         wfid = wfid.replace("-", "_")
         # Parse the event metadata
-        event = self._parse_event_data(metadata)
+        event = self._parse_event_data(metadata, values)
         # Parse the distance metadata
-        distances = self._parse_distances(metadata, event.depth)
+        distances = self._parse_distances(values, event.depth)
         # Parse the station metadata
-        site = self._parse_site_data(metadata)
+        site = self._parse_site_data(metadata, values)
         # Parse waveform data
-        xcomp, ycomp, vertical = self._parse_waveform_data(metadata, wfid)
+        xcomp, ycomp, vertical = self._parse_waveform_data(metadata, values,
+                                                           wfid)
         return GroundMotionRecord(wfid,
                                   [None, None, None],
                                   event, distances, site,
@@ -189,7 +469,7 @@ class ESMFlatfileParser(SMDatabaseReader):
                                   vertical=vertical)
 
 
-    def _parse_event_data(self, metadata):
+    def _parse_event_data(self, metadata, values):
         """
         Parses the event metadata
         """
@@ -203,29 +483,29 @@ class ESMFlatfileParser(SMDatabaseReader):
         else:
             eq_country = None
         # Date and time
-        eq_datetime = valid.date_time(metadata["event_time"],
-                                     "%Y-%m-%d %H:%M:%S")
+        eq_datetime = values["event_time"]
         # Latitude, longitude and depth
-        eq_lat = valid.latitude(metadata["ev_latitude"])
-        eq_lon = valid.longitude(metadata["ev_longitude"])
-        eq_depth = valid.positive_float(metadata["ev_depth_km"], "ev_depth_km")
+        eq_lat = values["ev_latitude"]
+        eq_lon = values["ev_longitude"]
+        eq_depth = values["ev_depth_km"]
         if not eq_depth:
             eq_depth = 0.0
         eqk = Earthquake(eq_id, eq_name, eq_datetime, eq_lon, eq_lat, eq_depth,
                          None, # Magnitude not defined yet
                          eq_country=eq_country)
         # Get preferred magnitude and list
-        pref_mag, magnitude_list = self._parse_magnitudes(metadata)
+        pref_mag, magnitude_list = self._parse_magnitudes(metadata, values)
         eqk.magnitude = pref_mag
         eqk.magnitude_list = magnitude_list
         eqk.rupture, eqk.mechanism = self._parse_rupture_mechanism(metadata,
+                                                                   values,
                                                                    eq_id,
                                                                    eq_name,
                                                                    pref_mag,
                                                                    eq_depth)
         return eqk
 
-    def _parse_magnitudes(self, metadata):
+    def _parse_magnitudes(self, metadata, values):
         """
         So, here things get tricky. Up to four magnitudes are defined in the
         flatfile (EMEC Mw, MW, Ms and ML). An order of precedence is required
@@ -234,8 +514,8 @@ class ESMFlatfileParser(SMDatabaseReader):
         pref_mag = None
         mag_list = []
         for key in self.M_PRECEDENCE:
-            mvalue = metadata[key].strip()
-            if mvalue:
+            mvalue = values[key]
+            if mvalue is not None:
                 if key == "EMEC_Mw":
                     mtype = "Mw"
                     msource = "EMEC({:s}|{:s})".format(
@@ -244,7 +524,7 @@ class ESMFlatfileParser(SMDatabaseReader):
                 else:
                     mtype = key
                     msource = metadata[key + "_ref"].strip()
-                mag = Magnitude(float(mvalue),
+                mag = Magnitude(mvalue,
                                 mtype,
                                 source=msource)
                 if not pref_mag:
@@ -252,7 +532,8 @@ class ESMFlatfileParser(SMDatabaseReader):
                 mag_list.append(mag)
         return pref_mag, mag_list
 
-    def _parse_rupture_mechanism(self, metadata, eq_id, eq_name, mag, depth):
+    def _parse_rupture_mechanism(self, metadata, values, eq_id, eq_name, mag,
+                                 depth):
         """
         If rupture data is available - parse it, otherwise return None
         """
@@ -268,8 +549,8 @@ class ESMFlatfileParser(SMDatabaseReader):
             # See if focal mechanism exists
             fm_set = []
             for key in ["strike_1", "dip_1", "rake_1"]:
-                if key in metadata:
-                    fm_param = valid.vfloat(metadata[key], key)
+                if key in values:
+                    fm_param = values[key]
                     if fm_param is not None:
                         fm_set.append(fm_param)
             if len(fm_set) == 3:
@@ -279,8 +560,8 @@ class ESMFlatfileParser(SMDatabaseReader):
                                                         "rake": fm_set[2]}
             fm_set = []
             for key in ["strike_2", "dip_2", "rake_2"]:
-                if key in metadata:
-                    fm_param = valid.vfloat(metadata[key], key)
+                if key in values:
+                    fm_param = values[key]
                     if fm_param is not None:
                         fm_set.append(fm_param)
             if len(fm_set) == 3:
@@ -299,12 +580,12 @@ class ESMFlatfileParser(SMDatabaseReader):
                     }
             return rupture, mechanism
 
-        strike = valid.strike(metadata["es_strike"])
-        dip = valid.dip(metadata["es_dip"])
-        rake = valid.rake(metadata["es_rake"])
-        ztor = valid.positive_float(metadata["es_z_top"], "es_z_top")
-        length = valid.positive_float(metadata["es_length"], "es_length")
-        width = valid.positive_float(metadata["es_width"], "es_width")
+        strike = values["es_strike"]
+        dip = values["es_dip"]
+        rake = values["es_rake"]
+        ztor = values["es_z_top"]
+        length = values["es_length"]
+        width = values["es_width"]
         rupture = Rupture(eq_id, eq_name, mag, length, width, ztor)
 
         # Get mechanism type and focal mechanism
@@ -324,16 +605,16 @@ class ESMFlatfileParser(SMDatabaseReader):
                                                 "rake": rake}
         return rupture, mechanism
 
-    def _parse_distances(self, metadata, hypo_depth):
+    def _parse_distances(self, values, hypo_depth):
         """
         Parse the distances
         """
-        repi = valid.positive_float(metadata["epi_dist"], "epi_dist")
-        razim = valid.positive_float(metadata["epi_az"], "epi_az")
-        rjb = valid.positive_float(metadata["JB_dist"], "JB_dist")
-        rrup = valid.positive_float(metadata["rup_dist"], "rup_dist")
-        r_x = valid.vfloat(metadata["Rx_dist"], "Rx_dist")
-        ry0 = valid.positive_float(metadata["Ry0_dist"], "Ry0_dist")
+        repi = values["epi_dist"]
+        razim = values["epi_az"]
+        rjb = values["JB_dist"]
+        rrup = values["rup_dist"]
+        r_x = values["Rx_dist"]
+        ry0 = values["Ry0_dist"]
         rhypo = sqrt(repi ** 2. + hypo_depth ** 2.)
         if not isinstance(rjb, float):
             # In the first case Rjb == Repi
@@ -355,7 +636,7 @@ class ESMFlatfileParser(SMDatabaseReader):
         distances.azimuth = razim
         return distances
 
-    def _parse_site_data(self, metadata):
+    def _parse_site_data(self, metadata, values):
         """
         Parses the site information
         """
@@ -363,12 +644,12 @@ class ESMFlatfileParser(SMDatabaseReader):
         station_code = metadata["station_code"].strip()
         site_id = "{:s}-{:s}".format(network_code, station_code)
         location_code = metadata["location_code"].strip()
-        site_lon = valid.longitude(metadata["st_longitude"])
-        site_lat = valid.latitude(metadata["st_latitude"])
-        elevation = valid.vfloat(metadata["st_elevation"], "st_elevation")
+        site_lon = values["st_longitude"]
+        site_lat = values["st_latitude"]
+        elevation = values["st_elevation"]
 
-        vs30 = valid.vfloat(metadata["vs30_m_sec"], "vs30_m_sec")
-        vs30_topo = valid.vfloat(metadata["vs30_m_sec_WA"], "vs30_m_sec_WA")
+        vs30 = values["vs30_m_sec"]
+        vs30_topo = values["vs30_m_sec_WA"]
         if vs30:
             vs30_measured = True
         elif vs30_topo:
@@ -385,9 +666,8 @@ class ESMFlatfileParser(SMDatabaseReader):
                           site_lat, elevation, vs30, vs30_measured,
                           network_code=network_code,
                           country=st_country)
-        site.slope = valid.vfloat(metadata["slope_deg"], "slope_deg")
-        site.sensor_depth = valid.vfloat(metadata["sensor_depth_m"],
-                                         "sensor_depth_m")
+        site.slope = values["slope_deg"]
+        site.sensor_depth = values["sensor_depth_m"]
         site.instrument_type = metadata["instrument_code"].strip()
         if site.vs30:
             site.z1pt0 = vs30_to_z1pt0_cy14(vs30)
@@ -397,32 +677,28 @@ class ESMFlatfileParser(SMDatabaseReader):
             site.building_structure = HOUSING[housing_code]
         return site
 
-    def _parse_waveform_data(self, metadata, wfid):
+    def _parse_waveform_data(self, metadata, values, wfid):
         """
         Parse the waveform data
         """
-        late_trigger = valid.vint(metadata["late_triggered_flag_01"],
-                                  "late_triggered_flag_01")
+        late_trigger = values["late_triggered_flag_01"]
         # U channel - usually east
         xorientation = metadata["U_channel_code"].strip()
-        xazimuth = valid.vfloat(metadata["U_azimuth_deg"], "U_azimuth_deg")
-        xfilter = {"Low-Cut": valid.vfloat(metadata["U_hp"], "U_hp"),
-                   "High-Cut": valid.vfloat(metadata["U_lp"], "U_lp")}
+        xazimuth = values["U_azimuth_deg"]
+        xfilter = {"Low-Cut": values["U_hp"], "High-Cut": values["U_lp"]}
         xcomp = Component(wfid, xazimuth, waveform_filter=xfilter,
                           units="cm/s/s")
         xcomp.late_trigger = late_trigger
         # V channel - usually North
         vorientation = metadata["V_channel_code"].strip()
-        vazimuth = valid.vfloat(metadata["V_azimuth_deg"], "V_azimuth_deg")
-        vfilter = {"Low-Cut": valid.vfloat(metadata["V_hp"], "V_hp"),
-                   "High-Cut": valid.vfloat(metadata["V_lp"], "V_lp")}
+        vazimuth = values["V_azimuth_deg"]
+        vfilter = {"Low-Cut": values["V_hp"], "High-Cut": values["V_lp"]}
         vcomp = Component(wfid, vazimuth, waveform_filter=vfilter,
                           units="cm/s/s")
         vcomp.late_trigger = late_trigger
         zorientation = metadata["W_channel_code"].strip()
         if zorientation:
-            zfilter = {"Low-Cut": valid.vfloat(metadata["W_hp"], "W_hp"),
-                       "High-Cut": valid.vfloat(metadata["W_lp"], "W_lp")}
+            zfilter = {"Low-Cut": values["W_hp"], "High-Cut": values["W_lp"]}
             zcomp = Component(wfid, None, waveform_filter=zfilter,
                               units="cm/s/s")
             zcomp.late_trigger = late_trigger
@@ -431,13 +707,18 @@ class ESMFlatfileParser(SMDatabaseReader):
         
         return xcomp, vcomp, zcomp
 
-    def _parse_ground_motion(self, location, row, record, headers):
+    def _parse_ground_motion(self, location, row, record, headers,
+                             ground_motion=None):
         """
         In this case we parse the information from the flatfile directly
         to hdf5 at the metadata stage
+        :param ground_motion:
+            Scalars and spectra of the row, if already decoded (see
+            :class: ESMGroundMotion)
         """
         # Get the data
-        scalars, spectra = self._retreive_ground_motion_from_row(row, headers)
+        scalars, spectra = self._retreive_ground_motion_from_row(
+            row, headers, ground_motion)
         # Build the hdf5 files
         filename = os.path.join(location, "{:s}.hdf5".format(record.id))
         fle = h5py.File(filename, "w-")
@@ -446,6 +727,7 @@ class ESMFlatfileParser(SMDatabaseReader):
             comp_grp = ims_grp.create_group(comp)
             # Add on the scalars
             scalar_grp = comp_grp.create_group("Scalar")
+            comp_scalars = []
             for imt in scalars[key]:
                 if imt in ["ia", "housner"]:
                     # In the smtk convention it is "Ia" and "Housner"
@@ -453,8 +735,8 @@ class ESMFlatfileParser(SMDatabaseReader):
                 else:
                     # Everything else to upper case (PGA, PGV, PGD, T90, CAV)
                     ikey = imt.upper()
-                dset = scalar_grp.create_dataset(ikey, (1,), dtype="f")
-                dset[:] = scalars[key][imt]
+                comp_scalars.append((ikey, scalars[key][imt], {}))
+            self.layout.create_scalars(scalar_grp, comp_scalars)
             # Add on the spectra
             spectra_grp = comp_grp.create_group("Spectra")
             response = spectra_grp.create_group("Response")
@@ -470,14 +752,15 @@ class ESMFlatfileParser(SMDatabaseReader):
 
             # Add on the values
             values = spectra[key]["Values"]
-            spectra_dset = accel.create_dataset("damping_05", values.shape,
-                                                dtype="f")
+            spectra_dset = self.layout.create_dataset(accel, "damping_05",
+                                                      values.shape)
             spectra_dset[:] = np.copy(values)
             spectra_dset.attrs["Damping"] = 5.0
         # Add on the horizontal values
         hcomp = ims_grp.create_group("H")
         # Scalars - just geometric mean for now
         hscalar = hcomp.create_group("Scalar")
+        h_scalars = []
         for imt in scalars["Geometric"]:
             if imt in ["ia", "housner"]:
                 # In the smtk convention it is "Ia" and "Housner"
@@ -485,8 +768,8 @@ class ESMFlatfileParser(SMDatabaseReader):
             else:
                 # Everything else to upper case (PGA, PGV, PGD, T90, CAV)
                 key = imt.upper()
-            dset = hscalar.create_dataset(key, (1,), dtype="f")
-            dset[:] = scalars["Geometric"][imt]
+            h_scalars.append((key, scalars["Geometric"][imt], {}))
+        self.layout.create_scalars(hscalar, h_scalars)
         # For Spectra - can support multiple components
         hspectra = hcomp.create_group("Spectra")
         hresponse = hspectra.create_group("Response")
@@ -507,60 +790,30 @@ class ESMFlatfileParser(SMDatabaseReader):
                 key = copy.deepcopy(htype)
             htype_grp = haccel.create_group(htype)
             hvals = spectra[htype]["Values"]
-            hspec_dset = htype_grp.create_dataset("damping_05", hvals.shape,
-                                                  dtype="f")
+            hspec_dset = self.layout.create_dataset(htype_grp, "damping_05",
+                                                    hvals.shape)
             hspec_dset[:] = hvals
             hspec_dset.attrs["Units"] = "cm/s/s"
+        fle.close()
         record.datafile = filename
         return record
 
 
-    def _retreive_ground_motion_from_row(self, row, header_list):
+    def _retreive_ground_motion_from_row(self, row, header_list,
+                                         ground_motion=None):
         """
-
+        Returns the scalars and spectra of each component of a row, decoded
+        with the column plan of the headers (built once per flatfile),
+        unless already decoded (`ground_motion`)
         """
-        imts = ["U", "V", "W", "rotD00", "rotD100", "rotD50"]
-        spectra = []
-        scalar_imts = ["pga", "pgv", "pgd", "T90", "housner", "ia", "CAV"]
-        scalars = []
-        for imt in imts:
-            periods = []
-            values = []
-            key = "{:s}_T".format(imt)
-            scalar_dict = {}
-            for header in header_list:
-                # Deal with the scalar case
-                for scalar in scalar_imts:
-                    if header == "{:s}_{:s}".format(imt, scalar):
-                        # The value is a scalar
-                        value = row[header].strip()
-                        if value:
-                            scalar_dict[scalar] = np.fabs(float(value))
-                        else:
-                            scalar_dict[scalar] = None
-            scalars.append((imt, scalar_dict))
-            for header in header_list:
-                if key in header:
-                    if header == "{:s}90".format(key):
-                        # Not a spectral period but T90
-                        continue
-                    iky = header.replace(key, "").replace("_", ".")
-                    #print imt, key, header, iky
-                    periods.append(float(iky))
-                    value = row[header].strip()
-                    if value:
-                        values.append(np.fabs(float(value)))
-                    else:
-                        values.append(np.nan)
-                    #values.append(np.fabs(float(row[header].strip())))
-            periods = np.array(periods)
-            values = np.array(values)
-            idx = np.argsort(periods)
-            spectra.append((imt, {"Periods": periods[idx],
-                                   "Values": values[idx]}))
+        if ground_motion is not None:
+            scalars, spectra = ground_motion
+        else:
+            if self.column_plan is None or\
+                    self.column_plan.headers is not header_list:
+                self.column_plan = ESMColumnPlan(header_list)
+            scalars, spectra = self.column_plan.decode(row)
         # Add on the as-recorded geometric mean
-        spectra = OrderedDict(spectra)
-        scalars = OrderedDict(scalars)
         spectra["Geometric"] = {
             "Values": np.sqrt(spectra["U"]["Values"] *
                               spectra["V"]["Values"]),
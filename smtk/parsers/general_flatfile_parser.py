@@ -43,6 +43,7 @@ from smtk.sm_utils import convert_accel_units
 from smtk.parsers.base_database_parser import (get_float, get_int,
                                                get_positive_float,
                                                get_positive_int,
+                                               FlatfileColumns,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader,
                                                SMSpectraReader)
@@ -138,33 +139,69 @@ class GeneralFlatfileParser(SimpleFlatfileParserV9):
     Operates in the same manner as for SARA Simple Flatfile parser, albeit
     with Rx and Ry0 added as explicit columns
     """
-    def parse(self):
+    FLOAT_COLUMNS = SimpleFlatfileParserV9.FLOAT_COLUMNS + ["Rx (km)",
+                                                            "Ry0 (km)"]
+
+    def iter_records(self, workers=None, chunk_size=1000):
         """
-        Parses the database
+        Yields the record of each valid row of the flatfile
+        :param int workers:
+            Number of processes parsing blocks of `chunk_size` valid rows
+            (default None: the rows are parsed sequentially)
         """
         HEADER_LIST1 = copy.deepcopy(HEADER_LIST)
         self._header_check(HEADER_LIST1)
-        # Read in csv
-        reader = csv.DictReader(open(self.filename, "r"))
-        metadata = []
-        self.database = GroundMotionDatabase(self.id, self.name)
-        self._get_site_id = self.database._get_site_id
-        counter = 0
-        for row in reader:
-            #print(row["Record Sequence Number"])
-            #if (counter % 100) == 0:
-            #    print("%s - %s" % (str(counter), row["Record Sequence Number"]))
+        # Read in csv, by columns
+        columns = FlatfileColumns(self.filename)
+        # Validation of the ground motion values and of the events, by
+        # columns
+        valid_ims = self._sanitise_columns(columns)
+        valid_events = self._verify_event_columns(columns)
+        wfids = columns.get_column("Record Sequence Number")
+        for wfid in wfids[~valid_ims]:
+            print("Record with sequence number %s is null/invalid"
+                  % str(wfid))
+        for wfid in wfids[valid_ims & ~valid_events]:
+            print("Record Number %s has invalid event!" % wfid)
+        valid = valid_ims & valid_events
+        if workers and workers > 1 and np.sum(valid) > chunk_size:
+            records = self._iter_chunked(columns, np.where(valid)[0],
+                                         workers, chunk_size)
+        else:
+            records = self._iter_rows(columns, valid)
+        for record in records:
+            yield record
 
-            if self._sanitise(row, reader):
-                record = self._parse_record(row)
-                if record:
-                    self.database.records.append(record)
-            else:
-                print("Record with sequence number %s is null/invalid"
-                      % str(row["Record Sequence Number"]))
-            counter += 1
-        return self.database
+    def _sanitise_columns(self, columns):
+        """
+        Returns the mask of the rows with some positive ground motion value
+        (if all of the strong motion values are negative or missing the
+        record is null), as `_sanitise`
+        """
+        imls = columns.get_floats(
+            [fname for fname in columns.headers
+             if fname.startswith("SA(") or fname in SCALAR_LIST])
+        imls[np.isnan(imls) | (imls == 0.0)] = -999.0
+        return np.logical_not(np.all(imls < 0.0, axis=1))
 
+    def _verify_event_columns(self, columns):
+        """
+        Returns the mask of the rows with a usable event, applying the
+        checks of `_verify_event` to whole columns
+        """
+        year = columns.get_floats("Year")
+        month = columns.get_floats("Month")
+        day = columns.get_floats("Day")
+        lon = columns.get_floats("Epicenter Longitude (deg; positive E)")
+        lat = columns.get_floats("Epicenter Latitude (deg; positive N)")
+        depth = columns.get_floats("Hypocenter Depth (km)")
+        mag = columns.get_floats("Magnitude")
+        with np.errstate(invalid="ignore"):
+            return (year > 0) & (month > 0) & (month <= 12) & (day > 0) &\
+                (day <= 31) & (lon != 0.0) & (lon >= -180.0) &\
+                (lon <= 180.0) & (lat != 0.0) & (lat >= -90.0) &\
+                (lat <= 90.0) & (depth > 0.0) & (mag != 0.0) &\
+                (mag >= -10.0)
 
     def _sanitise(self, row, reader):
         """
@@ -187,30 +224,29 @@ class GeneralFlatfileParser(SimpleFlatfileParserV9):
         else:
             return True
                     
-    def _parse_record(self, metadata):
+    def _parse_record(self, metadata, values):
         """
         Parses the record information and returns an instance of the
-        :class: smtk.sm_database.GroundMotionRecord
+        :class: smtk.sm_database.GroundMotionRecord. The event of the row
+        is already verified, by columns (`_verify_event_columns`)
+        :param dict values:
+            Values of the `FLOAT_COLUMNS` of the row
         """
         # Waveform ID
         wfid = metadata["Record Sequence Number"]
         # Event information
-        # Verify datetime
         event = self._parse_event_data(metadata)
-        if not self._verify_event(event, wfid):
-            print("Record Number %s has invalid event!" % wfid)
-            return False
         # Site information
         site = self._parse_site_data(metadata)
         # Distance Information
-        distances = self._parse_distance_data(event, site, metadata)
+        distances = self._parse_distance_data(event, site, metadata, values)
         # Components
         x_comp, y_comp, vertical = self._parse_processing_data(wfid, metadata)
         # Return record metadata
-        lup = get_float(metadata["Lowest Usable Freq - Ave. Component (Hz)"])
+        lup = values["Lowest Usable Freq - Ave. Component (Hz)"]
         if lup:
             lup = 1. / lup
-        sup = get_float(metadata["Maximum Usable Freq - Ave. Component (Hz)"])
+        sup = values["Maximum Usable Freq - Ave. Component (Hz)"]
         if sup:
             sup = 1. / sup
         return GroundMotionRecord(wfid,
@@ -295,7 +331,7 @@ class GeneralFlatfileParser(SimpleFlatfileParserV9):
 #        second = get_int(metadata["Second"])
 #        return year, month, day, hour, minute, second
 
-    def _parse_distance_data(self, event, site, metadata):
+    def _parse_distance_data(self, event, site, metadata, values):
         """
         Read in the distance related metadata and return an instance of the
         :class: smtk.sm_database.RecordDistance
@@ -343,12 +379,10 @@ class GeneralFlatfileParser(SimpleFlatfileParserV9):
                 1.0)
         
         # Rhypo
-        Rhypo, Repi, Rrup, Rjb, Ry0 = tuple(map(
-            get_positive_float, [metadata[key] for key in [
-                "Hypocentral Distance (km)", "Epicentral Distance (km)",
-                "Rupture Distance (km)", "Joyner-Boore Distance (km)",
-                "Ry0 (km)"]]))
-        Rx = get_float(metadata["Rx (km)"]) # Rx can be negative
+        Rhypo, Repi, Rrup, Rjb, Rx, Ry0 = [values[key] for key in [
+            "Hypocentral Distance (km)", "Epicentral Distance (km)",
+            "Rupture Distance (km)", "Joyner-Boore Distance (km)",
+            "Rx (km)", "Ry0 (km)"]]
 
         #Rhypo = get_float(metadata["Hypocentral Distance (km)"])
         if Rhypo is None or Rhypo < 0.0:
@@ -373,7 +407,6 @@ class GeneralFlatfileParser(SimpleFlatfileParserV9):
         if Rx is None or Rx < 0.0:
             Rx = surface_modeled.get_rx_distance(target_site)[0]
         # Ry0
-        Ry0 = get_float(metadata["Ry0 (km)"])
         if Ry0 is None or Ry0 < 0.0:
             Ry0 = surface_modeled.get_ry0_distance(target_site)[0]
         
@@ -384,7 +417,7 @@ class GeneralFlatfileParser(SimpleFlatfileParserV9):
             rrup = Rrup,
             r_x = Rx,
             ry0 = Ry0)
-        distance.azimuth = get_float(metadata["Source to Site Azimuth (deg)"])
+        distance.azimuth = values["Source to Site Azimuth (deg)"]
         #distance.hanging_wall = get_float(metadata["FW/HW Indicator"])
         if metadata["FW/HW Indicator"] == "HW":
             distance.hanging_wall = True
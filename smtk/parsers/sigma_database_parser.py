@@ -28,6 +28,7 @@ from datetime import datetime
 import h5py
 from smtk.sm_database import *
 from smtk.parsers.base_database_parser import (get_float, get_int,
+                                               read_numeric_block,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader,
                                                SMSpectraReader)
@@ -43,12 +44,11 @@ class SigmaDatabaseMetadataReader(SMDatabaseReader):
     YSPEC_STR = "_H2.rs"
     ZSPEC_STR = "_V.rs"
 
-    def parse(self):
+    def iter_records(self):
         """
-
+        Yields the record of each metadata file
         """
         file_list = os.listdir(self.filename)
-        num_files = len(file_list)
         self.database = GroundMotionDatabase(self.id, self.name)
         for file_str in file_list:
             if "DS_Store" in file_str:
@@ -57,14 +57,11 @@ class SigmaDatabaseMetadataReader(SMDatabaseReader):
                                     file_str + "/" + file_str + ".metadata")
             if not os.path.exists(metafile):
                 continue
-            csv_data = csv.DictReader(open(metafile, 'r'),
-                                      delimiter=",",
-                                      quotechar='"')
-            metadata = next(csv_data)
-            self.database.records.append(self.parse_metadata(metadata, 
-                                                             file_str))
-
-        return self.database
+            with open(metafile, 'r') as f:
+                metadata = next(csv.DictReader(f, delimiter=",",
+                                               quotechar='"'))
+            yield self.interner.intern_record(
+                self.parse_metadata(metadata, file_str))
 
     def parse_metadata(self, metadata, file_str):
         """
@@ -299,7 +296,7 @@ class SigmaSpectraParser(SMSpectraReader):
         for iloc, ifile in enumerate(self.input_files):
             if not os.path.exists(ifile):
                 continue
-            data = np.genfromtxt(ifile, skip_header=1)
+            data = read_numeric_block(ifile, skip_header=1)
             per = data[:-1, 0]
             spec_acc = data[:-1, 1:]
             pgv = 100.0 * data[-1, 1]
@@ -37,6 +37,7 @@ import smtk.trellis.configure as rcfg
 from smtk.sm_database import *
 from smtk.sm_utils import convert_accel_units
 from smtk.parsers.base_database_parser import (get_float, get_int,
+                                               read_numeric_block,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader,
                                                SMSpectraReader)
@@ -75,18 +76,16 @@ class SimpleFlatfileParser(SMDatabaseReader):
     Typically this format is an Excel spreadsheet, though for the current
     purposes it is assumed the spreadsheet is formatted as csv
     """
-    def parse(self):
+    def iter_records(self):
         """
-        Parses the database
+        Yields the record of each row of the flatfile
         """
         self._header_check()
-        # Read in csv
-        reader = csv.DictReader(open(self.filename, "r"))
-        metadata = []
         self.database = GroundMotionDatabase(self.id, self.name)
-        for row in reader:
-            self.database.records.append(self._parse_record(row))
-        return self.database
+        # Read in csv
+        with open(self.filename, "r") as f:
+            for row in csv.DictReader(f):
+                yield self.interner.intern_record(self._parse_record(row))
 
     def _header_check(self):
         """
@@ -409,7 +408,7 @@ class SimpleAsciiTimeseriesReader(SMTimeSeriesReader):
         time-series properties
         """
         output = {}
-        accel = np.genfromtxt(ifile, skip_header=1)
+        accel = read_numeric_block(ifile, skip_header=1)
         output["Acceleration"] = convert_accel_units(accel, self.units)
         nvals, time_step = (getline(ifile, 1).rstrip("\n")).split()
         output["Time-step"] = float(time_step)
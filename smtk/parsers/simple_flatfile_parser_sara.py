@@ -40,8 +40,10 @@ import smtk.trellis.configure as rcfg
 from smtk.sm_database import *
 from smtk.sm_utils import convert_accel_units
 from smtk.parsers.base_database_parser import (get_float, get_int,
+                                               read_numeric_block,
                                                get_positive_float,
                                                get_positive_int,
+                                               FlatfileColumns,
                                                SMDatabaseReader,
                                                SMTimeSeriesReader,
                                                SMSpectraReader)
@@ -102,20 +104,88 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
     Typically this format is an Excel spreadsheet, though for the current
     purposes it is assumed the spreadsheet is formatted as csv
     """
-    def parse(self):
+    # Numeric columns converted by columns, for each block of rows
+    FLOAT_COLUMNS = ["Epicentral Distance (km)", "Hypocentral Distance (km)",
+                     "Rupture Distance (km)", "Joyner-Boore Distance (km)",
+                     "Source to Site Azimuth (deg)",
+                     "Lowest Usable Freq - Ave. Component (Hz)",
+                     "Maximum Usable Freq - Ave. Component (Hz)"]
+
+    def iter_records(self, workers=None, chunk_size=1000):
         """
-        Parses the database
+        Yields the record of each valid row of the flatfile
+        :param int workers:
+            Number of processes parsing blocks of `chunk_size` rows (default
+            None: the rows are parsed sequentially)
         """
         HEADER_LIST1 = copy.deepcopy(HEADER_LIST)
         self._header_check(HEADER_LIST1)
         # Read in csv
-        reader = csv.DictReader(open(self.filename, "r"))
-        metadata = []
+        columns = FlatfileColumns(self.filename)
+        if workers and workers > 1 and len(columns) > chunk_size:
+            records = self._iter_chunked(columns, np.arange(len(columns)),
+                                         workers, chunk_size)
+        else:
+            records = self._iter_rows(columns)
+        for record in records:
+            yield record
+
+    def _iter_rows(self, columns, valid=None):
+        """
+        Yields the records of the rows of the flatfile
+        :param columns:
+            Flatfile as instance of :class:
+            smtk.parsers.base_database_parser.FlatfileColumns
+        :param numpy.ndarray valid:
+            Boolean mask of the rows to parse (default all)
+        """
         self.database = GroundMotionDatabase(self.id, self.name)
         self._get_site_id = self.database._get_site_id
-        for row in reader:
-            self.database.records.append(self._parse_record(row))
-        return self.database
+        values = self._get_float_rows(columns)
+        for irow in range(len(columns)):
+            if valid is not None and not valid[irow]:
+                continue
+            record = self._parse_record(columns.get_row(irow), values[irow])
+            if record:
+                yield self.interner.intern_record(record)
+
+    def _iter_chunked(self, columns, rows, workers, chunk_size=1000):
+        """
+        Yields the records of the given rows of the flatfile, parsed in
+        blocks by a pool of processes and merged in the order of the rows,
+        with shared events and sites
+        """
+        self.database = GroundMotionDatabase(self.id, self.name)
+        # The site ids are positions in the database, assigned when merging
+        self._get_site_id = str
+        try:
+            for record in self._iter_parsed_blocks(columns, rows, workers,
+                                                   chunk_size):
+                if record:
+                    record.site.id = self.database._get_site_id(
+                        record.site.code)
+                    yield self.interner.intern_record(record)
+        finally:
+            self._get_site_id = self.database._get_site_id
+
+    def _parse_block(self, block):
+        """
+        Parses a block of the flatfile in a worker process, returning the
+        record of each row (with the station id as site id)
+        """
+        self._get_site_id = str
+        values = self._get_float_rows(block)
+        return [self._parse_record(block.get_row(irow), values[irow])
+                for irow in range(len(block))]
+
+    def _get_float_rows(self, columns):
+        """
+        Returns, for each row, the dictionary of the values of the
+        `FLOAT_COLUMNS` (None if missing or invalid, as `get_float`)
+        """
+        values = columns.get_floats(self.FLOAT_COLUMNS)
+        values = np.where(np.isnan(values), None, values).tolist()
+        return [dict(zip(self.FLOAT_COLUMNS, row)) for row in values]
 
     def _header_check(self, headerslist):
         """
@@ -137,10 +207,12 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
                       header)
         return
 
-    def _parse_record(self, metadata):
+    def _parse_record(self, metadata, values):
         """
         Parses the record information and returns an instance of the
         :class: smtk.sm_database.GroundMotionRecord
+        :param dict values:
+            Values of the `FLOAT_COLUMNS` of the row
         """
         # Waveform ID
         wfid = metadata["Record Sequence Number"]
@@ -149,14 +221,14 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
         # Site information
         site = self._parse_site_data(metadata)
         # Distance Information
-        distances = self._parse_distance_data(event, site, metadata)
+        distances = self._parse_distance_data(event, site, metadata, values)
         # Components
         x_comp, y_comp, vertical = self._parse_processing_data(wfid, metadata)
         # Return record metadata
-        lup = get_float(metadata["Lowest Usable Freq - Ave. Component (Hz)"])
+        lup = values["Lowest Usable Freq - Ave. Component (Hz)"]
         if lup:
             lup = 1. / lup
-        sup = get_float(metadata["Maximum Usable Freq - Ave. Component (Hz)"])
+        sup = values["Maximum Usable Freq - Ave. Component (Hz)"]
         if sup:
             sup = 1. / sup
         return GroundMotionRecord(wfid,
@@ -378,7 +450,7 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
 
                                 
 
-    def _parse_distance_data(self, event, site, metadata):
+    def _parse_distance_data(self, event, site, metadata, values):
         """
         Read in the distance related metadata and return an instance of the
         :class: smtk.sm_database.RecordDistance
@@ -423,19 +495,19 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
                 1.0)
         
         # Rhypo
-        Rhypo = get_float(metadata["Hypocentral Distance (km)"])
+        Rhypo = values["Hypocentral Distance (km)"]
         if Rhypo is None:
             Rhypo = hypocenter.distance_to_mesh(target_site)
         # Repi
-        Repi = get_float(metadata["Epicentral Distance (km)"])
+        Repi = values["Epicentral Distance (km)"]
         if Repi is None:
             Repi= hypocenter.distance_to_mesh(target_site, with_depths=False)
         # Rrup
-        Rrup = get_float(metadata["Rupture Distance (km)"])
+        Rrup = values["Rupture Distance (km)"]
         if Rrup is None:
             Rrup = surface_modeled.get_min_distance(target_site)
         # Rjb
-        Rjb = get_float(metadata["Joyner-Boore Distance (km)"])
+        Rjb = values["Joyner-Boore Distance (km)"]
         if Rjb is None:
             Rjb = surface_modeled.get_joyner_boore_distance(target_site)
         # Need to check if Rx and Ry0 are consistant with the other metrics
@@ -452,7 +524,7 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
             rrup = float(Rrup),
             r_x = float(Rx),
             ry0 = float(Ry0))
-        distance.azimuth = get_float(metadata["Source to Site Azimuth (deg)"])
+        distance.azimuth = values["Source to Site Azimuth (deg)"]
         #distance.hanging_wall = get_float(metadata["FW/HW Indicator"])
         if metadata["FW/HW Indicator"] == "HW":
             distance.hanging_wall = True
@@ -579,24 +651,20 @@ class SimpleFlatfileParserV9(SMDatabaseReader):
 
 
 class NearFaultFlatFileParser(SimpleFlatfileParserV9):
+    FLOAT_COLUMNS = SimpleFlatfileParserV9.FLOAT_COLUMNS + ["Rcdpp"]
 
-    def parse(self):
+    def iter_records(self):
         """
-        Parses the database
+        Yields the record of each valid row of the flatfile
         """
         HEADER_LIST1 = copy.deepcopy(HEADER_LIST)
         HEADER_LIST1.add("Rcdpp")
         self._header_check(HEADER_LIST1)
         # Read in csv
-        reader = csv.DictReader(open(self.filename, "r"))
-        metadata = []
-        self.database = GroundMotionDatabase(self.id, self.name)
-        self._get_site_id = self.database._get_site_id
-        for row in reader:
-            self.database.records.append(self._parse_record(row))
-        return self.database
+        for record in self._iter_rows(FlatfileColumns(self.filename)):
+            yield record
 
-    def _parse_distance_data(self, event, site, metadata):
+    def _parse_distance_data(self, event, site, metadata, values):
         """
         Read in the distance related metadata and return an instance of the
         :class: smtk.sm_database.RecordDistance
@@ -641,23 +709,23 @@ class NearFaultFlatFileParser(SimpleFlatfileParserV9):
                 1.0)
             
         # Rhypo
-        Rhypo = get_float(metadata["Hypocentral Distance (km)"])
+        Rhypo = values["Hypocentral Distance (km)"]
         if Rhypo is None:
             Rhypo = hypocenter.distance_to_mesh(target_site)
         # Repi
-        Repi = get_float(metadata["Epicentral Distance (km)"])
+        Repi = values["Epicentral Distance (km)"]
         if Repi is None:
             Repi= hypocenter.distance_to_mesh(target_site, with_depths=False)
         # Rrup
-        Rrup = get_float(metadata["Rupture Distance (km)"])
+        Rrup = values["Rupture Distance (km)"]
         if Rrup is None:
             Rrup = surface_modeled.get_min_distance(target_site)
         # Rjb
-        Rjb = get_float(metadata["Joyner-Boore Distance (km)"])
+        Rjb = values["Joyner-Boore Distance (km)"]
         if Rjb is None:
             Rjb = surface_modeled.get_joyner_boore_distance(target_site)
         # Rcdpp
-        Rcdpp = get_float(metadata["Rcdpp"])
+        Rcdpp = values["Rcdpp"]
         if Rcdpp is None:
             Rcdpp = surface_modeled.get_cdppvalue(target_site)
         # Need to check if Rx and Ry0 are consistant with the other metrics
@@ -675,7 +743,7 @@ class NearFaultFlatFileParser(SimpleFlatfileParserV9):
             r_x = float(Rx),
             ry0 = float(Ry0),
             rcdpp = float(Rcdpp) )
-        distance.azimuth = get_float(metadata["Source to Site Azimuth (deg)"])
+        distance.azimuth = values["Source to Site Azimuth (deg)"]
         #distance.hanging_wall = get_float(metadata["FW/HW Indicator"])
         if metadata["FW/HW Indicator"] == "HW":
             distance.hanging_wall = True
@@ -726,7 +794,7 @@ class SimpleAsciiTimeseriesReader(SMTimeSeriesReader):
         time-series properties
         """
         output = {}
-        accel = np.genfromtxt(ifile, skip_header=1)
+        accel = read_numeric_block(ifile, skip_header=1)
         output["Acceleration"] = convert_accel_units(accel, self.units)
         nvals, time_step = (getline(ifile, 1).rstrip("\n")).split()
         output["Time-step"] = float(time_step)
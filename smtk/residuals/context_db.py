@@ -7,6 +7,8 @@ from collections import OrderedDict  # compatibility with dicts in Python <3.7
 import numpy as np
 from openquake.hazardlib.contexts import DistancesContext, RuptureContext
 
+from smtk.trellis.configure import vs30_to_z1pt0_cy14, vs30_to_z2pt5_cb14
+
 
 class ContextDB:
     """This abstract-like class represents a Database (DB) of data capable of
@@ -20,6 +22,9 @@ class ContextDB:
      - get_observations(self, imtx, records, component="Geometric")
        (which is called only if `imts` is given in :meth:`self.get_contexts`)
 
+    Subclasses able to read the observations of several IMTs at once should
+    also overwrite `get_observation_matrix`.
+
     Please refer to the functions docstring for further details
     """
 
@@ -46,14 +51,82 @@ class ContextDB:
             self.update_context(ctx, records, nodal_plane_index)
             if compute_observations:
                 observations = dic['Observations']
-                for imtx, values in observations.items():
-                    values = self.get_observations(imtx, records, component)
-                    observations[imtx] = np.asarray(values, dtype=float)
+                values = self.get_observation_matrix(list(observations),
+                                                     records, component)
+                for i, imtx in enumerate(observations):
+                    observations[imtx] = values[:, i]
                 dic["Num. Sites"] = len(records)
             # Legacy code??  FIXME: kind of redundant with "Num. Sites" above
             dic['Ctx'].sids = np.arange(len(records), dtype=np.uint32)
             yield dic
 
+    def get_stacked_context(self, nodal_plane_index=1, imts=None,
+                            component="Geometric"):
+        """Return a single Context `dict` holding the records of all events,
+        so that a GSIM can be evaluated for the whole database at once.
+        Rupture attributes are repeated for each record of the event, site and
+        distance attributes are concatenated. Attributes not defined for all
+        the records (e.g. optional attributes missing in some events) are
+        not included. Arguments as in :meth:`get_contexts`
+
+        :return: the dict with keys:
+            ```
+            {
+            'EventID': list of the earthquake ids,
+            'Event Index': numpy array of the position in 'EventID' of the
+                           event of each record,
+            'Ctx': a :class:`openquake.hazardlib.contexts.RuptureContext`
+            'IMTs': list of imts,
+            'Observations': numpy array of shape (number records, number imts)
+            'Num. Sites': number of records
+            }
+            ```
+            NOTE: 'IMTs', 'Observations' and 'Num. Sites' are missing if
+            `imts` is missing, None or an emtpy sequence.
+        """
+        evt_ids, ctxs, observations = [], [], []
+        for dic in self.get_contexts(nodal_plane_index, imts, component):
+            evt_ids.append(dic['EventID'])
+            ctxs.append(dic['Ctx'])
+            if 'Observations' in dic:
+                observations.append(np.column_stack(
+                    list(dic['Observations'].values())))
+        sizes = [len(ctx.sids) for ctx in ctxs]
+        nrecs = sum(sizes)
+        stacked = RuptureContext()
+        attnames = set(vars(ctxs[0])) if ctxs else set()
+        for ctx in ctxs[1:]:
+            attnames &= set(vars(ctx))
+        attnames.discard('sids')
+        for attname in sorted(attnames):
+            values = []
+            for ctx, size in zip(ctxs, sizes):
+                value = np.asarray(getattr(ctx, attname))
+                if value.ndim and len(value) == size and \
+                        attname not in self.rupture_context_attrs:
+                    # Record attribute
+                    values.append(value)
+                elif attname in self.rupture_context_attrs or not value.ndim:
+                    # Event attribute
+                    values.append(np.repeat(value[np.newaxis], size, axis=0))
+                else:
+                    # Not defined for all records
+                    break
+            else:
+                setattr(stacked, attname, np.concatenate(values))
+        stacked.sids = np.arange(nrecs, dtype=np.uint32)
+        dic = {
+            'EventID': evt_ids,
+            'Event Index': np.repeat(np.arange(len(evt_ids)), sizes),
+            'Ctx': stacked
+        }
+        if imts is not None and len(imts):
+            dic['IMTs'] = list(OrderedDict.fromkeys(imts))
+            dic['Observations'] = np.concatenate(observations) \
+                if observations else np.zeros([0, len(dic['IMTs'])])
+            dic['Num. Sites'] = nrecs
+        return dic
+
     def create_context(self, evt_id, imts=None):
         """Create a new Context `dict`. Objects of this type will be yielded
         by `get_context`.
@@ -130,3 +203,90 @@ class ContextDB:
         """
         # NOTE: imtx, not imt, otherwise it shadows the package imt!!
         raise NotImplementedError('')
+
+    def get_observation_matrix(self, imts, records, component="Geometric"):
+        """Return the observed values of all the given IMTs from `records`, as
+        numpy array of shape (len(records), len(imts)). By default this
+        calls :meth:`get_observations` for each IMT: subclasses can overwrite
+        it to extract all IMTs in a single pass over the records.
+
+        :param imts: a list of strings denoting the Intensity measure types
+        :param records: sequence (e.g., list, tuple, pandas DataFrame) of records
+            related to a given event (see :meth:`get_event_and_records`)
+        """
+        values = np.zeros([len(records), len(imts)])
+        for i, imtx in enumerate(imts):
+            values[:, i] = np.asarray(
+                self.get_observations(imtx, records, component), dtype=float)
+        return values
+
+
+def get_context_arrays(column):
+    """
+    Returns the site and distance attributes of the context for all the
+    records of a database, as dictionary mapping the attribute name to the
+    tuple (values, records with value). The latter is None unless the
+    attribute is optional, i.e. only records with a value contribute to it
+
+    :param column: a callable accepting the path of a record attribute
+        (e.g. `column("site", "vs30")`) and returning the tuple (values,
+        present) of its float values (nan where missing) and the boolean
+        array of the records with a value
+    """
+    arrays = {}
+    # Sites
+    vs30 = column("site", "vs30")[0]
+    arrays["vs30"] = (vs30, None)
+    arrays["lons"] = (column("site", "longitude")[0], None)
+    arrays["lats"] = (column("site", "latitude")[0], None)
+    altitude, present = column("site", "altitude")
+    arrays["depths"] = (
+        np.where(present & (altitude != 0), altitude * -1.0E-3, 0.0), None)
+    vs30_measured, present = column("site", "vs30_measured")
+    arrays["vs30measured"] = (
+        np.where(present, vs30_measured, 0).astype(bool), None)
+    for attname, vs30_to_z in [("z1pt0", vs30_to_z1pt0_cy14),
+                               ("z2pt5", vs30_to_z2pt5_cb14)]:
+        values, present = column("site", attname)
+        missing = np.logical_not(present)
+        if np.any(missing):
+            # Depths from vs30, in one step for all the records
+            values = np.array(values, dtype=float)
+            values[missing] = vs30_to_z(vs30[missing])
+        arrays[attname] = (values, None)
+    backarc, present = column("site", "backarc")
+    arrays["backarc"] = (backarc.astype(bool), present)
+    # Distances
+    repi = column("distance", "repi")[0]
+    rhypo = column("distance", "rhypo")[0]
+    arrays["repi"] = (repi, None)
+    arrays["rhypo"] = (rhypo, None)
+    # TODO Setting Rjb == Repi and Rrup == Rhypo when missing value
+    # is a hack! Need feedback on how to fix
+    for attname, path, default in [("rjb", "rjb", repi),
+                                   ("rrup", "rrup", rhypo),
+                                   ("rx", "r_x", repi)]:
+        values, present = column("distance", path)
+        arrays[attname] = (np.where(present, values, default), None)
+    for attname in ["ry0", "rcdpp", "azimuth", "hanging_wall", "rvolc"]:
+        arrays[attname] = column("distance", attname)
+    return arrays
+
+
+def set_context_arrays(ctx, arrays, indices, attnames):
+    """
+    Sets the given site or distance attributes of the context `ctx` by
+    slicing the arrays returned by :func:`get_context_arrays` with the
+    positions `indices` of the records of the event
+    """
+    for attname in attnames:
+        if attname not in arrays:
+            continue
+        values, present = arrays[attname]
+        values = values[indices]
+        if present is not None:
+            # Optional attribute: only the records with a value are kept
+            values = values[present[indices]]
+        # remove attribute if its value is empty-like
+        if len(values):
+            setattr(ctx, attname, values)
@@ -0,0 +1,499 @@
+"""
+Module defining a Context Database (ContextDB) reading the records metadata
+and intensity measures directly from a flatfile, without building the
+strong motion database (one HDF5 file per record)
+"""
+import re
+import csv
+from collections import OrderedDict
+
+import numpy as np
+from openquake.hazardlib import imt
+
+from smtk.sm_database import RecordIndex
+from smtk.sm_oq_utils import MECHANISM_TYPE, DIP_TYPE, DEFAULT_MSR
+from smtk.sm_utils import convert_accel_units, get_interpolated_periods
+from smtk.residuals.context_db import ContextDB, get_context_arrays, \
+    set_context_arrays
+
+
+# Magnitude precedence in the ESM flatfile (see ESMFlatfileParser)
+ESM_M_PRECEDENCE = ["EMEC_Mw", "Mw", "Ms", "ML"]
+
+# Components of the ESM flatfile (as-recorded and rotation invariant)
+ESM_COMPONENTS = ["U", "V", "W", "rotD00", "rotD50", "rotD100"]
+
+# Columns of the NGA-West2 and of the template flatfiles, mapped to the
+# names used by the FlatfileContextDB (event and rupture attributes) and by
+# the GroundMotionRecord site and distance attributes
+NGAWEST2_COLUMNS = {
+    "record_id": "Record Sequence Number",
+    "event_id": "EQID",
+    "hypo_lat": "Epicenter Latitude (deg, positive N)",
+    "hypo_lon": "Epicenter Longitude (deg, positive E)",
+    "hypo_depth": "Hypocenter Depth (km)",
+    "mag": "Magnitude",
+    "strike_1": "Nodal Plane 1 Strike (deg)",
+    "dip_1": "Nodal Plane 1 Dip (deg)",
+    "rake_1": "Nodal Plane 1 Rake Angle (deg)",
+    "strike_2": "Nodal Plane 2 Strike (deg)",
+    "dip_2": "Nodal Plane 2 Dip (deg)",
+    "rake_2": "Nodal Plane 2 Rake Angle (deg)",
+    "sof": "Style-of-Faulting (S, R, N, U)",
+    "ztor": "Depth to Top Of Fault Rupture Model",
+    "width": "Fault Rupture Width (km)",
+    "latitude": "Station Latitude (deg positive N)",
+    "longitude": "Station Longitude (deg positive E)",
+    "altitude": "Station Elevation (m)",
+    "vs30": "Preferred Vs30 (m/s)",
+    "vs30_measured": "Measured(1)/Inferred(2) Class",
+    "z1pt0": "Z1 (m)",
+    "z2pt5": "Z2.5 (m)",
+    "repi": "Epicentral Distance (km)",
+    "rhypo": "Hypocentral Distance (km)",
+    "rjb": "Joyner-Boore Distance (km)",
+    "rrup": "Rupture Distance (km)",
+    "r_x": "Rx (km)",
+    "ry0": "Ry0 (km)",
+    "azimuth": "Source to Site Azimuth (deg)",
+    "hanging_wall": "FW/HW Indicator",
+    "backarc": "Forearc/Backarc for subduction events"
+}
+
+TEMPLATE_COLUMNS = {
+    "record_id": "record_id",
+    "event_id": "event_id",
+    "hypo_lat": "event_latitude",
+    "hypo_lon": "event_longitude",
+    "hypo_depth": "hypocenter_depth",
+    "mag": "magnitude",
+    "strike_1": "strike_1",
+    "dip_1": "dip_1",
+    "rake_1": "rake_1",
+    "strike_2": "strike_2",
+    "dip_2": "dip_2",
+    "rake_2": "rake_2",
+    "sof": "style_of_faulting",
+    "ztor": "depth_top_of_rupture",
+    "width": "rupture_width",
+    "latitude": "station_latitude",
+    "longitude": "station_longitude",
+    "altitude": "station_elevation",
+    "vs30": "vs30",
+    "vs30_measured": "vs30_measured",
+    "z1pt0": "z1.0",
+    "z2pt5": "z2.5",
+    "repi": "epicentral_distance",
+    "rhypo": "hypocentral_distance",
+    "rjb": "joyner_boore_distance",
+    "rrup": "rupture_distance",
+    "r_x": "rx",
+    "ry0": "ry0",
+    "azimuth": "azimuth"
+}
+
+# Missing value in the NGA-West2 and template flatfiles
+MISSING_VALUE = -999.
+
+
+def _to_float(values, missing=None):
+    """
+    Converts the given strings to a float array. Empty or invalid strings
+    (and the optional `missing` value) are converted to nan
+    """
+    output = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        try:
+            output[i] = float(value)
+        except ValueError:
+            pass
+    if missing is not None:
+        output[output == missing] = np.nan
+    return output
+
+
+def _read_columns(filename, delimiter=",", headers=None):
+    """
+    Reads a delimited file into an OrderedDict mapping each header to the
+    list of its (string) values. If `headers` is given, the first line of the
+    file is skipped and the given headers are used instead
+    """
+    with open(filename, "r", newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        first_row = next(reader)
+        if headers is None:
+            headers = [header.strip() for header in first_row]
+        rows = [row for row in reader if any(row)]
+    columns = OrderedDict()
+    for i, header in enumerate(headers):
+        if header and header not in columns:
+            columns[header] = [row[i].strip() if i < len(row) else ""
+                               for row in rows]
+    return columns
+
+
+def _get_spectra(columns, pattern, period=float):
+    """
+    Returns the periods (sorted in ascending order) and the matrix (number of
+    records, number of periods) of the spectral ordinates in the columns
+    whose header matches the regular expression `pattern`. The period is
+    given by `period(*match.groups())`
+    """
+    periods, headers = [], []
+    for header in columns:
+        match = re.match(pattern, header)
+        if match:
+            periods.append(period(*match.groups()))
+            headers.append(header)
+    order = np.argsort(periods)
+    periods = np.array(periods, dtype=float)[order]
+    values = np.column_stack([_to_float(columns[headers[i]]) for i in order])\
+        if len(headers) else np.zeros([len(next(iter(columns.values()))), 0])
+    return periods, values
+
+
+def read_esm2018_flatfile(filename):
+    """
+    Reads an ESM 2018 flatfile
+
+    :returns: the tuple (columns, observations) (see :class:
+        FlatfileContextDB)
+    """
+    raw = _read_columns(filename, ";")
+    nrecs = len(raw["event_id"])
+
+    def column(key):
+        if key in raw:
+            return _to_float(raw[key])
+        return np.full(nrecs, np.nan)
+
+    columns = {}
+    columns["event_id"] = raw["event_id"]
+    columns["record_id"] = [
+        "_".join(ids).replace("-", "_") for ids in
+        zip(raw["event_id"], raw["network_code"], raw["station_code"],
+            raw["location_code"])]
+    # Event
+    mag = np.full(nrecs, np.nan)
+    for key in ESM_M_PRECEDENCE[::-1]:
+        values = column(key)
+        mag = np.where(np.isfinite(values), values, mag)
+    columns["mag"] = mag
+    columns["hypo_lat"] = column("ev_latitude")
+    columns["hypo_lon"] = column("ev_longitude")
+    depth = column("ev_depth_km")
+    columns["hypo_depth"] = np.where(depth > 0, depth, 0.0)
+    columns["sof"] = raw["fm_type_code"]
+    # Rupture: the finite source model (es_*), if given, is the first plane
+    has_source = np.array([bool(value) for value in
+                           raw.get("event_source_id", [""] * nrecs)])
+    for key, es_key in [("strike", "es_strike"), ("dip", "es_dip"),
+                        ("rake", "es_rake")]:
+        columns[key + "_1"] = np.where(has_source, column(es_key),
+                                       column(key + "_1"))
+        columns[key + "_2"] = np.where(has_source, np.nan,
+                                       column(key + "_2"))
+    columns["ztor"] = np.where(has_source, column("es_z_top"), np.nan)
+    columns["width"] = np.where(has_source, column("es_width"), np.nan)
+    # Site
+    columns["latitude"] = column("st_latitude")
+    columns["longitude"] = column("st_longitude")
+    columns["altitude"] = column("st_elevation")
+    vs30 = column("vs30_m_sec")
+    measured = np.isfinite(vs30) & (vs30 != 0)
+    columns["vs30"] = np.where(measured, vs30, column("vs30_m_sec_WA"))
+    columns["vs30_measured"] = measured.astype(float)
+    # Distances (missing values as in ESMFlatfileParser)
+    repi = column("epi_dist")
+    rhypo = np.sqrt(repi ** 2. + columns["hypo_depth"] ** 2.)
+    columns["repi"] = repi
+    columns["rhypo"] = rhypo
+    for key, esm_key, default in [("rjb", "JB_dist", repi),
+                                  ("rrup", "rup_dist", rhypo),
+                                  ("r_x", "Rx_dist", -repi),
+                                  ("ry0", "Ry0_dist", repi)]:
+        values = column(esm_key)
+        columns[key] = np.where(np.isfinite(values), values, default)
+    columns["azimuth"] = column("epi_az")
+    columns["backarc"] = np.zeros(nrecs)
+    # Intensity measures (in cm/s/s)
+    observations = OrderedDict()
+    for comp in ESM_COMPONENTS:
+        periods, spectra = _get_spectra(
+            raw, r"^%s_T(\d+)_(\d+)$" % comp,
+            lambda units, decimals: float(units + "." + decimals))
+        observations[comp] = {
+            "PGA": np.fabs(column("%s_pga" % comp)),
+            "PGV": np.fabs(column("%s_pgv" % comp)),
+            "SA": (periods, np.fabs(spectra))
+        }
+    observations["Geometric"] = {
+        "PGA": np.sqrt(observations["U"]["PGA"] * observations["V"]["PGA"]),
+        "PGV": np.sqrt(observations["U"]["PGV"] * observations["V"]["PGV"]),
+        "SA": (observations["U"]["SA"][0],
+               np.sqrt(observations["U"]["SA"][1] *
+                       observations["V"]["SA"][1]))
+    }
+    return columns, observations
+
+
+def _read_single_component_flatfile(raw, keys, component):
+    """
+    Reads the columns of the NGA-West2 or template flatfile (read as `raw`),
+    mapped to the FlatfileContextDB names with `keys`.
+    The horizontal intensity measures are given as `component`
+    """
+    nrecs = len(raw[keys["event_id"]])
+
+    def column(key):
+        if key in keys and keys[key] in raw:
+            return _to_float(raw[keys[key]], MISSING_VALUE)
+        return np.full(nrecs, np.nan)
+
+    columns = {}
+    for key in ["event_id", "record_id", "sof"]:
+        columns[key] = raw[keys[key]]
+    for key in ["mag", "hypo_lat", "hypo_lon", "hypo_depth", "strike_1",
+                "dip_1", "rake_1", "strike_2", "dip_2", "rake_2", "ztor",
+                "width", "latitude", "longitude", "altitude", "vs30",
+                "z1pt0", "z2pt5", "repi", "rhypo", "rjb", "rrup", "r_x",
+                "ry0", "azimuth"]:
+        columns[key] = column(key)
+    columns["hypo_depth"] = np.where(columns["hypo_depth"] > 0,
+                                     columns["hypo_depth"], 0.0)
+    columns["vs30_measured"] = (column("vs30_measured") == 1).astype(float)
+    # Hanging wall flag missing if not given, sites not in backarc by
+    # default (as in RecordSite)
+    for key, flags, default in [("hanging_wall", {"HW": 1.0, "FW": 0.0},
+                                 np.nan),
+                                ("backarc", {"BACKARC": 1.0}, 0.0)]:
+        values = raw.get(keys.get(key), [""] * nrecs)
+        columns[key] = np.array([flags.get(value.upper(), default)
+                                 for value in values])
+    rhypo = np.sqrt(columns["repi"] ** 2. + columns["hypo_depth"] ** 2.)
+    columns["rhypo"] = np.where(np.isfinite(columns["rhypo"]),
+                                columns["rhypo"], rhypo)
+    # Intensity measures: accelerations in g, converted to cm/s/s
+    periods, spectra = _get_spectra(raw, r"^SA\(([0-9.]+)\)$")
+    spectra[spectra == MISSING_VALUE] = np.nan
+    observations = OrderedDict([(component, {
+        "PGA": convert_accel_units(
+            _to_float(raw.get("PGA (g)", [""] * nrecs), MISSING_VALUE), "g"),
+        "PGV": _to_float(raw.get("PGV (cm/s)", [""] * nrecs), MISSING_VALUE),
+        "SA": (periods, convert_accel_units(spectra, "g"))
+    })])
+    return columns, observations
+
+
+def read_ngawest2_flatfile(filename, component="RotD50"):
+    """
+    Reads an NGA-West2 flatfile. The horizontal intensity measures of the
+    flatfile (RotD50) are given as `component`
+
+    :returns: the tuple (columns, observations) (see :class:
+        FlatfileContextDB)
+    """
+    with open(filename, "r", newline="") as f:
+        header = f.readline().rstrip("\r\n")
+    # The headers contain commas between brackets ("(deg, positive N)") and
+    # in "Earthquake in Extensional Regime: 1=Yes, 0=No"
+    headers = [header.strip() for header in
+               re.split(r",(?![^(]*\))(?! 0=No)", header)]
+    raw = _read_columns(filename, ",", headers)
+    return _read_single_component_flatfile(raw, NGAWEST2_COLUMNS, component)
+
+
+def read_template_flatfile(filename, component="RotD50"):
+    """
+    Reads a flatfile in the smtk template format (see
+    tests/file_samples/template_basic_flatfile.csv). The horizontal
+    intensity measures of the flatfile are given as `component`
+
+    :returns: the tuple (columns, observations) (see :class:
+        FlatfileContextDB)
+    """
+    raw = _read_columns(filename, ",")
+    return _read_single_component_flatfile(raw, TEMPLATE_COLUMNS, component)
+
+
+FLATFILE_READERS = OrderedDict([
+    ("esm2018", read_esm2018_flatfile),
+    ("ngawest2", read_ngawest2_flatfile),
+    ("template", read_template_flatfile)
+])
+
+
+def get_flatfile_format(filename):
+    """
+    Returns the format of the flatfile (a key of `FLATFILE_READERS`) from
+    its first line
+    """
+    with open(filename, "r") as f:
+        header = f.readline()
+    if "ev_nation_code" in header and ";" in header:
+        return "esm2018"
+    if header.startswith("Record Sequence Number"):
+        return "ngawest2"
+    if header.startswith("record_id,"):
+        return "template"
+    raise ValueError("Flatfile format of %s not recognised" % filename)
+
+
+class FlatfileContextDB(ContextDB):
+    """
+    ContextDB reading the records metadata and intensity measures from a
+    flatfile into arrays, one element per record. Events are groups of
+    record positions, so that contexts and observations are obtained by
+    slicing the arrays
+
+    :param columns:
+        dict of the record attributes: "event_id", "record_id" and "sof"
+        (lists of strings) and numeric arrays of the rupture ("mag",
+        "hypo_lat", "hypo_lon", "hypo_depth", "strike_1", "dip_1", "rake_1",
+        "strike_2", "dip_2", "rake_2", "ztor", "width"), site and distance
+        attributes (named as in GroundMotionRecord), nan where missing
+    :param observations:
+        dict mapping each horizontal component to the dict of the "PGA" and
+        "PGV" arrays and of the "SA" tuple (periods, values), in cm/s/s
+    """
+    def __init__(self, filename, flatfile_format=None, component=None):
+        """
+        :param str filename: path to the flatfile
+        :param str flatfile_format: one of "esm2018", "ngawest2", "template"
+            (default: inferred from the header of the file)
+        :param str component: the name of the horizontal component for the
+            flatfiles with a single horizontal component (NGA-West2 and
+            template). If None (default) the component is "RotD50" and its
+            values are returned for any requested component
+        """
+        if flatfile_format is None:
+            flatfile_format = get_flatfile_format(filename)
+        if flatfile_format not in FLATFILE_READERS:
+            raise ValueError("Flatfile format %s not supported (one of %s)"
+                             % (flatfile_format,
+                                ", ".join(FLATFILE_READERS)))
+        self.filename = filename
+        self.flatfile_format = flatfile_format
+        # Single horizontal component returned for any requested component
+        self.any_component = False
+        if flatfile_format == "esm2018":
+            self.columns, self.observations = read_esm2018_flatfile(filename)
+        else:
+            self.any_component = component is None
+            self.columns, self.observations = \
+                FLATFILE_READERS[flatfile_format](filename,
+                                                  component or "RotD50")
+        self.event_index = RecordIndex(self.columns["event_id"])
+        self._context_arrays = None
+        self._observations = {}
+
+    def __len__(self):
+        return len(self.columns["record_id"])
+
+    def __repr__(self):
+        return "FlatfileContextDB(%s) with %s records, %s events" % (
+            self.filename, len(self), len(self.event_index))
+
+    def get_event_and_records(self):
+        """Yields the event id and the array of the positions of its
+        records"""
+        for evt_id, indices in self.event_index.groups():
+            yield evt_id, indices
+
+    def update_context(self, ctx, records, nodal_plane_index=1):
+        """Updates the given RuptureContext with data from `records` (array
+        of record positions). See superclass docstring for details
+        """
+        self._update_rupture_context(ctx, records, nodal_plane_index)
+        if self._context_arrays is None:
+            self._context_arrays = get_context_arrays(self._get_raw_column)
+        set_context_arrays(ctx, self._context_arrays, records,
+                           self.sites_context_attrs +
+                           self.distances_context_attrs)
+
+    def _update_rupture_context(self, ctx, records, nodal_plane_index=1):
+        """Called by self.update_context"""
+        i = records[0]
+        columns = self.columns
+        ctx.mag = columns["mag"][i]
+        sof = columns["sof"][i]
+        plane = nodal_plane_index if nodal_plane_index in (1, 2) else None
+        if plane == 2 and np.isnan(columns["strike_2"][i]):
+            plane = 1
+        if plane is not None:
+            ctx.strike, ctx.dip, ctx.rake = [
+                columns["%s_%d" % (key, plane)][i]
+                for key in ["strike", "dip", "rake"]]
+        else:
+            ctx.strike, ctx.dip, ctx.rake = np.nan, 90.0, np.nan
+        # Missing values from the style of faulting
+        if np.isnan(ctx.strike):
+            ctx.strike = 0.0
+        if np.isnan(ctx.dip):
+            ctx.dip = DIP_TYPE.get(sof, 90.0)
+        if np.isnan(ctx.rake):
+            ctx.rake = MECHANISM_TYPE.get(sof, 0.0)
+        ctx.hypo_depth = columns["hypo_depth"][i]
+        ctx.hypo_lat = columns["hypo_lat"][i]
+        ctx.hypo_lon = columns["hypo_lon"][i]
+        ctx.ztor = columns["ztor"][i]
+        if np.isnan(ctx.ztor):
+            ctx.ztor = ctx.hypo_depth
+        ctx.width = columns["width"][i]
+        if np.isnan(ctx.width):
+            # Use the PeerMSR to define the area and assuming an aspect ratio
+            # of 1 get the width
+            ctx.width = np.sqrt(DEFAULT_MSR.get_median_area(ctx.mag, 0))
+        # Default hypocentre location to the middle of the rupture
+        ctx.hypo_loc = (0.5, 0.5)
+
+    def _get_raw_column(self, *path):
+        """Returns the values of a site or distance attribute of all the
+        records (nan where missing) and the boolean array of the records with
+        a value"""
+        values = self.columns.get(path[-1])
+        if values is None:
+            return np.full(len(self), np.nan), np.zeros(len(self), dtype=bool)
+        return values, np.isfinite(values)
+
+    def get_observations(self, imtx, records, component="Geometric"):
+        """Returns the observed values of the given IMT for the `records`
+        (array of record positions). See superclass docstring for details
+        """
+        return self.get_observation_column(imtx, component)[records]
+
+    def get_observation_matrix(self, imts, records, component="Geometric"):
+        """Returns the observed values of all the given IMTs for the
+        `records` (array of record positions), as numpy array of shape
+        (len(records), len(imts))
+        """
+        return np.column_stack([
+            self.get_observation_column(imtx, component)[records]
+            for imtx in imts]) if len(imts) else np.zeros([len(records), 0])
+
+    def get_observation_column(self, imtx, component="Geometric"):
+        """Returns the observed values of the given IMT for all the records
+        of the flatfile (nan where missing). SA are interpolated in log-log
+        space from the flatfile periods, for all the records at once
+        """
+        key = (imtx, component)
+        if key not in self._observations:
+            if self.any_component:
+                observations = list(self.observations.values())[0]
+            elif component in self.observations:
+                observations = self.observations[component]
+            else:
+                raise ValueError("Component %s not in flatfile (one of %s)"
+                                 % (component,
+                                    ", ".join(self.observations)))
+            if "SA(" in imtx:
+                periods, spectra = observations["SA"]
+                target = imt.from_string(imtx).period
+                values = get_interpolated_periods(
+                    [target], periods, spectra.T)[0]
+            elif imtx in observations:
+                values = observations[imtx]
+            else:
+                raise ValueError("IMT %s not in flatfile" % imtx)
+            self._observations[key] = np.asarray(values, dtype=float)
+        return self._observations[key]
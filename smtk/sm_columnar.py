@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2014-2018 GEM Foundation and G. Weatherill
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+"""
+Columnar binary storage of the metadata of a strong motion database.
+
+The nested dictionary of each record (as returned by
+:meth:`smtk.sm_database.GroundMotionRecord.to_dict`) is flattened into one
+typed column per attribute path (e.g. ("event", "magnitude", "value")). Numeric
+and boolean attributes are stored as plain arrays, strings as integer codes
+into a string table, and anything else (lists, mixed types) as json text in a
+string table. All columns are written as contiguous datasets of a single HDF5
+file, which is memory mapped when read so that loading a database costs only
+the reading of the file header.
+"""
+import json
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+
+METADATA_FILE = "metadatafile.hdf5"
+
+# Kinds of column
+FLOAT = "float"
+INT = "int"
+BOOL = "bool"
+STRING = "str"
+JSON = "json"
+DICT = "dict"
+EMPTY = "empty"
+
+# Per-row state of a column
+ABSENT = 0  # Attribute not present in the record
+NONE = 1  # Attribute is None
+VALUE = 2  # Attribute has a value
+INT_VALUE = 3  # Attribute is an integer stored in a float column
+
+
+def _is_flat_dict(value):
+    """
+    Returns True if the value is a dictionary that can be flattened into
+    columns (i.e. all keys are strings)
+    """
+    return isinstance(value, dict) and all(isinstance(key, str)
+                                           for key in value)
+
+
+def _normalise(value):
+    """
+    Converts numpy scalars to their Python equivalent
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _flatten(value, path, irow, columns):
+    """
+    Recursively assigns the value of the attribute at `path` for row `irow`
+    to the columns
+    """
+    if path not in columns:
+        columns[path] = {}
+    if _is_flat_dict(value):
+        columns[path][irow] = value
+        for key in value:
+            _flatten(value[key], path + (key,), irow, columns)
+    else:
+        columns[path][irow] = _normalise(value)
+
+
+def _column_kind(values):
+    """
+    Returns the kind of column needed to store the set of values
+    """
+    types = set()
+    for value in values:
+        if value is None:
+            continue
+        if _is_flat_dict(value):
+            types.add(DICT)
+        elif isinstance(value, bool):
+            types.add(BOOL)
+        elif isinstance(value, int):
+            types.add(INT)
+        elif isinstance(value, float):
+            types.add(FLOAT)
+        elif isinstance(value, str):
+            types.add(STRING)
+        else:
+            types.add(JSON)
+    if not types:
+        return EMPTY
+    if len(types) == 1:
+        return types.pop()
+    if types == {INT, FLOAT}:
+        return FLOAT
+    return JSON
+
+
+def _json_default(value):
+    """
+    Serialises objects not natively supported by json
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _encode_strings(strings):
+    """
+    Encodes a list of strings as a single utf-8 byte buffer with offsets
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+# Dataset holding the columns of each kind. Strings and json text share the
+# same integer codes into a single string table
+_DATASETS = {FLOAT: ("float", np.float64), INT: ("int", np.int64),
+             BOOL: ("bool", bool), STRING: ("codes", np.int32),
+             JSON: ("codes", np.int32)}
+
+
+def write_columnar_metadata(filename, records, attributes=None):
+    """
+    Writes the metadata of a set of records to a columnar HDF5 file
+    :param str filename:
+        Path to the output file
+    :param records:
+        Iterable of records (any object with a `to_dict` method)
+    :param dict attributes:
+        Database level attributes (id, name etc.) to store with the columns,
+        must be json serialisable
+    """
+    columns = OrderedDict()
+    nrecords = 0
+    for irow, record in enumerate(records):
+        _flatten(record.to_dict(), (), irow, columns)
+        nrecords += 1
+    # The root of the tree is the record itself
+    columns.pop((), None)
+    flags = np.zeros([len(columns), nrecords], dtype=np.uint8)
+    data = dict((name, []) for name, _ in _DATASETS.values())
+    table = OrderedDict()
+    kinds = []
+    locations = []
+    for icol, rows in enumerate(columns.values()):
+        kind = _column_kind(rows.values())
+        kinds.append(kind)
+        if kind not in _DATASETS:
+            # Dictionaries and empty columns only need the flags
+            for irow, value in rows.items():
+                flags[icol, irow] = NONE if value is None else VALUE
+            locations.append(-1)
+            continue
+        name, dtype = _DATASETS[kind]
+        values = np.zeros(nrecords, dtype=dtype)
+        for irow, value in rows.items():
+            if value is None:
+                flags[icol, irow] = NONE
+                continue
+            if kind == FLOAT and isinstance(value, int):
+                flags[icol, irow] = INT_VALUE
+            else:
+                flags[icol, irow] = VALUE
+            if kind == JSON:
+                value = json.dumps(value, default=_json_default)
+            if kind in (STRING, JSON):
+                value = table.setdefault(value, len(table))
+            values[irow] = value
+        locations.append(len(data[name]))
+        data[name].append(values)
+    strings, offsets = _encode_strings(list(table))
+    with h5py.File(filename, "w") as fle:
+        fle.attrs["nrecords"] = nrecords
+        fle.attrs["attributes"] = json.dumps(attributes or {},
+                                             default=_json_default)
+        fle.attrs["paths"] = json.dumps([list(path) for path in columns])
+        fle.attrs["kinds"] = json.dumps(kinds)
+        fle.attrs["locations"] = json.dumps(locations)
+        fle.create_dataset("flags", data=flags)
+        for name, dtype in _DATASETS.values():
+            if name not in fle:
+                fle.create_dataset(name, data=np.array(
+                    data[name], dtype=dtype).reshape([len(data[name]),
+                                                      nrecords]))
+        fle.create_dataset("strings", data=strings)
+        fle.create_dataset("offsets", data=offsets)
+
+
+def _memory_map(filename):
+    """
+    Returns a function that loads a dataset as a memory mapped view of the
+    file (or reads it in memory if it cannot be mapped)
+    """
+    mmap = []
+
+    def load(dset):
+        offset = dset.id.get_offset()
+        if offset is None or not dset.size:
+            # Chunked or empty datasets cannot be mapped
+            return dset[()]
+        if not mmap:
+            mmap.append(np.memmap(filename, dtype=np.uint8, mode="r"))
+        nbytes = dset.size * dset.dtype.itemsize
+        return mmap[0][offset:offset + nbytes].view(dset.dtype).reshape(
+            dset.shape)
+    return load
+
+
+class ColumnarMetadata(object):
+    """
+    Read access to the columnar metadata file. Columns are memory mapped and
+    the nested record dictionaries are assembled on demand, row by row
+    :param str filename:
+        Path to the metadata file
+    :param int nrecords:
+        Number of records
+    :param dict attributes:
+        Database level attributes
+    :param columns:
+        Columns as dictionary of attribute path mapped to the tuple
+        (kind, row states, values)
+    """
+    def __init__(self, filename):
+        """
+        Instantiate and map the columns
+        """
+        self.filename = filename
+        self.columns = OrderedDict()
+        self._strings = {}
+        with h5py.File(filename, "r") as fle:
+            load = _memory_map(filename)
+            self.nrecords = int(fle.attrs["nrecords"])
+            self.attributes = json.loads(fle.attrs["attributes"])
+            paths = json.loads(fle.attrs["paths"])
+            kinds = json.loads(fle.attrs["kinds"])
+            locations = json.loads(fle.attrs["locations"])
+            flags = load(fle["flags"])
+            data = dict((name, load(fle[name]))
+                        for name, _ in _DATASETS.values())
+            self._buffer = load(fle["strings"])
+            self._offsets = load(fle["offsets"])
+        for icol, (path, kind, loc) in enumerate(zip(paths, kinds,
+                                                     locations)):
+            values = data[_DATASETS[kind][0]][loc] if loc >= 0 else None
+            self.columns[tuple(path)] = (kind, flags[icol], values)
+
+    def __len__(self):
+        """
+        Returns the number of records
+        """
+        return self.nrecords
+
+    def get_column(self, path):
+        """
+        Returns the values of a numeric column as an array and the array of
+        row states (see ABSENT, NONE, VALUE)
+        :param tuple path:
+            Attribute path, e.g. ("site", "vs30")
+        """
+        kind, flags, values = self.columns[tuple(path)]
+        if kind not in (FLOAT, INT, BOOL):
+            raise ValueError("Column %s is not numeric" % str(path))
+        return values, flags
+
+    def get_values(self, path):
+        """
+        Returns the values of a column as a list of Python objects (None if
+        the attribute is None or absent)
+        :param tuple path:
+            Attribute path, e.g. ("event", "id")
+        """
+        kind, flags, values = self.columns[tuple(path)]
+        output = [None] * self.nrecords
+        for irow in np.flatnonzero(flags >= VALUE):
+            if kind == STRING:
+                output[irow] = self._get_string(int(values[irow]))
+            elif kind == JSON:
+                output[irow] = json.loads(self._get_string(int(values[irow])))
+            elif kind == DICT:
+                output[irow] = self.get_row(irow)
+                for key in path:
+                    output[irow] = output[irow][key]
+            elif flags[irow] == INT_VALUE:
+                output[irow] = int(values[irow])
+            else:
+                output[irow] = values[irow].item()
+        return output
+
+    def _get_string(self, code):
+        """
+        Returns the string of the table with the given code
+        """
+        if code not in self._strings:
+            text = self._buffer[self._offsets[code]:self._offsets[code + 1]]
+            self._strings[code] = text.tobytes().decode("utf-8")
+        return self._strings[code]
+
+    def get_row(self, irow):
+        """
+        Returns the nested dictionary of a record, in the same form as the
+        original `to_dict` output
+        :param int irow:
+            Index of the record
+        """
+        root = OrderedDict()
+        nodes = {(): root}
+        for path, (kind, flags, values) in self.columns.items():
+            parent = nodes.get(path[:-1])
+            if parent is None:
+                # Parent attribute is None or absent
+                continue
+            flag = flags[irow]
+            if flag == ABSENT:
+                continue
+            elif flag == NONE:
+                parent[path[-1]] = None
+            elif kind == DICT:
+                node = OrderedDict()
+                parent[path[-1]] = node
+                nodes[path] = node
+            elif kind == STRING:
+                parent[path[-1]] = self._get_string(int(values[irow]))
+            elif kind == JSON:
+                parent[path[-1]] = json.loads(
+                    self._get_string(int(values[irow])))
+            elif flag == INT_VALUE:
+                parent[path[-1]] = int(values[irow])
+            else:
+                parent[path[-1]] = values[irow].item()
+        return root
@@ -3,10 +3,17 @@ Basic Pseudo-database built on top of hdf5 for a set of processed strong
 motion records
 """
 import os
+import io
 import pickle
 import json
+import zlib
+import warnings
 from datetime import datetime
 from collections import OrderedDict
+try:
+    from collections.abc import MutableSequence
+except ImportError:
+    from collections import MutableSequence
 import numpy as np
 import h5py
 from openquake.hazardlib import imt
@@ -15,13 +22,68 @@ from openquake.hazardlib.geo.point import Point
 
 import smtk.sm_oq_utils
 from smtk.trellis.configure import vs30_to_z1pt0_as08, z1pt0_to_z2pt5
-from smtk.trellis.configure import vs30_to_z1pt0_cy14, vs30_to_z2pt5_cb14
 import smtk.sm_utils as utils
 from smtk import surface_utils
-from smtk.residuals.context_db import ContextDB
+from smtk import sm_columnar
+from smtk.residuals.context_db import ContextDB, get_context_arrays, \
+    set_context_arrays
 
+# Supported formats of the metadata file
+METADATA_FORMATS = ["hdf5", "pkl", "json"]
 
-class Magnitude(object):
+# Cache of the observations of a database, per component
+OBSERVATION_CACHE = "observations_%s.hdf5"
+
+# Manifest and shard directories of a sharded database
+SHARD_MANIFEST = "manifest.json"
+SHARD_DIRECTORY = "shard_%04d"
+
+# Consolidated IM store of a database (see `IMStore`)
+IM_STORE = "im_store.hdf5"
+
+
+class _CompactObject(object):
+    """
+    Base class of the compact metadata classes. The standard attributes of
+    each class are held in `__slots__`, while any extra attribute (e.g. one
+    set by a specific parser) goes to an instance dictionary that is only
+    created when needed
+    """
+    __slots__ = ("__dict__",)
+
+    def _get_attributes(self):
+        """
+        Returns the attributes of the object as an ordered dictionary
+        """
+        output = OrderedDict()
+        for key in self.__slots__:
+            try:
+                output[key] = getattr(self, key)
+            except AttributeError:
+                continue
+        # Reading __dict__ creates it, so remove it again if empty
+        extras = self.__dict__
+        if extras:
+            output.update(extras)
+        else:
+            del self.__dict__
+        return output
+
+    def __getstate__(self):
+        return self._get_attributes()
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            # (dict state, slots state) as from the default protocol
+            dict_state, slots_state = state
+            state = dict(dict_state or {})
+            state.update(slots_state or {})
+        # Objects pickled before the slots were introduced have a dict
+        for key, value in state.items():
+            setattr(self, key, value)
+
+
+class Magnitude(_CompactObject):
     """
     Class to hold magnitude attributes
     :param float value:
@@ -31,6 +93,8 @@ class Magnitude(object):
     :param float sigma:
         The magnitude uncertainty (standard deviation)
     """
+    __slots__ = ("value", "mtype", "sigma", "source")
+
     def __init__(self, value, mtype, sigma=None, source=""):
         """
         Instantiate the class
@@ -48,7 +112,7 @@ class Magnitude(object):
         return cls(d["value"], d["mtype"], d["sigma"], d["source"])
 
     def to_dict(self):
-        return self.__dict__
+        return self._get_attributes()
 
     def __eq__(self, m):
         """
@@ -153,7 +217,7 @@ class Rupture(object):
         for key in self.__dict__:
             if key == "magnitude" and self.magnitude is not None:
                 # Parse magnitude object to dictionary
-                output[key] = self.magnitude.__dict__
+                output[key] = self.magnitude.to_dict()
             elif key == "hypocentre" and self.hypocentre is not None:
                 output[key] = [self.hypocentre.longitude,
                                self.hypocentre.latitude,
@@ -330,10 +394,10 @@ class FocalMechanism(object):
         if self.tensor is None:
             return None
         else:
-            return self.tensor.to_list() 
+            return self.tensor.tolist()
 
 
-class Earthquake(object):
+class Earthquake(_CompactObject):
     """
     Class to hold earthquake event related information
     :param str id:
@@ -358,6 +422,10 @@ class Earthquake(object):
     :param rupture:
         Earthquake rupture as instance of the :class: Rupture
     """
+    __slots__ = ("id", "datetime", "name", "country", "longitude", "latitude",
+                 "depth", "magnitude", "magnitude_list", "mechanism", "rupture",
+                 "tectonic_region")
+
     def __init__(self, eq_id, name, date_time, longitude, latitude, depth,
                  magnitude, focal_mechanism=None, eq_country=None,
                  tectonic_region=None):
@@ -382,19 +450,16 @@ class Earthquake(object):
         """
         Parses the information to a json compatible dictionary
         """
-        output = OrderedDict([])
-        for key in self.__dict__:
+        output = self._get_attributes()
+        for key, value in output.items():
             if key == "datetime":
-                output[key] = str(self.datetime)
+                output[key] = str(value)
             elif key == "magnitude":
-                output[key] = self.magnitude.__dict__
+                output[key] = value.to_dict()
             elif key == "magnitude_list":
-                output[key] = [mag.__dict__ for mag in self.magnitude_list]
-            elif key in ("mechanism", "rupture") and\
-                getattr(self, key) is not None:
-                output[key] = getattr(self, key).to_dict()
-            else:
-                output[key] = getattr(self, key)
+                output[key] = [mag.to_dict() for mag in value]
+            elif key in ("mechanism", "rupture") and value is not None:
+                output[key] = value.to_dict()
         return output
 
     @classmethod
@@ -404,8 +469,12 @@ class Earthquake(object):
         """
         reqs = ["id", "name", "datetime", "longitude", "latitude", "depth",
                 "magnitude"]
+        if "." in data["datetime"]:
+            dtime_format = "%Y-%m-%d %H:%M:%S.%f"
+        else:
+            dtime_format = "%Y-%m-%d %H:%M:%S"
         eqk = cls(data["id"], data["name"],
-                  datetime.strptime(data["datetime"], "%Y-%m-%d %H:%M:%S"),
+                  datetime.strptime(data["datetime"], dtime_format),
                   data["longitude"],
                   data["latitude"],
                   data["depth"],
@@ -426,7 +495,7 @@ class Earthquake(object):
         return eqk
 
 
-class RecordDistance(object):
+class RecordDistance(_CompactObject):
     """
     Class to hold source to site distance information
     :param float repi:
@@ -453,6 +522,10 @@ class RecordDistance(object):
         and earthquake-specific
         average DPP used
     """
+    __slots__ = ("repi", "rhypo", "rjb", "rrup", "r_x", "ry0", "azimuth",
+                 "hanging_wall", "flag", "rcdpp", "rvolc", "pre_event_length",
+                 "post_event_length")
+
     def __init__(self, repi, rhypo, rjb=None, rrup=None, r_x=None, ry0=None,
                  flag=None, azimuth=None, rcdpp=None, rvolc=None):
         """
@@ -474,7 +547,7 @@ class RecordDistance(object):
         self.post_event_length = None
 
     def to_dict(self):
-        return self.__dict__
+        return self._get_attributes()
 
     @classmethod
     def from_dict(cls, data):
@@ -522,7 +595,7 @@ NEHRP_NSPT_BOUNDARIES = {
 }
 
 
-class RecordSite(object):
+class RecordSite(_CompactObject):
     """
     Class to hold attributes belonging to the site
     :param str site_id:
@@ -577,6 +650,14 @@ class RecordSite(object):
         True if site is in subduction backarc, False otherwise
 
     """
+    __slots__ = ("id", "name", "code", "longitude", "latitude", "altitude",
+                 "site_class", "vs30", "vs30_measured", "vs30_measured_type",
+                 "vs30_uncertainty", "nspt", "nehrp", "ec8",
+                 "building_structure", "number_floors", "floor",
+                 "instrument_type", "digitiser", "network_code",
+                 "sensor_depth", "country", "z1pt0", "z1pt5", "z2pt5",
+                 "backarc", "morphology", "slope")
+
     def __init__(self, site_id, site_code, site_name, longitude, latitude,
                  altitude, vs30=None, vs30_measured=None, network_code=None,
                  country=None, site_class=None, backarc=False):
@@ -613,7 +694,7 @@ class RecordSite(object):
         self.slope = None
 
     def to_dict(self):
-        return self.__dict__
+        return self._get_attributes()
 
     @classmethod
     def from_dict(cls, data):
@@ -758,7 +839,7 @@ ims_dict = {
 }
 
 
-class Component(object):
+class Component(_CompactObject):
     """
     Contains the metadata relating to waveform of the record
     :param str id:
@@ -777,6 +858,11 @@ class Component(object):
         Units of record
         
     """
+    __slots__ = ("id", "orientation", "lup", "sup", "filter", "baseline",
+                 "ims", "units", "late_trigger", "start_time", "duration",
+                 "resample_rate_denominator", "resample_rate_numerator",
+                 "owner", "creation_info")
+
     def __init__(self, waveform_id, orientation, ims=None, longest_period=None,
                  waveform_filter=None, baseline=None, units=None):
         """
@@ -800,7 +886,7 @@ class Component(object):
         self.creation_info = None
 
     def to_dict(self):
-        return self.__dict__
+        return self._get_attributes()
 
     @classmethod
     def from_dict(cls, data):
@@ -813,7 +899,7 @@ class Component(object):
         return comp
 
 
-class GroundMotionRecord(object):
+class GroundMotionRecord(_CompactObject):
     """
     Class containing the full representation of the strong motion record
     :param str id:
@@ -845,6 +931,10 @@ class GroundMotionRecord(object):
     :param str datafile:
         Data file for strong motion record
     """
+    __slots__ = ("id", "time_series_file", "spectra_file", "event", "distance",
+                 "site", "xrecord", "yrecord", "vertical", "average_lup",
+                 "average_sup", "ims", "directivity", "datafile", "misc")
+
     def __init__(self, gm_id, time_series_file, event, distance, record_site,
                  x_comp, y_comp, vertical=None, ims=None, longest_period=None,
                  shortest_period=None, spectra_file=None):
@@ -875,14 +965,12 @@ class GroundMotionRecord(object):
     def to_dict(self):
         """
         """
-        output = OrderedDict([])
-        for key in self.__dict__:
+        output = self._get_attributes()
+        for key, value in output.items():
             if key in ("event", "distance", "site", "xrecord", "yrecord"):
-                output[key] = getattr(self, key).to_dict()
-            elif key == "vertical" and self.vertical:
-                output[key] = self.vertical.to_dict()
-            else:
-                output[key] = getattr(self, key)
+                output[key] = value.to_dict()
+            elif key == "vertical" and value:
+                output[key] = value.to_dict()
         return output
 
     @classmethod
@@ -891,11 +979,18 @@ class GroundMotionRecord(object):
         """
         reqs = ["id", "time_series_file", "event", "distance", "site",
                 "xrecord", "yrecord", "vertical"]
+        # Event and site may be given as already built (shared) objects
+        event = data["event"]
+        if not isinstance(event, Earthquake):
+            event = Earthquake.from_dict(event)
+        site = data["site"]
+        if not isinstance(site, RecordSite):
+            site = RecordSite.from_dict(site)
         evnt = cls(data["id"],
                    data["time_series_file"],
-                   Earthquake.from_dict(data["event"]),
+                   event,
                    RecordDistance.from_dict(data["distance"]),
-                   RecordSite.from_dict(data["site"]),
+                   site,
                    Component.from_dict(data["xrecord"]),
                    Component.from_dict(data["yrecord"]))
 
@@ -926,6 +1021,263 @@ class GroundMotionRecord(object):
         return self.distance.azimuth
 
 
+class MetadataInterner(object):
+    """
+    Registry of the events and sites met so far, keyed by their id, so that
+    records of the same event (or site) share a single :class: Earthquake
+    (or :class: RecordSite) instead of holding identical copies. An object
+    is only shared if its metadata is identical to the registered one
+    :param dict events:
+        Registered events as tuple (object, dictionary) keyed by id
+    :param dict sites:
+        Registered sites as tuple (object, dictionary) keyed by id
+    """
+    def __init__(self):
+        """
+        Instantiate with empty registries
+        """
+        self.events = {}
+        self.sites = {}
+
+    @staticmethod
+    def _lookup(registry, obj_id, data):
+        """
+        Returns the registered object if its metadata are identical to
+        `data`, None otherwise
+        """
+        if obj_id not in registry:
+            return None
+        obj, obj_data = registry[obj_id]
+        try:
+            same = obj_data is data or obj_data == data
+        except ValueError:
+            # Comparison involving arrays
+            same = False
+        return obj if same else None
+
+    def _intern(self, registry, obj):
+        """
+        Returns the registered equivalent of `obj`, registering `obj` if
+        its id is new
+        """
+        if obj is None:
+            return obj
+        data = obj.to_dict()
+        shared = self._lookup(registry, obj.id, data)
+        if shared is not None:
+            return shared
+        registry.setdefault(obj.id, (obj, data))
+        return obj
+
+    def _from_dict(self, registry, cls, data):
+        """
+        Returns the registered object matching the dictionary or else builds
+        it from the dictionary, registering it if its id is new
+        """
+        shared = self._lookup(registry, data["id"], data)
+        if shared is not None:
+            return shared
+        obj = cls.from_dict(data)
+        registry.setdefault(obj.id, (obj, data))
+        return obj
+
+    def intern_event(self, event):
+        """
+        Returns the shared instance of an :class: Earthquake
+        """
+        return self._intern(self.events, event)
+
+    def intern_site(self, site):
+        """
+        Returns the shared instance of a :class: RecordSite
+        """
+        return self._intern(self.sites, site)
+
+    def intern_record(self, record):
+        """
+        Replaces the event and site of a record with the shared instances
+        :param record:
+            Record as instance of :class: GroundMotionRecord (or None)
+        """
+        if record is not None:
+            record.event = self.intern_event(record.event)
+            record.site = self.intern_site(record.site)
+        return record
+
+    def event_from_dict(self, data):
+        """
+        Returns the shared :class: Earthquake described by the dictionary
+        """
+        return self._from_dict(self.events, Earthquake, data)
+
+    def site_from_dict(self, data):
+        """
+        Returns the shared :class: RecordSite described by the dictionary
+        """
+        return self._from_dict(self.sites, RecordSite, data)
+
+
+class LazyRecordList(MutableSequence):
+    """
+    List of records in which each record is only built from its source
+    (e.g. a row of the columnar metadata) the first time it is accessed
+    :param loader:
+        Function returning the record given its index in the source
+    :param int nrecords:
+        Number of records in the source
+    :param metadata:
+        Columnar metadata of the records as instance of :class:
+        smtk.sm_columnar.ColumnarMetadata, if available
+    """
+    def __init__(self, loader, nrecords, metadata=None):
+        """
+        Instantiate with all records unloaded
+        """
+        self._loader = loader
+        self.metadata = metadata
+        # Integers denote the source index of records not yet loaded
+        self._items = list(range(nrecords))
+        # Number of changes to the list (loading records does not count)
+        self.version = 0
+
+    def _load(self, index):
+        """
+        Returns the record at the given position, loading it if necessary
+        """
+        item = self._items[index]
+        if isinstance(item, int):
+            item = self._loader(item)
+            self._items[index] = item
+        return item
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._load(i)
+                    for i in range(*index.indices(len(self._items)))]
+        return self._load(index)
+
+    def __setitem__(self, index, value):
+        self._items[index] = value
+        self.version += 1
+
+    def __delitem__(self, index):
+        del self._items[index]
+        self.version += 1
+
+    def insert(self, index, value):
+        self._items.insert(index, value)
+        self.version += 1
+
+    def number_loaded(self):
+        """
+        Returns the number of records built so far
+        """
+        return sum(not isinstance(item, int) for item in self._items)
+
+
+def _changes_list(method):
+    """
+    Wraps a method of :class: RecordList so that it counts as a change
+    """
+    def wrapper(self, *args, **kwargs):
+        output = method(self, *args, **kwargs)
+        self.version += 1
+        return output
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+class RecordList(list):
+    """
+    Plain list of records that counts the changes made to it, so that
+    indices built on the records know when they are out of date
+    """
+    version = 0
+
+    __setitem__ = _changes_list(list.__setitem__)
+    __delitem__ = _changes_list(list.__delitem__)
+    __iadd__ = _changes_list(list.__iadd__)
+    __imul__ = _changes_list(list.__imul__)
+    append = _changes_list(list.append)
+    extend = _changes_list(list.extend)
+    insert = _changes_list(list.insert)
+    pop = _changes_list(list.pop)
+    remove = _changes_list(list.remove)
+    clear = _changes_list(list.clear)
+    sort = _changes_list(list.sort)
+    reverse = _changes_list(list.reverse)
+
+
+class RecordIndex(object):
+    """
+    Grouping of the records of a database by a key (e.g. the event id) in
+    compressed sparse row form: the positions of the records with the i-th
+    key are `order[offsets[i]:offsets[i + 1]]`, in ascending order
+    :param list keys:
+        Unique keys in order of first appearance
+    :param dict lookup:
+        Position of each key in `keys`
+    :param numpy.ndarray codes:
+        Position in `keys` of the key of each record
+    :param numpy.ndarray offsets:
+        Offsets of each group in `order`
+    :param numpy.ndarray order:
+        Positions of the records sorted by group
+    """
+    def __init__(self, values):
+        """
+        :param values:
+            Key of each record
+        """
+        self.lookup = {}
+        self.codes = np.array([self.lookup.setdefault(value, len(self.lookup))
+                               for value in values], dtype=np.int64)
+        self.keys = list(self.lookup)
+        self.order = np.argsort(self.codes, kind="stable")
+        self.offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.codes, minlength=len(self.keys)),
+                  out=self.offsets[1:])
+
+    def __len__(self):
+        """
+        Returns the number of groups
+        """
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.lookup
+
+    def get_group(self, key):
+        """
+        Returns the positions of the records with the given key
+        """
+        i = self.lookup[key]
+        return self.order[self.offsets[i]:self.offsets[i + 1]]
+
+    def groups(self):
+        """
+        Yields the tuple (key, positions of the records) for every group
+        """
+        for i, key in enumerate(self.keys):
+            yield key, self.order[self.offsets[i]:self.offsets[i + 1]]
+
+
+class RecordGroup(list):
+    """
+    List of the records of a group (e.g. an event) that also holds their
+    positions in the database
+    :param numpy.ndarray indices:
+        Positions of the records in the database
+    """
+    def __init__(self, records, indices):
+        super(RecordGroup, self).__init__(records)
+        self.indices = indices
+
+
 class GroundMotionDatabase(ContextDB):
     """
     Class to represent a database of strong motions
@@ -948,9 +1300,112 @@ class GroundMotionDatabase(ContextDB):
         self.id = db_id
         self.name = db_name
         self.directory = db_directory
-        self.records = list(records) if records is not None else []
+        self.records = records if records is not None else []
         self.site_ids = list(site_ids) if site_ids is not None else []
 
+    @property
+    def records(self):
+        """
+        Records of the database as instance of :class: RecordList (or
+        :class: LazyRecordList)
+        """
+        return self._records
+
+    @records.setter
+    def records(self, records):
+        if not isinstance(records, (RecordList, LazyRecordList)):
+            records = RecordList(records)
+        self._records = records
+        self._indices = {}
+
+    def __getstate__(self):
+        """
+        Records are always pickled as a plain list, without the indices
+        """
+        state = self.__dict__.copy()
+        del state["_records"], state["_indices"]
+        state.pop("_site_lookup", None)
+        state.pop("_observations", None)
+        state["records"] = list(self.records)
+        return state
+
+    def __setstate__(self, state):
+        state = state.copy()
+        records = state.pop("records")
+        self.__dict__.update(state)
+        self.records = records
+
+    def _get_cached(self, name, build):
+        """
+        Returns the output of `build()`, building it again only if the records
+        have changed since it was last built
+        """
+        version = self._records.version
+        if name not in self._indices or self._indices[name][0] != version:
+            self._indices[name] = (version, build())
+        return self._indices[name][1]
+
+    def _get_columnar_metadata(self):
+        """
+        Returns the columnar metadata the records were loaded from, or None
+        if not available or if the list of records changed since
+        """
+        records = self._records
+        if isinstance(records, LazyRecordList) and records.version == 0:
+            return records.metadata
+        return None
+
+    def _get_index(self, name, key, path):
+        """
+        Returns the index grouping the records by the given key function,
+        building it if the records have changed since it was last built. If
+        available the keys are taken from the column `path` of the columnar
+        metadata, without building the records
+        """
+        def build():
+            metadata = self._get_columnar_metadata()
+            if metadata is not None and path in metadata.columns:
+                return RecordIndex(metadata.get_values(path))
+            return RecordIndex([key(record) for record in self._records])
+        return self._get_cached(name, build)
+
+    def invalidate_indices(self):
+        """
+        Discards the record indices. Changes to the list of records are
+        detected automatically, but changes to the event or site of a
+        record in place are not and need this to be called
+        """
+        self._indices = {}
+
+    @property
+    def event_index(self):
+        """
+        Index of the records by event id, as :class: RecordIndex
+        """
+        return self._get_index("event", lambda rec: rec.event.id,
+                               ("event", "id"))
+
+    @property
+    def site_index(self):
+        """
+        Index of the records by site id, as :class: RecordIndex
+        """
+        return self._get_index("site", lambda rec: rec.site.id,
+                               ("site", "id"))
+
+    @property
+    def record_index(self):
+        """
+        Index of the records by record id, as :class: RecordIndex
+        """
+        return self._get_index("record", lambda rec: rec.id, ("id",))
+
+    def get_records(self, indices):
+        """
+        Returns the records at the given positions as :class: RecordGroup
+        """
+        return RecordGroup([self.records[i] for i in indices], indices)
+
     def __iter__(self):
         """
         Make this object iterable, i.e.
@@ -964,40 +1419,189 @@ class GroundMotionDatabase(ContextDB):
     ############################################
 
     def get_event_and_records(self):
-        """yield (event, records) tuples. See superclass docstring for details"""
-        data = {}
-        for record in self.records:
-            evt_id = record.event.id
-            if evt_id not in data:  # defaultdict might be an option
-                data[evt_id] = []
-            data[evt_id].append(record)
-
-        for evt_id, records in data.items():
-            yield evt_id, records
+        """yield (event, records) tuples. See superclass docstring for details.
+        Records are given as :class: RecordGroup"""
+        for evt_id, indices in self.event_index.groups():
+            yield evt_id, self.get_records(indices)
 
     SCALAR_IMTS = ["PGA", "PGV"]
+    # Observations of all records, set while iterating over the contexts
+    _observations = None
+    # Store the observations of all records in a cache file in the database
+    # directory (see `get_database_observations`)
+    cache_observations = True
+    # Number of threads reading the record files (None for the default of
+    # smtk.sm_utils.IO_WORKERS)
+    io_workers = None
+    # Read the observations from the consolidated IM store of the database
+    # directory, if any (see `IMStore`)
+    use_im_store = True
+
+    def get_contexts(self, nodal_plane_index=1,
+                     imts=None, component="Geometric"):
+        """Return an iterable of Contexts. See superclass docstring for
+        details. The observations of all records are extracted in a single
+        pass over the record files and then sliced per event
+        """
+        if imts is not None and len(imts):
+            imts = list(OrderedDict.fromkeys(imts))
+            self._observations = (imts, component,
+                                  self.get_database_observations(imts,
+                                                                 component))
+        try:
+            for dic in super(GroundMotionDatabase, self).get_contexts(
+                    nodal_plane_index, imts, component):
+                yield dic
+        finally:
+            self._observations = None
 
     def get_observations(self, imtx, records, component="Geometric"):
         """Return observed values for the given imt, as numpy array.
         See superclass docstring for details
         """
-
-        values = []
-        selection_string = "IMS/H/Spectra/Response/Acceleration/"
-        for record in records:
-            fle = h5py.File(record.datafile, "r")
+        return self.get_observation_matrix([imtx], records, component)[:, 0]
+
+    def get_observation_matrix(self, imts, records, component="Geometric"):
+        """Return the observed values of the given imts, as numpy array of
+        shape (len(records), len(imts)). Each record file is opened once and
+        all spectral accelerations are interpolated at once. See superclass
+        docstring for details
+        """
+        if self._observations is not None and \
+                isinstance(records, RecordGroup) and \
+                list(imts) == self._observations[0] and \
+                component == self._observations[1]:
+            # Observations already extracted for all records
+            return self._observations[2][records.indices]
+        values = self.get_store_observations(imts, records, component)
+        if values is not None:
+            return values
+        scalars, spectral, periods = [], [], []
+        for i, imtx in enumerate(imts):
             if imtx in self.SCALAR_IMTS:
-                values.append(self.get_scalar(fle, imtx, component))
+                scalars.append((i, imtx))
             elif "SA(" in imtx:
-                target_period = imt.from_string(imtx).period
-                spectrum = fle[selection_string + component +
-                               "/damping_05"][:]
-                periods = fle["IMS/H/Spectra/Response/Periods"][:]
-                values.append(utils.get_interpolated_period(
-                    target_period, periods, spectrum))
+                spectral.append(i)
+                periods.append(imt.from_string(imtx).period)
             else:
                 raise ValueError("IMT %s is unsupported!" % imtx)
-            fle.close()
+        missing = [record.id for record in records if not record.datafile]
+        if missing:
+            # e.g. database with a consolidated IM store only
+            raise ValueError("%s not in the IM store for component %s and "
+                             "records %s have no record file"
+                             % (", ".join(imts), component,
+                                ", ".join(missing)))
+        values = np.zeros([len(records), len(imts)])
+        selection_string = "IMS/H/Spectra/Response/Acceleration/"
+        # The bytes of the record files are read by a pool of threads ahead
+        # of their decoding (h5py serialises all its calls), and only the
+        # datasets of the requested imts are decoded
+        images = utils.iter_prefetched(
+            utils.read_file, [record.datafile for record in records],
+            self.io_workers)
+        for irec, image in enumerate(images):
+            with h5py.File(io.BytesIO(image), "r") as fle:
+                if scalars:
+                    values[irec, [i for i, _ in scalars]] = self.get_scalars(
+                        fle, [imtx for _, imtx in scalars], component)
+                if spectral:
+                    spectrum = fle[selection_string + component +
+                                   "/damping_05"][:]
+                    values[irec, spectral] = utils.get_interpolated_periods(
+                        periods, fle["IMS/H/Spectra/Response/Periods"][:],
+                        spectrum)
+        return values
+
+    def get_im_store(self):
+        """
+        Returns the consolidated IM store of the database directory, as
+        instance of :class: IMStore, or None if there is none (or
+        `use_im_store` is False)
+        """
+        if not (self.use_im_store and self.directory):
+            return None
+        filename = os.path.join(self.directory, IM_STORE)
+        if not os.path.exists(filename):
+            return None
+        return IMStore(filename)
+
+    def get_store_observations(self, imts, records, component="Geometric"):
+        """
+        Returns the observed values of the given imts for the records, as
+        `get_observation_matrix`, read from the consolidated IM store, or
+        None if the store is missing or does not hold all of them
+        """
+        if not all([imtx in self.SCALAR_IMTS or "SA(" in imtx
+                    for imtx in imts]):
+            return None
+        store = self.get_im_store()
+        if store is None or not store.has_imts(imts, component):
+            return None
+        indices = store.get_indices([record.id for record in records])
+        if indices is None:
+            return None
+        # Record files changed since the store was built (e.g. by
+        # add_horizontal_im): the store is outdated
+        if store.mtimes is None or np.any(
+                store.mtimes[indices] != get_datafile_mtimes(records)):
+            return None
+        return store.get_observation_matrix(imts, indices, component)
+
+    def get_database_observations(self, imts, component="Geometric"):
+        """Returns the observed values of the given imts for all records, as
+        numpy array of shape (len(self.records), len(imts)).
+
+        If `cache_observations` is True and the database has a directory, the
+        values are stored in a cache file of the directory (one per
+        component) with the record ids and the modification times of the
+        record files. Only the records whose file changed since, and the imts
+        not found in the cache, are read again from the record files
+        """
+        records = self.records
+        values = self.get_store_observations(imts, records, component)
+        if values is not None:
+            # One read per IMT, no need of the cache
+            return values
+        if not (self.cache_observations and self.directory and
+                os.path.isdir(self.directory)):
+            return self.get_observation_matrix(imts, records, component)
+        filename = os.path.join(self.directory,
+                                OBSERVATION_CACHE % component)
+        keys = ["%s|%s" % (record.id, record.datafile) for record in records]
+        mtimes = get_datafile_mtimes(records)
+        valid = np.zeros(len(records), dtype=bool)
+        columns = {}
+        if os.path.exists(filename):
+            try:
+                valid, columns = _read_observation_cache(filename, keys,
+                                                         mtimes)
+            except (IOError, OSError, KeyError) as err:
+                warnings.warn("Observation cache %s not readable (%s): "
+                              "rebuilding" % (filename, str(err)))
+        values = np.zeros([len(records), len(imts)])
+        cached = [i for i, imtx in enumerate(imts) if imtx in columns]
+        missing = [i for i, imtx in enumerate(imts) if imtx not in columns]
+        stale = np.where(np.logical_not(valid))[0]
+        for i in cached:
+            values[:, i] = columns[imts[i]]
+        if len(stale) and cached:
+            values[np.ix_(stale, cached)] = self.get_observation_matrix(
+                [imts[i] for i in cached], self.get_records(stale),
+                component)
+        if missing:
+            values[:, missing] = self.get_observation_matrix(
+                [imts[i] for i in missing], records, component)
+        if len(stale) or missing:
+            if len(stale):
+                # Columns not requested cannot be updated
+                columns = {}
+            columns.update((imtx, values[:, i]) for i, imtx in enumerate(imts))
+            try:
+                _write_observation_cache(filename, keys, mtimes, columns)
+            except (IOError, OSError) as err:
+                warnings.warn("Observation cache %s not written (%s)"
+                              % (filename, str(err)))
         return values
 
     def update_context(self, ctx, records, nodal_plane_index=1):
@@ -1051,93 +1655,62 @@ class GroundMotionDatabase(ContextDB):
 
     def _update_sites_context(self, ctx, records):
         """Called by self.update_context"""
-
-        for attname in self.sites_context_attrs:
-            setattr(ctx, attname, [])
-
-        for record in records:
-            ctx.vs30.append(record.site.vs30)
-            ctx.lons.append(record.site.longitude)
-            ctx.lats.append(record.site.latitude)
-            if record.site.altitude:
-                depth = record.site.altitude * -1.0E-3
-            else:
-                depth = 0.0
-            ctx.depths.append(depth)
-            if record.site.vs30_measured is not None:
-                vs30_measured = record.site.vs30_measured
-            else:
-                vs30_measured = 0
-            ctx.vs30measured.append(vs30_measured)
-            if record.site.z1pt0 is not None:
-                z1pt0 = record.site.z1pt0
-            else:
-                z1pt0 = vs30_to_z1pt0_cy14(record.site.vs30)
-            ctx.z1pt0.append(z1pt0)
-            if record.site.z2pt5 is not None:
-                z2pt5 = record.site.z2pt5
-            else:
-                z2pt5 = vs30_to_z2pt5_cb14(record.site.vs30)
-            ctx.z2pt5.append(z2pt5)
-            if getattr(record.site, "backarc", None) is not None:
-                ctx.backarc.append(record.site.backarc)
-
-        # finalize:
-        for attname in self.sites_context_attrs:
-            attval = getattr(ctx, attname)
-            # remove attribute if its value is empty-like
-            if attval is None or not len(attval):
-                delattr(ctx, attname)
-            elif attname in ('vs30measured', 'backarc'):
-                setattr(ctx, attname, np.asarray(attval, dtype=bool))
-            else:
-                # dtype=float forces Nones to be safely converted to nan
-                setattr(ctx, attname, np.asarray(attval, dtype=float))
+        self._set_context_arrays(ctx, records, self.sites_context_attrs)
 
     def _update_distances_context(self, ctx, records):
         """Called by self.update_context"""
+        self._set_context_arrays(ctx, records, self.distances_context_attrs)
 
-        for attname in self.distances_context_attrs:
-            setattr(ctx, attname, [])
-
-        for record in records:
-            ctx.repi.append(record.distance.repi)
-            ctx.rhypo.append(record.distance.rhypo)
-            # TODO Setting Rjb == Repi and Rrup == Rhypo when missing value
-            # is a hack! Need feedback on how to fix
-            if record.distance.rjb is not None:
-                ctx.rjb.append(record.distance.rjb)
-            else:
-                ctx.rjb.append(record.distance.repi)
-            if record.distance.rrup is not None:
-                ctx.rrup.append(record.distance.rrup)
-            else:
-                ctx.rrup.append(record.distance.rhypo)
-            if record.distance.r_x is not None:
-                ctx.rx.append(record.distance.r_x)
-            else:
-                ctx.rx.append(record.distance.repi)
-            if getattr(record.distance, "ry0", None) is not None:
-                ctx.ry0.append(record.distance.ry0)
-            if getattr(record.distance, "rcdpp", None) is not None:
-                ctx.rcdpp.append(record.distance.rcdpp)
-            if record.distance.azimuth is not None:
-                ctx.azimuth.append(record.distance.azimuth)
-            if record.distance.hanging_wall is not None:
-                ctx.hanging_wall.append(record.distance.hanging_wall)
-            if getattr(record.distance, "rvolc", None) is not None:
-                ctx.rvolc.append(record.distance.rvolc)
-
-        # finalize:
-        for attname in self.distances_context_attrs:
-            attval = getattr(ctx, attname)
-            # remove attribute if its value is empty-like
-            if attval is None or not len(attval):
-                delattr(ctx, attname)
-            else:
-                # FIXME: dtype=float forces Nones to be safely converted to nan
-                # but it assumes obviously all attval elements to be numeric
-                setattr(ctx, attname, np.asarray(attval, dtype=float))
+    def _set_context_arrays(self, ctx, records, attnames):
+        """
+        Sets the given site or distance attributes of the context by slicing
+        the arrays of the whole database (see `_get_context_arrays`) with the
+        positions of the records (if given as :class: RecordGroup)
+        """
+        indices = getattr(records, "indices", None)
+        if indices is None:
+            arrays = self._get_context_arrays(records)
+            indices = np.arange(len(records))
+        else:
+            arrays = self._get_cached(
+                "contexts", lambda: self._get_context_arrays(self._records))
+        set_context_arrays(ctx, arrays, indices, attnames)
+
+    def _get_raw_column(self, records, path):
+        """
+        Returns the values of a site or distance attribute of the records as
+        float array (nan where missing) and the boolean array of the records
+        with a value
+        """
+        metadata = None
+        if records is self._records:
+            metadata = self._get_columnar_metadata()
+        if metadata is not None:
+            if path not in metadata.columns:
+                return (np.full(len(records), np.nan),
+                        np.zeros(len(records), dtype=bool))
+            try:
+                values, flags = metadata.get_column(path)
+                present = flags >= sm_columnar.VALUE
+                return np.where(present, values, np.nan), present
+            except ValueError:
+                # Not a numeric column: read from the records
+                pass
+        values = [getattr(getattr(record, path[0]), path[1], None)
+                  for record in records]
+        present = np.array([value is not None for value in values],
+                           dtype=bool)
+        # dtype=float forces Nones to be safely converted to nan
+        return np.array(values, dtype=float), present
+
+    def _get_context_arrays(self, records):
+        """
+        Returns the site and distance attributes of the context for all the
+        given records (see :func:`smtk.residuals.context_db.get_context_arrays`)
+        """
+        def column(*path):
+            return self._get_raw_column(records, path)
+        return get_context_arrays(column)
 
     ###########################
     # END OF ABSTRACT METHODS #
@@ -1154,38 +1727,119 @@ class GroundMotionDatabase(ContextDB):
         :param str component:
             Horizontal component of IM
         """
+        return self.get_scalars(fle, [i_m], component)[0]
+
+    def get_scalars(self, fle, ims, component="Geometric"):
+        """
+        Retrieves a list of scalar IMs from the database, reading the scalar
+        group of each component once
+        :param fle:
+            Instance of :class: h5py.File
+        :param list ims:
+            Intensity measures
+        :param str component:
+            Horizontal component of IM
+        """
         if not ("H" in fle["IMS"].keys()):
-            x_im = fle["IMS/X/Scalar/" + i_m][0]
-            y_im = fle["IMS/Y/Scalar/" + i_m][0]
-            return utils.SCALAR_XY[component](x_im, y_im)
+            x_ims = utils.get_scalar_ims(fle["IMS/X/Scalar"], ims)
+            y_ims = utils.get_scalar_ims(fle["IMS/Y/Scalar"], ims)
+            return [utils.SCALAR_XY[component](x_im, y_im)
+                    for x_im, y_im in zip(x_ims, y_ims)]
         else:
-            if i_m in fle["IMS/H/Scalar"].keys():
-                return fle["IMS/H/Scalar/" + i_m][0]
-            else:
-                raise ValueError("Scalar IM %s not in record database" % i_m)
+            try:
+                return utils.get_scalar_ims(fle["IMS/H/Scalar"], ims)
+            except KeyError as err:
+                raise ValueError("Scalar IM not in record database (%s)"
+                                 % str(err))
 
     def to_json(self):
         """
-        Exports the database to json
+        Exports the database to json. Events and sites are written once, in
+        the "events" and "sites" objects, and referred to by id in the
+        records (unless they differ from the shared one)
         """
         json_dict = {"id": self.id,
                      "name": self.name,
                      "directory": self.directory,
+                     "events": OrderedDict(),
+                     "sites": OrderedDict(),
                      "records": []}
         for rec in self.records:
-            json_dict["records"].append(rec.to_dict())
+            rec_dict = rec.to_dict()
+            for key, shared in [("event", json_dict["events"]),
+                                ("site", json_dict["sites"])]:
+                # Json keys are always strings
+                obj_id = str(rec_dict[key]["id"])
+                if obj_id not in shared:
+                    shared[obj_id] = rec_dict[key]
+                if shared[obj_id] == rec_dict[key]:
+                    rec_dict[key] = rec_dict[key]["id"]
+            json_dict["records"].append(rec_dict)
         return json.dumps(json_dict)
 
     @classmethod
     def from_json(cls, filename):
         """
+        Loads the database from json. Records are built from their
+        dictionaries only when accessed
         """
         with open(filename, "r") as f:
             raw = json.load(f)
         gmdb = cls(raw["id"], raw["name"], raw["directory"])
-        for record in raw["records"]:
-            gmdb.records.append(GroundMotionRecord.from_dict(record))
-        gmdb.site_ids = [rec.site.id for rec in gmdb.records]
+        raw_records = raw["records"]
+        # Events and sites referred to by id
+        shared = {"event": raw.get("events", {}),
+                  "site": raw.get("sites", {})}
+        for rec in raw_records:
+            for key in shared:
+                if not isinstance(rec[key], dict):
+                    rec[key] = shared[key][str(rec[key])]
+        interner = MetadataInterner()
+
+        def load(irow):
+            data = raw_records[irow].copy()
+            data["event"] = interner.event_from_dict(data["event"])
+            data["site"] = interner.site_from_dict(data["site"])
+            record = GroundMotionRecord.from_dict(data)
+            # The dictionary is no longer needed once the record is built
+            raw_records[irow] = None
+            return record
+        gmdb.records = LazyRecordList(load, len(raw_records))
+        gmdb.site_ids = [rec["site"]["id"] for rec in raw_records]
+        return gmdb
+
+    def to_columnar(self, filename):
+        """
+        Exports the metadata to the columnar binary format (see
+        :mod:`smtk.sm_columnar`)
+        :param str filename:
+            Path to the output file
+        """
+        sm_columnar.write_columnar_metadata(
+            filename, self.records,
+            {"id": self.id, "name": self.name, "directory": self.directory,
+             "site_ids": self.site_ids})
+
+    @classmethod
+    def from_columnar(cls, filename):
+        """
+        Loads the database from the columnar binary format. The columns are
+        memory mapped and the records are only built when accessed
+        :param str filename:
+            Path to the metadata file
+        """
+        metadata = sm_columnar.ColumnarMetadata(filename)
+        attrs = metadata.attributes
+        gmdb = cls(attrs["id"], attrs["name"], attrs["directory"],
+                   site_ids=attrs.get("site_ids"))
+        interner = MetadataInterner()
+
+        def load(irow):
+            data = metadata.get_row(irow)
+            data["event"] = interner.event_from_dict(data["event"])
+            data["site"] = interner.site_from_dict(data["site"])
+            return GroundMotionRecord.from_dict(data)
+        gmdb.records = LazyRecordList(load, len(metadata), metadata)
         return gmdb
 
     def number_records(self):
@@ -1212,20 +1866,28 @@ class GroundMotionDatabase(ContextDB):
         """
         Returns the list of unique event keys from the database
         """
-        event_list = []
-        for record in self.records:
-            if not record.event.id in event_list:
-                event_list.append(record.event.id)
-        return np.array(event_list)
+        return np.array(self.event_index.keys)
 
     def _get_site_id(self, str_id):
         """
-        TODO 
-        """
-        if str_id not in self.site_ids:
+        Returns the position of the site id in `self.site_ids`, appending it
+        if not present
+        """
+        lookup = getattr(self, "_site_lookup", None)
+        if lookup is None or lookup[0] is not self.site_ids or \
+                lookup[1] != len(self.site_ids):
+            # Site ids changed outside of this method: rebuild the lookup
+            positions = {}
+            for i, site_id in enumerate(self.site_ids):
+                positions.setdefault(site_id, i)
+            lookup = [self.site_ids, len(self.site_ids), positions]
+            self._site_lookup = lookup
+        positions = lookup[2]
+        if str_id not in positions:
+            positions[str_id] = len(self.site_ids)
             self.site_ids.append(str_id)
-        _id = np.argwhere(str_id == np.array(self.site_ids))[0]
-        return _id[0]
+            lookup[1] += 1
+        return positions[str_id]
 
     def get_site_collection(self, missing_vs30=None):
         """
@@ -1236,15 +1898,482 @@ class GroundMotionDatabase(ContextDB):
                                for rec in self.records])
 
 
-def load_database(directory):
+def _read_observation_cache(filename, keys, mtimes):
+    """
+    Reads the observation cache file
+    :param list keys:
+        Key of each record ("<record id>|<record file>")
+    :param numpy.ndarray mtimes:
+        Modification time of each record file (ns)
+    :returns:
+        Boolean array flagging the records with valid values in the cache
+        and dictionary of the values of each imt in the cache
+    """
+    with h5py.File(filename, "r") as fle:
+        rows = dict((key.decode("utf-8"), i)
+                    for i, key in enumerate(fle["keys"][:]))
+        rows = np.array([rows.get(key, -1) for key in keys], dtype=np.int64)
+        valid = rows >= 0
+        rows[np.logical_not(valid)] = 0
+        if len(rows):
+            valid &= fle["mtimes"][:][rows] == mtimes
+        columns = dict((imtx, fle["values/" + imtx][:][rows])
+                       for imtx in fle["values"])
+    return valid, columns
+
+
+def _write_observation_cache(filename, keys, mtimes, columns):
+    """
+    Writes the observation cache file, replacing any previous one
+    """
+    tmp_filename = filename + ".tmp"
+    with h5py.File(tmp_filename, "w") as fle:
+        fle.create_dataset("keys", data=np.array(
+            [key.encode("utf-8") for key in keys], dtype=bytes))
+        fle.create_dataset("mtimes", data=mtimes)
+        grp = fle.create_group("values")
+        for imtx, values in columns.items():
+            grp.create_dataset(imtx, data=values)
+    os.replace(tmp_filename, filename)
+
+
+class IMStore(object):
+    """
+    Consolidated store of the intensity measures of the records of a
+    database, as a single hdf5 file with the vectors
+    "scalar/<component>/<IM>" (one value per record) and the matrices
+    "spectra/<component>/damping_XX" (records x periods), aligned with the
+    "record_id" index. The values of an IMT for all records are loaded with
+    one read
+    :param str filename:
+        Path to the store
+    :param list record_ids:
+        Ids of the records (rows of the store)
+    :param numpy.ndarray periods:
+        Periods of the spectra
+    :param dict scalars:
+        Names of the scalar IMs of each component
+    :param dict spectra:
+        Damping strings ("damping_XX") of the spectra of each component
+    :param numpy.ndarray mtimes:
+        Modification times of the record files when the store was built
+        (see `get_datafile_mtimes`), or None if unknown
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with h5py.File(filename, "r") as fle:
+            self.record_ids = [rec_id.decode("utf-8")
+                               for rec_id in fle["record_id"][:]]
+            self.periods = fle["periods"][:]
+            self.mtimes = fle["mtimes"][:] if "mtimes" in fle else None
+            self.scalars = dict((comp, list(fle["scalar"][comp]))
+                                for comp in fle.get("scalar", {}))
+            self.spectra = dict((comp, list(fle["spectra"][comp]))
+                                for comp in fle.get("spectra", {}))
+        self._index = dict((rec_id, i)
+                           for i, rec_id in enumerate(self.record_ids))
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def get_indices(self, record_ids):
+        """
+        Returns the rows of the given records, or None if any of them is not
+        in the store
+        """
+        indices = [self._index.get(rec_id) for rec_id in record_ids]
+        if any([idx is None for idx in indices]):
+            return None
+        return np.array(indices, dtype=np.int64)
+
+    def has_imts(self, imts, component="Geometric", damping="05"):
+        """
+        Returns True if the store holds all the given imts for the component
+        """
+        for imtx in imts:
+            if "SA(" in imtx:
+                if ("damping_" + damping) not in\
+                        self.spectra.get(component, []):
+                    return False
+            elif imtx not in self.scalars.get(component, []):
+                return False
+        return True
+
+    def get_observation_matrix(self, imts, indices, component="Geometric",
+                               damping="05"):
+        """
+        Returns the values of the given imts for the given rows, as numpy
+        array of shape (len(indices), len(imts)). Spectral accelerations are
+        interpolated from the spectra
+        """
+        values = np.zeros([len(indices), len(imts)])
+        spectral, periods = [], []
+        with h5py.File(self.filename, "r") as fle:
+            for i, imtx in enumerate(imts):
+                if "SA(" in imtx:
+                    spectral.append(i)
+                    periods.append(imt.from_string(imtx).period)
+                else:
+                    values[:, i] = fle["scalar/%s/%s" %
+                                       (component, imtx)][:][indices]
+            if spectral:
+                spectra = fle["spectra/%s/damping_%s" %
+                              (component, damping)][:][indices]
+                values[:, spectral] = utils.get_interpolated_periods(
+                    periods, self.periods, spectra.T).T
+        return values
+
+
+def get_datafile_mtimes(records):
+    """
+    Returns the modification times (ns) of the files of the records, as
+    numpy array, with -1 for the records without a file
+    """
+    return np.array([os.stat(record.datafile).st_mtime_ns
+                     if record.datafile and os.path.exists(record.datafile)
+                     else -1 for record in records], dtype=np.int64)
+
+
+def write_im_store(filename, record_ids, periods, scalars, spectra,
+                   layout=None, mtimes=None):
+    """
+    Writes the consolidated IM store of a database (see :class:`IMStore`),
+    replacing any previous one
+    :param list record_ids:
+        Ids of the records
+    :param numpy.ndarray periods:
+        Periods of the spectra
+    :param dict scalars:
+        For each component, dictionary of the tuples (values, units) of each
+        scalar IM (one value per record, nan if missing)
+    :param dict spectra:
+        For each component, dictionary of the spectra matrix (records x
+        periods, in cm/s/s) of each damping string (e.g. "05")
+    :param layout:
+        Storage layout of the datasets, as instance of :class:
+        smtk.sm_utils.HDF5Layout
+    :param numpy.ndarray mtimes:
+        Modification times of the record files (see `get_datafile_mtimes`,
+        default -1 for all records: no record files)
+    """
+    layout = layout if layout is not None else utils.DEFAULT_HDF5_LAYOUT
+    if mtimes is None:
+        mtimes = np.full(len(record_ids), -1, dtype=np.int64)
+    tmp_filename = filename + ".tmp"
+    with h5py.File(tmp_filename, "w") as fle:
+        fle.create_dataset("record_id", data=np.array(
+            [rec_id.encode("utf-8") for rec_id in record_ids],
+            dtype="S%d" % max([len(rec_id.encode("utf-8"))
+                               for rec_id in record_ids] + [1])))
+        fle.create_dataset("mtimes", data=np.asarray(mtimes, dtype=np.int64))
+        per_dset = fle.create_dataset("periods", data=np.asarray(periods,
+                                                                 dtype=float))
+        per_dset.attrs["Number Periods"] = len(periods)
+        scalar_grp = fle.create_group("scalar")
+        for component in scalars:
+            comp_grp = scalar_grp.create_group(component)
+            for i_m, (values, units) in scalars[component].items():
+                dset = layout.create_dataset(comp_grp, i_m, (len(record_ids),))
+                if units:
+                    dset.attrs["Units"] = units
+                dset[:] = values
+        spectra_grp = fle.create_group("spectra")
+        for component in spectra:
+            comp_grp = spectra_grp.create_group(component)
+            for damping, values in spectra[component].items():
+                dset = layout.create_dataset(comp_grp,
+                                             "damping_%s" % damping,
+                                             np.shape(values))
+                dset.attrs["Units"] = "cm/s/s"
+                dset[:] = values
+    os.replace(tmp_filename, filename)
+
+
+def get_horizontal_scalars(scalars, component):
+    """
+    Returns the dictionary of the scalar IMs of a horizontal component, from
+    the dictionary of the "H" scalars or of the "X" and "Y" ones (combined
+    as in `GroundMotionDatabase.get_scalars`)
+    """
+    if "H" in scalars:
+        return scalars["H"]
+    if component not in utils.SCALAR_XY:
+        return {}
+    return dict((name, utils.SCALAR_XY[component](value,
+                                                  scalars["Y"][name]))
+                for name, value in scalars.get("X", {}).items()
+                if name in scalars.get("Y", {}))
+
+
+def build_im_store(database, directory=None, components=None, damping="05",
+                   layout=None):
+    """
+    Builds the consolidated IM store of a database from its record files,
+    read in a single pass. Only the IMs found in all of the record files are
+    stored, and the spectra only if all records share the same periods, so
+    that the other queries are answered from the record files
+    :param database:
+        Strong motion database as instance of :class: GroundMotionDatabase
+    :param str directory:
+        Directory of the store (default the database directory)
+    :param list components:
+        Horizontal components (default: those of the horizontal spectra in
+        the record files, or ["Geometric"] if there are none)
+    :param str damping:
+        Damping of the spectra
+    :returns:
+        Path to the store
+    """
+    directory = directory or database.directory
+    if not directory:
+        raise ValueError("Database has no directory for the IM store")
+    records = [record for record in database.records
+               if record.datafile and os.path.exists(record.datafile)]
+    mtimes = get_datafile_mtimes(records)
+    spectra_loc = "IMS/H/Spectra/Response/Acceleration/%s/" +\
+        utils.get_damping_string(damping)
+    periods = None
+    # For each record, the scalars (per component) and spectra (per
+    # component, with their periods)
+    rows = []
+    found = OrderedDict()
+    same_periods = True
+
+    def read_record(image):
+        # Only the IMS datasets are decoded, not the time series
+        scalars, spectra = {}, {}
+        with h5py.File(io.BytesIO(image), "r") as fle:
+            if "IMS/H/Spectra/Response/Acceleration" in fle:
+                for component in fle["IMS/H/Spectra/Response/Acceleration"]:
+                    if (spectra_loc % component) in fle:
+                        spectra[component] = (
+                            fle["IMS/H/Spectra/Response/Periods"][:],
+                            fle[spectra_loc % component][:])
+            # Horizontal scalars, or those of the X and Y components
+            keys = [] if "IMS" not in fle else\
+                (["H"] if "H" in fle["IMS"] else ["X", "Y"])
+            for key in keys:
+                loc = "IMS/%s/Scalar" % key
+                names = utils.get_scalar_names(fle[loc]) if loc in fle else []
+                scalars[key] = dict(zip(
+                    names, utils.get_scalar_ims(fle[loc], names)))
+        return scalars, spectra
+
+    # The bytes of the record files are read by a pool of threads ahead of
+    # their decoding (h5py serialises all its calls)
+    images = utils.iter_prefetched(
+        utils.read_file, [record.datafile for record in records],
+        database.io_workers)
+    for scalars, spectra in map(read_record, images):
+        found.update((component, True) for component in spectra)
+        rows.append((scalars, spectra))
+        for rec_periods, _ in spectra.values():
+            if periods is None:
+                periods = rec_periods
+            elif len(rec_periods) != len(periods) or\
+                    not np.allclose(rec_periods, periods):
+                # Spectra on different periods: not stored
+                same_periods = False
+    if components is None:
+        components = list(found) or ["Geometric"]
+    if not same_periods:
+        warnings.warn("Records with different periods - spectra not stored")
+    nrecs = len(records)
+    scalar_values, spectra_values = {}, {}
+    for component in components:
+        values = [get_horizontal_scalars(scalars, component)
+                  for scalars, _ in rows]
+        # IMs of all of the records
+        names = [name for name in (values[0] if values else [])
+                 if all([name in rec_values for rec_values in values])]
+        scalar_values[component] = OrderedDict(
+            (name, (np.array([rec_values[name] for rec_values in values],
+                             dtype=float), None))
+            for name in names)
+        if not same_periods or periods is None or\
+                not all([component in spectra for _, spectra in rows]):
+            continue
+        spectra_values[component] = {damping: np.array(
+            [spectra[component][1] for _, spectra in rows], dtype=float)}
+    filename = os.path.join(directory, IM_STORE)
+    write_im_store(filename, [record.id for record in records],
+                   periods if periods is not None else [], scalar_values,
+                   spectra_values, layout, mtimes)
+    return filename
+
+
+def save_database(database, directory, metadata_format="pkl"):
+    """
+    Wrapper function to store the metadata of a :class:`GroundMotionDatabase`
+    to a file of the given type
+    :param database:
+        Database as instance of :class:`GroundMotionDatabase`
+    :param str directory:
+        Path to the database directory
+    :param str metadata_format:
+        Format of the metadata file, one of "hdf5" (columnar binary),
+        "pkl" or "json"
+    :returns:
+        Path to the metadata file
+    """
+    if metadata_format not in METADATA_FORMATS:
+        raise ValueError("Metadata filetype %s not supported"
+                         % metadata_format)
+    metadata_path = os.path.join(directory,
+                                 "metadatafile.%s" % metadata_format)
+    if database.directory is None:
+        database.directory = directory
+    # Written to a temporary file first, so that the existing metadata are
+    # replaced only once the new file is complete
+    tmp_path = metadata_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    if metadata_format == "hdf5":
+        database.to_columnar(tmp_path)
+    elif metadata_format == "json":
+        with open(tmp_path, "w") as f:
+            f.write(database.to_json())
+    else:
+        with open(tmp_path, "wb+") as f:
+            pickle.dump(database, f)
+    os.replace(tmp_path, metadata_path)
+    return metadata_path
+
+
+def get_shard(event_id, nshards):
+    """
+    Returns the shard (integer in [0, nshards)) of the records of the given
+    event. The shard is a stable hash (crc32) of the event id, the same on
+    every machine and Python session
+    """
+    return zlib.crc32(str(event_id).encode("utf-8")) % nshards
+
+
+def split_database(database, nshards):
+    """
+    Splits the database by event into `nshards` databases (all the records
+    of an event belong to the same shard)
+    :param database:
+        Database as instance of :class:`GroundMotionDatabase`
+    :param int nshards:
+        Number of shards
+    :returns:
+        List of :class:`GroundMotionDatabase`, one per shard
+    """
+    if nshards < 1:
+        raise ValueError("Number of shards must be positive (%s)" % nshards)
+    records = [[] for _ in range(nshards)]
+    for evt_id, indices in database.event_index.groups():
+        records[get_shard(evt_id, nshards)].extend(indices)
+    shards = []
+    for ishard, indices in enumerate(records):
+        shard = GroundMotionDatabase(database.id, database.name,
+                                     records=database.get_records(
+                                         np.sort(indices)))
+        site_ids = set(rec.site.id for rec in shard.records)
+        shard.site_ids = [site_id for site_id in database.site_ids
+                          if site_id in site_ids]
+        shards.append(shard)
+    return shards
+
+
+def save_sharded_database(database, directory, nshards,
+                          metadata_format="pkl"):
+    """
+    Stores the database as `nshards` databases partitioned by event (see
+    :func:`get_shard`), each in its own directory inside `directory`,
+    together with a manifest of the shards
+    :param database:
+        Database as instance of :class:`GroundMotionDatabase`
+    :param str directory:
+        Path to the sharded database directory
+    :param int nshards:
+        Number of shards
+    :param str metadata_format:
+        Format of the metadata file of each shard (see :func:`save_database`)
+    :returns:
+        Path to the manifest file
+    """
+    manifest = {"id": database.id,
+                "name": database.name,
+                "hash": "crc32",
+                "metadata_format": metadata_format,
+                "shards": []}
+    for ishard, shard in enumerate(split_database(database, nshards)):
+        shard_directory = os.path.join(directory, SHARD_DIRECTORY % ishard)
+        if not os.path.exists(shard_directory):
+            os.makedirs(shard_directory)
+        shard.directory = shard_directory
+        save_database(shard, shard_directory, metadata_format)
+        manifest["shards"].append({
+            "directory": SHARD_DIRECTORY % ishard,
+            "records": len(shard),
+            "events": len(shard.event_index)})
+    manifest_path = os.path.join(directory, SHARD_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest_path
+
+
+def load_manifest(directory):
+    """
+    Returns the manifest of a sharded database as dictionary, or None if the
+    database in `directory` is not sharded
+    """
+    manifest_path = os.path.join(directory, SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def iter_shards(directory):
+    """
+    Yields the databases of the shards of a sharded database, loading each
+    shard only when requested. A non-sharded database is yielded as a single
+    shard
+    """
+    manifest = load_manifest(directory)
+    if manifest is None:
+        yield load_database(directory)
+        return
+    for ishard in range(len(manifest["shards"])):
+        yield load_database(directory, ishard)
+
+
+def load_database(directory, shard=None):
     """
     Wrapper function to load the metadata of a :class:`GroundMotionDatabase`
-    according to the filetype
+    according to the filetype. If the database is sharded (see
+    :func:`save_sharded_database`) all the shards are loaded into a single
+    database, unless a `shard` index is given
     """
+    manifest = load_manifest(directory)
+    if manifest is not None:
+        if shard is not None:
+            if not 0 <= shard < len(manifest["shards"]):
+                raise ValueError("Shard %s not in database %s (%s shards)"
+                                 % (shard, directory,
+                                    len(manifest["shards"])))
+            return load_database(os.path.join(
+                directory, manifest["shards"][shard]["directory"]))
+        database = GroundMotionDatabase(manifest["id"], manifest["name"],
+                                        directory)
+        records = []
+        for shard_database in iter_shards(directory):
+            records.extend(shard_database.records)
+            # Sites may be shared by several shards
+            for site_id in shard_database.site_ids:
+                database._get_site_id(site_id)
+        database.records = records
+        return database
+    elif shard is not None:
+        raise ValueError("Database %s is not sharded" % directory)
     metadata_file = None
     filetype = None
     fileset = os.listdir(directory)
-    for ftype in ["pkl", "json"]:
+    for ftype in METADATA_FORMATS:
         if ("metadatafile.%s" % ftype) in fileset:
             metadata_file = "metadatafile.%s" % ftype
             filetype = ftype
@@ -1254,12 +2383,18 @@ def load_database(directory):
             "Expected metadata file of supported type not found in %s"
             % directory)
     metadata_path = os.path.join(directory, metadata_file)
-    if filetype == "json":
+    if filetype == "hdf5":
+        # columnar binary metadata filetype
+        database = GroundMotionDatabase.from_columnar(metadata_path)
+    elif filetype == "json":
         # json metadata filetype
-        return GroundMotionDatabase.from_json(metadata_path)
+        database = GroundMotionDatabase.from_json(metadata_path)
     elif filetype == "pkl":
         # pkl file type
         with open(metadata_path, "rb") as f:
-            return pickle.load(f)
+            database = pickle.load(f)
     else:
         raise ValueError("Metadata filetype %s not supported" % ftype)
+    if database.directory is None:
+        database.directory = directory
+    return database
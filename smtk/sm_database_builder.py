@@ -25,11 +25,21 @@ import os
 import sys
 import re
 import csv
+import json
+import copy
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import h5py
 import smtk.intensity_measures as ims
 import smtk.sm_utils as utils
-from smtk.parsers.base_database_parser import get_float
+from smtk.parsers.base_database_parser import get_float, MetadataInterner
+from smtk.sm_database import save_database, save_sharded_database, \
+    get_shard, load_database, build_im_store, write_im_store, \
+    get_datafile_mtimes, \
+    SHARD_DIRECTORY, SHARD_MANIFEST, IM_STORE
+from smtk.sm_timeseries_store import pack_time_series
 
 if sys.version_info[0] >= 3:
     # In Python 3 pickle uses cPickle by default
@@ -41,6 +51,35 @@ else:
 
 SCALAR_LIST = ["PGA", "PGV", "PGD", "CAV", "CAV5", "Ia", "D5-95", "Housner"]
 
+# Manifest of the hashes of the source data of each record of a database
+SOURCE_MANIFEST = "sources.json"
+
+
+# Builder and parsers of the worker processes of `parse_records`
+_PARSE_WORKER = None
+
+
+def _init_parse_worker(builder, time_series_parser, spectra_parser, units,
+                       skip_failed=False):
+    """
+    Initialises a worker process of `SMDatabaseBuilder.parse_records`
+    """
+    global _PARSE_WORKER
+    _PARSE_WORKER = (builder, time_series_parser, spectra_parser, units,
+                     skip_failed)
+
+
+def _parse_record_job(job):
+    """
+    Parses the record of a tuple (record, output directory) in a worker
+    process of `SMDatabaseBuilder.parse_records`
+    """
+    builder, time_series_parser, spectra_parser, units, skip_failed =\
+        _PARSE_WORKER
+    record, output_dir = job
+    return builder._parse_record(record, time_series_parser, spectra_parser,
+                                 units, output_dir, skip_failed)
+
 
 def _get_fieldnames_from_csv(reader):
     """
@@ -76,6 +115,22 @@ class SMDatabaseBuilder(object):
         Parser for spectra files, as instance of :class: SMSpectraReader
     :param str metafile:
         Path to output metadata file
+    :param str metadata_format:
+        Format of the output metadata file: "pkl" (default), "json" or
+        "hdf5" (columnar binary, see :mod:`smtk.sm_columnar`)
+    :param int shards:
+        Number of shards of the database (default None: not sharded). The
+        records are partitioned by event into shard directories, each with
+        its own metadata file and records (see
+        :func:`smtk.sm_database.save_sharded_database`)
+    :param bool update:
+        If True, an existing database in the target directory is updated:
+        only the records that are new, or whose source files changed, are
+        parsed (see `SOURCE_MANIFEST`)
+    :param layout:
+        Storage layout (chunking, compression, compound scalars) of the
+        record hdf5 files, as instance of :class: smtk.sm_utils.HDF5Layout
+        (default: contiguous uncompressed datasets)
     """
     TS_ATTRIBUTE_LIST = ["Year", "Month", "Day", "Hour", "Minute", "Second",
                          "Station Code", "Station Name", "Orientation",
@@ -86,7 +141,8 @@ class SMDatabaseBuilder(object):
 
     SPECTRA_LIST = ["Acceleration", "Velocity", "Displacement", "PSA", "PSV"]
 
-    def __init__(self, dbtype, db_location):
+    def __init__(self, dbtype, db_location, metadata_format="pkl",
+                 shards=None, update=False, layout=None):
         """
         Instantiation will create target database directory
 
@@ -95,21 +151,43 @@ class SMDatabaseBuilder(object):
                 smtk.parsers.base_database_parser.SMDatabaseReader
         :param str db_location:
             Path to database to be written
+        :param str metadata_format:
+            Format of the metadata file
+        :param int shards:
+            Number of shards (default None: not sharded)
+        :param bool update:
+            Update the database if the directory exists (default False:
+            raise IOError)
+        :param layout:
+            Storage layout of the record hdf5 files
         """
+        if shards is not None and shards < 1:
+            raise ValueError("Number of shards must be positive (%s)"
+                             % shards)
         self.dbtype = dbtype
         self.dbreader = None
-        if os.path.exists(db_location):
+        self.update = update and os.path.exists(db_location)
+        if os.path.exists(db_location) and not self.update:
             raise IOError("Target database directory %s already exists!"
                           % db_location)
         self.location = db_location
-        os.mkdir(self.location)
+        if not self.update:
+            os.mkdir(self.location)
         self.database = None
         self.time_series_parser = None
         self.spectra_parser = None
         self.metafile = None
+        self.metadata_format = metadata_format
+        self.shards = shards
+        self.layout = layout if layout is not None else\
+            utils.DEFAULT_HDF5_LAYOUT
+        # Hashes of the source data of the records (see SOURCE_MANIFEST)
+        self.sources = self._load_sources() if self.update else {}
+        # Ids of the records of the existing database kept as they are
+        self.retained = set()
 
     def build_database(self, db_id, db_name, metadata_location,
-                       record_location=None):
+                       record_location=None, record_filter=None):
         """
         Constructs the metadata database and exports to a .pkl file
         :param str db_id:
@@ -120,19 +198,32 @@ class SMDatabaseBuilder(object):
             Path to location of metadata
         :param str record_directory:
             Path to directory containing records (if different from metadata)
+        :param record_filter:
+            Function taking a record and returning True if the record is to
+            be kept in the database (default all records). It is applied
+            while the records are read, so rejected records are not retained
         """
         self.dbreader = self.dbtype(db_id, db_name, metadata_location,
                                     record_location)
-        # Build database
+        # Build database, adding the records as they are read
         print("Reading database ...")
-        self.database = self.dbreader.parse()
-        self.metafile = os.path.join(self.location, "metadatafile.pkl")
+        for record in self.dbreader.iter_records():
+            if record_filter is None or record_filter(record):
+                self.dbreader.database.records.append(record)
+        self.database = self.dbreader.database
+        if self.update:
+            self._merge_existing_database()
+        if self.shards:
+            self.metafile = os.path.join(self.location, SHARD_MANIFEST)
+        else:
+            self.metafile = os.path.join(self.location, "metadatafile.%s"
+                                         % self.metadata_format)
         print("Storing metadata to file %s" % self.metafile)
-        with open(self.metafile, "wb+") as f:
-            pickle.dump(self.database, f)
+        self._save_database()
 
     def parse_records(self, time_series_parser, spectra_parser=None,
-                      units="cm/s/s"):
+                      units="cm/s/s", workers=None, im_store=False,
+                      skip_failed=False):
         """
         Parses the strong motion records to hdf5
         :param time_series_parser:
@@ -143,15 +234,99 @@ class SMDatabaseBuilder(object):
             smtk.parsers.base_database_parser.SMSpectraReader
         :param str units:
             Units of the records
+        :param int workers:
+            Number of processes parsing and writing the records (default
+            None: all records are parsed sequentially in this process).
+            The results are collected in the order of the records and the
+            metadata is written once, at the end
+        :param bool im_store:
+            If True the consolidated IM store of the database is built
+            (an existing one is always rebuilt, so that it is not outdated)
+        :param bool skip_failed:
+            If True the records failing to parse are reported and left out
+            of the database, otherwise (default) the error is raised
         """
-        record_dir = os.path.join(self.location, "records")
-        os.mkdir(record_dir)
-        print("Creating repository for strong motion hdf5 records ... %s"
-              % record_dir)
+        record_dir = self._make_record_directories()
         nrecords = self.database.number_records()
-        valid_records = []
+        # Records to parse, as tuples (position, record, source hash,
+        # output directory)
+        jobs = []
+        kept = {}
         for iloc, record in enumerate(self.database.records):
-            print("Processing record %s of %s" % (iloc, nrecords))
+            source_hash = None
+            if record.id not in self.retained:
+                source_hash = self._get_source_hash(record)
+            if record.id in self.retained or\
+                    self._is_unchanged(record, source_hash):
+                # Record of the existing database - nothing to do
+                kept[iloc] = record
+                continue
+            output_dir = self._get_record_directory(record, record_dir)
+            self._remove_outdated(os.path.join(output_dir,
+                                               record.id + ".hdf5"))
+            jobs.append((iloc, record, source_hash, output_dir))
+        results = self._run_parse_jobs(
+            [(record, output_dir) for _, record, _, output_dir in jobs],
+            time_series_parser, spectra_parser, units, workers, skip_failed)
+        failed = []
+        for (iloc, record, source_hash, _), (output_file, error) in\
+                zip(jobs, results):
+            if error:
+                print("Record %s failed: %s" % (record.id, error))
+                failed.append(record.id)
+            elif output_file:
+                record.datafile = output_file
+                self.sources[record.id] = source_hash
+                kept[iloc] = record
+        self.database.records = [kept[iloc] for iloc in sorted(kept)]
+        if failed:
+            print("%s of %s records failed: %s" % (len(failed), nrecords,
+                                                   ", ".join(failed)))
+        print("Updating metadata file")
+        self._save_database()
+        self._update_im_store(im_store)
+        print("Done!")
+
+    def _run_parse_jobs(self, jobs, time_series_parser, spectra_parser,
+                        units, workers=None, skip_failed=False):
+        """
+        Parses the records of a list of tuples (record, output directory),
+        sequentially or in a pool of processes, and returns the list of
+        the results of `_parse_record` in the order of the jobs
+        """
+        if not workers or workers <= 1 or len(jobs) < 2:
+            results = []
+            for iloc, (record, output_dir) in enumerate(jobs):
+                print("Processing record %s of %s" % (iloc, len(jobs)))
+                results.append(self._parse_record(record, time_series_parser,
+                                                  spectra_parser, units,
+                                                  output_dir, skip_failed))
+            return results
+        # The workers get a copy of the builder and of its reader without
+        # the database (each job carries its own record)
+        worker = copy.copy(self)
+        worker.database = None
+        worker.sources = {}
+        worker.retained = set()
+        worker.dbreader = copy.copy(self.dbreader)
+        worker.dbreader.database = None
+        worker.dbreader.interner = MetadataInterner()
+        print("Processing %s records with %s workers" % (len(jobs), workers))
+        with ProcessPoolExecutor(
+                workers, initializer=_init_parse_worker,
+                initargs=(worker, time_series_parser, spectra_parser,
+                          units, skip_failed)) as executor:
+            return list(executor.map(_parse_record_job, jobs))
+
+    def _parse_record(self, record, time_series_parser, spectra_parser,
+                      units, output_dir, skip_failed=False):
+        """
+        Parses a record to a hdf5 file of the output directory. Returns the
+        tuple (path to the file, error message), with path None if the
+        record is skipped and error message None unless it failed. The
+        errors are raised unless `skip_failed` is True
+        """
+        try:
             has_spectra = isinstance(record.spectra_file, list) and\
                 (spectra_parser is not None)
             # Parse strong motion record
@@ -160,107 +335,314 @@ class SMDatabaseBuilder(object):
                                            units)
             if len(sm_parser.input_files) < 2:
                 print("Record contains < 2 components - skipping!")
-                continue
+                return None, None
             sm_data = sm_parser.parse_records(record)
             if not sm_data.get("X", {}).get("Original", {}):
                 print('No processed records - skipping')
-                continue
+                return None, None
 
             # Create hdf file and parse time series data
             fle, output_file = self.build_time_series_hdf5(record, sm_data,
-                                                           record_dir)
-
-            if has_spectra:
-                # Parse spectra data
-                spec_parser = spectra_parser(record.spectra_file,
-                                             self.dbreader.filename)
-                spec_data = spec_parser.parse_spectra()
-                fle = self.build_spectra_hdf5(fle, spec_data)
-            else:
-                # Build the data structure for IMS
-                self._build_hdf5_structure(fle, sm_data)
-            fle.close()
-            print("Record %s written to output file %s" % (record.id,
-                                                           output_file))
-            record.datafile = output_file
-            valid_records.append(record)
-        self.database.records = valid_records
-        print("Updating metadata file")
-        os.remove(self.metafile)
-        with open(self.metafile, "wb+") as f:
-            pickle.dump(self.database, f)
-        print("Done!")
+                                                           output_dir)
+            try:
+                if has_spectra:
+                    # Parse spectra data
+                    spec_parser = spectra_parser(record.spectra_file,
+                                                 self.dbreader.filename)
+                    spec_data = spec_parser.parse_spectra()
+                    fle = self.build_spectra_hdf5(fle, spec_data)
+                else:
+                    # Build the data structure for IMS
+                    self._build_hdf5_structure(fle, sm_data)
+            finally:
+                fle.close()
+        except Exception as err:
+            # Do not leave a partial file behind
+            partial_file = os.path.join(output_dir, record.id + ".hdf5")
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
+            if not skip_failed:
+                raise
+            return None, "%s: %s" % (err.__class__.__name__, str(err))
+        print("Record %s written to output file %s" % (record.id,
+                                                       output_file))
+        return output_file, None
 
     def build_spectra_from_flatfile(self, component, damping="05",
-                                    units="cm/s/s"):
+                                    units="cm/s/s", consolidated=False):
         """
         In the case in which the spectra data is defined in the
-        flatfile we construct the hdf5 from this information
+        flatfile we construct the hdf5 from this information. All the rows
+        are parsed first into a (records x periods) matrix of spectra and a
+        (records x IMs) matrix of scalars, then written in one sweep
         :param str component:
             Component to which the horizontal (or vertical!) records refer
         :param str damping"
             Percent damping
+        :param bool consolidated:
+            If True the spectra and scalars of all records are written to
+            the consolidated IM store of the database directory
+            (`smtk.sm_database.IM_STORE`) rather than to a file per record.
+            The records then have no record file, so every observation must
+            be found in the store (ValueError otherwise), and the whole store
+            is rewritten even when updating the database
         """
 
         # Flatfile name should be stored in database parser
         # Get header
 
-        reader = csv.DictReader(open(self.dbreader.filename, "r"))
-        # Fieldnames
-        scalar_fieldnames, spectra_fieldnames, periods =\
-            _get_fieldnames_from_csv(reader)
-        # Setup records folder
-        record_dir = os.path.join(self.location, "records")
-        os.mkdir(record_dir)
-        print("Creating repository for strong motion hdf5 records ... %s"
-              % record_dir)
-        valid_idset = [rec.id for rec in self.database.records]
-        for i, row in enumerate(reader):
-            # Build database file
-            # Waveform ID
-            if not row["Record Sequence Number"] in valid_idset:
-                # The record being passed has already been flagged as bad
-                # skipping
-                continue
-            idx = valid_idset.index(row["Record Sequence Number"])
-            wfid = self.database.records[idx].id
-            output_file = os.path.join(record_dir, wfid + ".hdf5")
-            self._build_spectra_hdf5_from_row(output_file, row, periods,
-                                              scalar_fieldnames,
-                                              spectra_fieldnames,
-                                              component, damping, units)
-            self.database.records[idx].datafile = output_file
-            if (i % 100) == 0:
-                print("Record %g written" % i)
+        with open(self.dbreader.filename, "r") as f:
+            reader = csv.DictReader(f)
+            # Fieldnames
+            scalar_fieldnames, spectra_fieldnames, periods =\
+                _get_fieldnames_from_csv(reader)
+            record_index = dict((rec.id, i)
+                                for i, rec in enumerate(self.database.records))
+            indices, source_hashes, scalar_rows, spectra_rows = [], [], [], []
+            for row in reader:
+                # Waveform ID
+                idx = record_index.get(row["Record Sequence Number"])
+                if idx is None:
+                    # The record being passed has already been flagged as
+                    # bad skipping
+                    continue
+                source_hash = hashlib.sha1(
+                    "\x1f".join(row[key] or "" for key in reader.fieldnames)
+                    .encode("utf-8")).hexdigest()
+                if not consolidated and\
+                        self._is_unchanged(self.database.records[idx],
+                                           source_hash):
+                    continue
+                indices.append(idx)
+                source_hashes.append(source_hash)
+                scalar_rows.append([get_float(row[f_attr])
+                                    for f_attr, _ in scalar_fieldnames])
+                spectra_rows.append([get_float(row[f_attr])
+                                     for f_attr in spectra_fieldnames])
+        # Unit conversion by columns (missing values are nan)
+        scalars = np.array(scalar_rows, dtype=float).reshape(
+            len(indices), len(scalar_fieldnames))
+        scalar_units = []
+        for j, (f_attr, imt) in enumerate(scalar_fieldnames):
+            input_units = re.search(r'\((.*?)\)', f_attr).group(1)
+            if imt == "PGA":
+                # Convert acceleration from reported units to cm/s/s
+                scalars[:, j] = utils.convert_accel_units(scalars[:, j],
+                                                          input_units)
+                scalar_units.append("cm/s/s")
+            else:
+                # For other values take direct from spreadsheet
+                # Units should be given in parenthesis from fieldname
+                scalar_units.append(input_units)
+        spectra = utils.convert_accel_units(
+            np.array(spectra_rows, dtype=float).reshape(len(indices),
+                                                        len(periods)),
+            units)
+        scalar_names = [imt for _, imt in scalar_fieldnames]
+        if consolidated:
+            write_im_store(
+                os.path.join(self.location, IM_STORE),
+                [self.database.records[idx].id for idx in indices], periods,
+                {component: OrderedDict(
+                    (name, (scalars[:, j], scalar_units[j]))
+                    for j, name in enumerate(scalar_names))},
+                {component: {damping: spectra}}, self.layout,
+                get_datafile_mtimes([self.database.records[idx]
+                                     for idx in indices]))
+        else:
+            record_dir = self._make_record_directories()
+            for i, idx in enumerate(indices):
+                record = self.database.records[idx]
+                output_file = os.path.join(
+                    self._get_record_directory(record, record_dir),
+                    record.id + ".hdf5")
+                self._remove_outdated(output_file)
+                self._build_spectra_hdf5_from_row(
+                    output_file, periods,
+                    [(name, scalars[i, j], {"Component": component,
+                                            "Units": scalar_units[j]})
+                     for j, name in enumerate(scalar_names)],
+                    spectra[i, :], component, damping)
+                record.datafile = output_file
+                self.sources[record.id] = source_hashes[i]
+                if (i % 100) == 0:
+                    print("Record %g written" % i)
         print("Updating metadata file")
-        os.remove(self.metafile)
-        with open(self.metafile, "wb+") as f:
-            pickle.dump(self.database, f)
+        self._save_database()
+        if not consolidated:
+            self._update_im_store()
         print("Done!")
 
-    def _build_spectra_hdf5_from_row(self, output_file, row, periods,
-                                     scalar_fields, spectra_fields, component,
-                                     damping, units):
+    def build_im_store(self, components=None, damping="05"):
+        """
+        Builds the consolidated IM store of the database from the record
+        files (see :class:`smtk.sm_database.IMStore`), so that
+        `GroundMotionDatabase.get_observation_matrix` loads each IMT of all
+        records with one read
+        :returns:
+            Path to the store
+        """
+        return build_im_store(self.database, self.location, components,
+                              damping, self.layout)
+
+    def _update_im_store(self, required=False):
+        """
+        Builds the IM store if required or if the database already has one
+        """
+        if required or os.path.exists(os.path.join(self.location, IM_STORE)):
+            self.build_im_store()
+
+    def pack_time_series(self, directory=None, components=("X", "Y", "V")):
+        """
+        Builds the packed store of the acceleration time series of the
+        records (see :mod:`smtk.sm_timeseries_store`)
+        :param str directory:
+            Path to the store (default: "time_series" in the database
+            directory)
+        :returns:
+            The store as instance of :class:
+            smtk.sm_timeseries_store.PackedTimeSeriesStore
+        """
+        if directory is None:
+            directory = os.path.join(self.location, "time_series")
+        print("Packing time series to %s" % directory)
+        return pack_time_series(self.database, directory, components)
+
+    def _save_database(self):
+        """
+        Stores the metadata of the database (of each shard, if sharded) and
+        the manifest of the record sources
+        """
+        if self.shards:
+            save_sharded_database(self.database, self.location, self.shards,
+                                  self.metadata_format)
+        else:
+            save_database(self.database, self.location, self.metadata_format)
+        record_ids = set(rec.id for rec in self.database.records)
+        sources = dict((key, value) for key, value in self.sources.items()
+                       if key in record_ids and value is not None)
+        _write_file(os.path.join(self.location, SOURCE_MANIFEST),
+                    json.dumps(sources, indent=0, sort_keys=True)
+                    .encode("utf-8"))
+
+    def _load_sources(self):
+        """
+        Returns the hashes of the record sources of the existing database
+        """
+        filename = os.path.join(self.location, SOURCE_MANIFEST)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename, "r") as f:
+            return json.load(f)
+
+    def _merge_existing_database(self):
+        """
+        Merges the records of the database being built with those of the
+        existing database: records in both keep the data file of the
+        existing one (rebuilt only if their source changed), records only
+        in the existing database are retained as they are
+        """
+        try:
+            existing = load_database(self.location)
+        except IOError:
+            # No metadata stored yet
+            return
+        records = OrderedDict((rec.id, rec) for rec in existing.records)
+        new_records = []
+        for record in self.database.records:
+            if record.id in records:
+                record.datafile = records[record.id].datafile
+                records[record.id] = record
+            else:
+                new_records.append(record)
+        self.retained = set(rec.id for rec in existing.records) -\
+            set(rec.id for rec in self.database.records)
+        print("Updating database: %s existing records, %s new records"
+              % (len(records), len(new_records)))
+        self.database.records = list(records.values()) + new_records
+
+    def _get_source_hash(self, record):
+        """
+        Returns the hash (sha1) of the time series and spectra files of the
+        record (resolved as in the time series and spectra parsers)
+        """
+        source_hash = hashlib.sha1()
+        for folder, filenames in [
+                (self.dbreader.record_folder, record.time_series_file),
+                (self.dbreader.filename, record.spectra_file)]:
+            if not isinstance(filenames, list):
+                continue
+            for fname in filenames:
+                filename = os.path.join(folder, fname) if folder else fname
+                source_hash.update(fname.encode("utf-8"))
+                if os.path.exists(filename):
+                    source_hash.update(utils.read_file(filename))
+        return source_hash.hexdigest()
+
+    def _is_unchanged(self, record, source_hash):
+        """
+        Returns True if the record, when updating a database, has already a
+        data file built from the same source
+        """
+        return self.update and source_hash is not None and\
+            self.sources.get(record.id) == source_hash and\
+            bool(record.datafile) and os.path.exists(record.datafile)
+
+    def _remove_outdated(self, filename):
+        """
+        Removes the data file of a record being rebuilt
+        """
+        if self.update and os.path.exists(filename):
+            os.remove(filename)
+
+    def _make_record_directories(self):
+        """
+        Creates the directories of the records (one per shard, if sharded)
+        and returns the records directory of the non-sharded database
+        """
+        record_dir = os.path.join(self.location, "records")
+        if not self.shards:
+            if self.update and os.path.isdir(record_dir):
+                return record_dir
+            os.mkdir(record_dir)
+            print("Creating repository for strong motion hdf5 records ... %s"
+                  % record_dir)
+            return record_dir
+        for ishard in range(self.shards):
+            shard_dir = os.path.join(self.location, SHARD_DIRECTORY % ishard,
+                                     "records")
+            if self.update and os.path.isdir(shard_dir):
+                continue
+            os.makedirs(shard_dir)
+            print("Creating repository for strong motion hdf5 records ... %s"
+                  % shard_dir)
+        return record_dir
+
+    def _get_record_directory(self, record, record_dir):
+        """
+        Returns the directory of the hdf5 file of the record: the records
+        directory of the shard of its event, if sharded
+        """
+        if not self.shards:
+            return record_dir
+        return os.path.join(self.location,
+                            SHARD_DIRECTORY % get_shard(record.event.id,
+                                                        self.shards),
+                            "records")
+
+    def _build_spectra_hdf5_from_row(self, output_file, periods, scalars,
+                                     spectra, component, damping):
+        """
+        Writes the hdf5 file of a record of the flatfile, given its list of
+        scalars (IM, value, attributes) and its spectrum (cm/s/s)
+        """
         fle = h5py.File(output_file, "w-")
         fle.create_group("Time Series")
         ims_grp = fle.create_group("IMS")
         h_grp = ims_grp.create_group("H")
         scalar_grp = h_grp.create_group("Scalar")
         # Create Scalar values
-        for f_attr, imt in scalar_fields:
-            dset = scalar_grp.create_dataset(imt, (1,), dtype="f")
-            dset.attrs["Component"] = component
-            input_units = re.search(r'\((.*?)\)', f_attr).group(1)
-            if imt == "PGA":
-                # Convert acceleration from reported units to cm/s/s
-                dset.attrs["Units"] = "cm/s/s"
-                dset[:] = utils.convert_accel_units(get_float(row[f_attr]),
-                                                    input_units)
-            else:
-                # For other values take direct from spreadsheet
-                # Units should be given in parenthesis from fieldname
-                dset.attrs["Units"] = input_units
-                dset[:] = get_float(row[f_attr])
+        self.layout.create_scalars(scalar_grp, scalars)
 
         spectra_grp = h_grp.create_group("Spectra")
         rsp_grp = spectra_grp.create_group("Response")
@@ -273,15 +655,12 @@ class SMDatabaseBuilder(object):
         per_dset.attrs["Number Periods"] = len(periods)
         per_dset[:] = periods
         # Get response spectra
-        spectra = np.array([get_float(row[f_attr])
-                            for f_attr in spectra_fields])
         acc_grp = rsp_grp.create_group("Acceleration")
         comp_grp = acc_grp.create_group(component)
-        spectra_dset = comp_grp.create_dataset("damping_{:s}".format(damping),
-                                               (len(spectra),),
-                                               dtype="f")
+        spectra_dset = self.layout.create_dataset(
+            comp_grp, utils.get_damping_string(damping), (len(spectra),))
         spectra_dset.attrs["Units"] = "cm/s/s"
-        spectra_dset[:] = utils.convert_accel_units(spectra, units)
+        spectra_dset[:] = spectra
         fle.close()
 
     def build_time_series_hdf5(self, record, sm_data, record_dir):
@@ -306,10 +685,9 @@ class SMDatabaseBuilder(object):
                 if attribute in sm_data[key]["Original"]:
                     grp_orig.attrs[attribute] =\
                         sm_data[key]["Original"][attribute]
-            ts_dset = grp_orig.create_dataset(
-                "Acceleration",
-                (sm_data[key]["Original"]["Number Steps"],),
-                dtype="f")
+            ts_dset = self.layout.create_dataset(
+                grp_orig, "Acceleration",
+                (sm_data[key]["Original"]["Number Steps"],))
             ts_dset.attrs["Units"] = "cm/s/s"
             time_step = sm_data[key]["Original"]["Time-step"]
             ts_dset.attrs["Time-step"] = time_step
@@ -328,17 +706,15 @@ class SMDatabaseBuilder(object):
                 ts_dset[:],
                 "cm/s/s")
             # Build velocity data set
-            v_dset = grp_orig.create_dataset("Velocity",
-                                             (number_steps,),
-                                             dtype="f")
+            v_dset = self.layout.create_dataset(grp_orig, "Velocity",
+                                                (number_steps,))
             v_dset.attrs["Units"] = "cm/s"
             v_dset.attrs["Time-step"] = time_step
             v_dset.attrs["Number Steps"] = number_steps
             v_dset[:] = vel
             # Build displacement data set
-            d_dset = grp_orig.create_dataset("Displacement",
-                                             (number_steps,),
-                                             dtype="f")
+            d_dset = self.layout.create_dataset(grp_orig, "Displacement",
+                                                (number_steps,))
             d_dset.attrs["Units"] = "cm"
             d_dset.attrs["Time-step"] = time_step
             d_dset.attrs["Number Steps"] = number_steps
@@ -358,16 +734,14 @@ class SMDatabaseBuilder(object):
         for key in data.keys():
             grp_comp0 = grp0.create_group(key)
             grp_scalar = grp_comp0.create_group("Scalar")
-            pga_dset = grp_scalar.create_dataset("PGA", (1,), dtype="f")
-            pga_dset.attrs["Units"] = "cm/s/s"
-            pgv_dset = grp_scalar.create_dataset("PGV", (1,), dtype="f")
-            pgv_dset.attrs["Units"] = "cm/s"
-            pgd_dset = grp_scalar.create_dataset("PGD", (1,), dtype="f")
-            pgd_dset.attrs["Units"] = "cm"
             locn = "/".join(["Time Series", key, "Original Record"])
-            pga_dset[:] = np.max(np.fabs(fle[locn + "/Acceleration"][:]))
-            pgv_dset[:] = np.max(np.fabs(fle[locn + "/Velocity"][:]))
-            pgd_dset[:] = np.max(np.fabs(fle[locn + "/Displacement"][:]))
+            self.layout.create_scalars(grp_scalar, [
+                ("PGA", np.max(np.fabs(fle[locn + "/Acceleration"][:])),
+                 {"Units": "cm/s/s"}),
+                ("PGV", np.max(np.fabs(fle[locn + "/Velocity"][:])),
+                 {"Units": "cm/s"}),
+                ("PGD", np.max(np.fabs(fle[locn + "/Displacement"][:])),
+                 {"Units": "cm"})])
 
     def build_spectra_hdf5(self, fle, data):
         """
@@ -383,14 +757,11 @@ class SMDatabaseBuilder(object):
                 continue
             grp_comp0 = grp0.create_group(key)
             grp_scalar = grp_comp0.create_group("Scalar")
-            for scalar_im in self.IMS_SCALAR_LIST:
-                if scalar_im in data[key]["Scalar"]:
-                    #print scalar_im, data[key]["Scalar"][scalar_im]
-                    dset_scalar = grp_scalar.create_dataset(scalar_im, (1,),
-                                                            dtype="f")
-                    dset_scalar.attrs["Units"] =\
-                        data[key]["Scalar"][scalar_im]["Units"]
-                    dset_scalar[:] = data[key]["Scalar"][scalar_im]["Value"]
+            self.layout.create_scalars(grp_scalar, [
+                (scalar_im, data[key]["Scalar"][scalar_im]["Value"],
+                 {"Units": data[key]["Scalar"][scalar_im]["Units"]})
+                for scalar_im in self.IMS_SCALAR_LIST
+                if scalar_im in data[key]["Scalar"]])
             grp_spectra = grp_comp0.create_group("Spectra")
             grp_four = grp_spectra.create_group("Fourier")
             grp_resp = grp_spectra.create_group("Response")
@@ -414,8 +785,8 @@ class SMDatabaseBuilder(object):
                 for spc_key in spec_data.keys():
                     if spc_key == "Units":
                         continue
-                    resp_dset = grp_spec.create_dataset(spc_key, (num_per,),
-                                                        dtype="f")
+                    resp_dset = self.layout.create_dataset(grp_spec, spc_key,
+                                                           (num_per,))
                     resp_dset.attrs["Damping"] = float(spc_key.split("_")[1])
                     resp_dset[:] = spec_data[spc_key]
         return fle
@@ -449,7 +820,7 @@ def add_recursive_nameset(fle, string):
         new_level = levels[iloc]
         if new_level not in fle[current_level]:
             fle[current_level].create_group(new_level)
-            current_level = "/".join([current_level, new_level])
+        current_level = "/".join([current_level, new_level])
 
 
 SCALAR_IMS = ["PGA", "PGV", "PGD", "CAV", "CAV5", "Ia", "T90", "Housner"]
@@ -470,7 +841,8 @@ class HorizontalMotion(object):
     """
     Base Class to implement methods to add horizontal motions to database
     """
-    def __init__(self, fle, component="Geometric", periods=[], damping=0.05):
+    def __init__(self, fle, component="Geometric", periods=[], damping=0.05,
+                 layout=None, response=None):
         """
         :param fle:
             Opem datastream of hdf5 file
@@ -480,17 +852,46 @@ class HorizontalMotion(object):
             Spectral periods
         :param float damping:
             Fractional coefficient of damping
+        :param layout:
+            Storage layout of the datasets, as instance of :class:
+            smtk.sm_utils.HDF5Layout
+        :param response:
+            Oscillator responses of the record, as instance of :class:
+            smtk.intensity_measures.HorizontalResponse, shared between the
+            horizontal motions of the record (computed when first needed
+            if None)
         """
+        self.layout = layout if layout is not None else\
+            utils.DEFAULT_HDF5_LAYOUT
         self.fle = fle
-        self.periods = periods
+        self.periods = periods if response is None else response.periods
         self.damping = damping
         self.component = component
+        self.response = response
 
     def add_data(self):
         """
         Adds the data
         """
 
+    def get_response(self):
+        """
+        Returns the oscillator responses of the record to its x and y
+        components
+        """
+        if self.response is None:
+            if len(self.periods) == 0:
+                self.periods = self.fle["IMS/X/Spectra/Response/Periods"][1:]
+            x_acc = self.fle["Time Series/X/Original Record/Acceleration"]
+            y_acc = self.fle["Time Series/Y/Original Record/Acceleration"]
+            self.response = ims.HorizontalResponse(x_acc[:],
+                                                   x_acc.attrs["Time-step"],
+                                                   y_acc[:],
+                                                   y_acc.attrs["Time-step"],
+                                                   self.periods,
+                                                   self.damping)
+        return self.response
+
 
 class AddPGA(HorizontalMotion):
     """
@@ -501,25 +902,23 @@ class AddPGA(HorizontalMotion):
         Takes PGA from X and Y component and determines the resultant
         horizontal component
         """
-        if "PGA" not in self.fle["IMS/X/Scalar"]:
+        if not utils.has_scalar_im(self.fle["IMS/X/Scalar"], "PGA"):
             x_pga = self._get_pga_from_time_series(
                 "Time Series/X/Original Record/Acceleration",
                 "IMS/X/Scalar")
         else:
-            x_pga = self.fle["IMS/X/Scalar/PGA"][()]
+            x_pga = utils.get_scalar_im(self.fle["IMS/X/Scalar"], "PGA")
 
-        if "PGA" not in self.fle["IMS/Y/Scalar"]:
+        if not utils.has_scalar_im(self.fle["IMS/Y/Scalar"], "PGA"):
             y_pga = self._get_pga_from_time_series(
                 "Time Series/Y/Original Record/Acceleration",
                 "IMS/Y/Scalar")
         else:
-            y_pga = self.fle["IMS/Y/Scalar/PGA"][()]
+            y_pga = utils.get_scalar_im(self.fle["IMS/Y/Scalar"], "PGA")
 
-        h_pga = self.fle["IMS/H/Scalar"].create_dataset("PGA", (1,),
-                                                        dtype=float)
-        h_pga.attrs["Units"] = "cm/s/s"
-        h_pga.attrs["Component"] = self.component
-        h_pga[:] = utils.SCALAR_XY[self.component](x_pga, y_pga)
+        self.layout.create_scalars(self.fle["IMS/H/Scalar"], [
+            ("PGA", utils.SCALAR_XY[self.component](x_pga, y_pga),
+             {"Units": "cm/s/s", "Component": self.component})], float)
 
     def _get_pga_from_time_series(self, time_series_location, target_location):
         """
@@ -527,10 +926,8 @@ class AddPGA(HorizontalMotion):
         this extracts them from the time series.
         """
         pga = np.max(np.fabs(self.fle[time_series_location][()]))
-        pga_dset = self.fle[target_location].create_dataset("PGA", (1,),
-                                                            dtype=float)
-        pga_dset.attrs["Units"] = "cm/s/s"
-        pga_dset[:] = pga
+        self.layout.create_scalars(self.fle[target_location], [
+            ("PGA", pga, {"Units": "cm/s/s"})], float)
         return pga
 
 
@@ -543,25 +940,23 @@ class AddPGV(HorizontalMotion):
         Takes PGV from X and Y component and determines the resultant
         horizontal component
         """
-        if "PGV" not in self.fle["IMS/X/Scalar"]:
+        if not utils.has_scalar_im(self.fle["IMS/X/Scalar"], "PGV"):
             x_pgv = self._get_pgv_from_time_series(
                 "Time Series/X/Original Record/",
                 "IMS/X/Scalar")
         else:
-            x_pgv = self.fle["IMS/X/Scalar/PGV"][()]
+            x_pgv = utils.get_scalar_im(self.fle["IMS/X/Scalar"], "PGV")
 
-        if "PGV" not in self.fle["IMS/Y/Scalar"]:
+        if not utils.has_scalar_im(self.fle["IMS/Y/Scalar"], "PGV"):
             y_pgv = self._get_pgv_from_time_series(
                 "Time Series/Y/Original Record",
                 "IMS/Y/Scalar")
         else:
-            y_pgv = self.fle["IMS/Y/Scalar/PGV"][()]
+            y_pgv = utils.get_scalar_im(self.fle["IMS/Y/Scalar"], "PGV")
 
-        h_pgv = self.fle["IMS/H/Scalar"].create_dataset("PGV", (1,),
-                                                        dtype=float)
-        h_pgv.attrs["Units"] = "cm/s"
-        h_pgv.attrs["Component"] = self.component
-        h_pgv[:] = utils.SCALAR_XY[self.component](x_pgv, y_pgv)
+        self.layout.create_scalars(self.fle["IMS/H/Scalar"], [
+            ("PGV", utils.SCALAR_XY[self.component](x_pgv, y_pgv),
+             {"Units": "cm/s", "Component": self.component})], float)
 
     def _get_pgv_from_time_series(self, time_series_location, target_location):
         """
@@ -575,19 +970,16 @@ class AddPGV(HorizontalMotion):
                 self.fle[accel_loc].attrs["Time-step"],
                 self.fle[accel_loc][()])
 
-            vel_dset = self.fle[time_series_location].create_dataset(
-                "Velocity",
-                (len(velocity),),
-                dtype=float)
+            vel_dset = self.layout.create_dataset(
+                self.fle[time_series_location], "Velocity",
+                (len(velocity),), float)
 
         else:
             velocity = self.fle[time_series_location + "/Velocity"][()]
 
         pgv = np.max(np.fabs(velocity))
-        pgv_dset = self.fle[target_location].create_dataset("PGV", (1,),
-                                                            dtype=float)
-        pgv_dset.attrs["Units"] = "cm/s/s"
-        pgv_dset[:] = pgv
+        self.layout.create_scalars(self.fle[target_location], [
+            ("PGV", pgv, {"Units": "cm/s/s"})], float)
         return pgv
 
 
@@ -603,19 +995,9 @@ class AddResponseSpectrum(HorizontalMotion):
         """
         Adds the response spectrum
         """
-        if len(self.periods) == 0:
-            self.periods = self.fle["IMS/X/Spectra/Response/Periods"][1:]
-
-        x_acc = self.fle["Time Series/X/Original Record/Acceleration"]
-        y_acc = self.fle["Time Series/Y/Original Record/Acceleration"]
-        sax, say = ims.get_response_spectrum_pair(x_acc[:],
-                                                  x_acc.attrs["Time-step"],
-                                                  y_acc[:],
-                                                  y_acc.attrs["Time-step"],
-                                                  self.periods,
-                                                  self.damping)
+        sax, say = self.get_response().get_spectrum_pair()
         sa_hor = ORDINARY_SA_COMBINATION[self.component](sax, say)
-        dstring = "damping_" + str(int(100.0 * self.damping)).zfill(2)
+        dstring = utils.get_damping_string(100.0 * self.damping)
         nvals = len(sa_hor["Acceleration"])
         self._build_group("IMS/H/Spectra/Response", "Acceleration",
                           "Acceleration", sa_hor, nvals, "cm/s/s", dstring)
@@ -640,8 +1022,9 @@ class AddResponseSpectrum(HorizontalMotion):
             base_grp = self.fle[base_string].create_group(key)
         else:
             base_grp = self.fle["/".join([base_string, key])]
-        base_cmp_grp = base_grp.create_group(self.component)
-        dset = base_cmp_grp.create_dataset(dstring, (nvals,), dtype=float)
+        base_cmp_grp = base_grp.require_group(self.component)
+        dset = self.layout.create_dataset(base_cmp_grp, dstring, (nvals,),
+                                          float)
         dset.attrs["Units"] = units
         dset[:] = sa_hor[im_key]
 
@@ -670,16 +1053,8 @@ class AddGMRotDppSpectrum(AddResponseSpectrum):
         :param float percentile:
             Percentile (pp)
         """
-        if len(self.periods) == 0:
-            self.periods = self.fle["IMS/X/Spectra/Response/Periods"][1:]
-
-        x_acc = self.fle["Time Series/X/Original Record/Acceleration"]
-        y_acc = self.fle["Time Series/Y/Original Record/Acceleration"]
-
-        gmrotdpp = ims.gmrotdpp(x_acc[:], x_acc.attrs["Time-step"],
-                                y_acc[:], y_acc.attrs["Time-step"],
-                                self.periods, percentile, self.damping)
-        dstring = "damping_" + str(int(100.0 * self.damping)).zfill(2)
+        gmrotdpp = self.get_response().gmrotdpp(percentile)
+        dstring = utils.get_damping_string(100.0 * self.damping)
         nvals = len(gmrotdpp)
         # Acceleration
         if "Acceleration" not in self.fle["IMS/H/Spectra/Response"]:
@@ -687,9 +1062,10 @@ class AddGMRotDppSpectrum(AddResponseSpectrum):
                 "Acceleration")
         else:
             acc_grp = self.fle["IMS/H/Spectra/Response/Acceleration"]
-        acc_cmp_grp = acc_grp.create_group(
+        acc_cmp_grp = acc_grp.require_group(
             "GMRotD" + str(int(percentile)).zfill(2))
-        acc_dset = acc_cmp_grp.create_dataset(dstring, (nvals,), dtype=float)
+        acc_dset = self.layout.create_dataset(acc_cmp_grp, dstring, (nvals,),
+                                              float)
         acc_dset.attrs["Units"] = "cm/s/s"
         acc_dset[:] = gmrotdpp["GMRotDpp"]
         self._add_periods()
@@ -704,15 +1080,8 @@ class AddRotDppSpectrum(AddResponseSpectrum):
         :param float percentile:
             Percentile (pp)
         """
-        if len(self.periods) == 0:
-            self.periods = self.fle["IMS/X/Spectra/Response/Periods"][1:]
-
-        x_acc = self.fle["Time Series/X/Original Record/Acceleration"]
-        y_acc = self.fle["Time Series/Y/Original Record/Acceleration"]
-        rotdpp = ims.rotdpp(x_acc[:], x_acc.attrs["Time-step"],
-                            y_acc[:], y_acc.attrs["Time-step"],
-                            self.periods, percentile, self.damping)[0]
-        dstring = "damping_" + str(int(100.0 * self.damping)).zfill(2)
+        rotdpp = self.get_response().rotdpp(percentile)[0]
+        dstring = utils.get_damping_string(100.0 * self.damping)
         nvals = len(rotdpp["Pseudo-Acceleration"])
         # Acceleration
         if not "Acceleration" in self.fle["IMS/H/Spectra/Response"]:
@@ -720,9 +1089,10 @@ class AddRotDppSpectrum(AddResponseSpectrum):
                 "Acceleration")
         else:
             acc_grp = self.fle["IMS/H/Spectra/Response/Acceleration"]
-        acc_cmp_grp = acc_grp.create_group("RotD" + 
-                                           str(int(percentile)).zfill(2))
-        acc_dset = acc_cmp_grp.create_dataset(dstring, (nvals,), dtype=float)
+        acc_cmp_grp = acc_grp.require_group("RotD" + 
+                                            str(int(percentile)).zfill(2))
+        acc_dset = self.layout.create_dataset(acc_cmp_grp, dstring, (nvals,),
+                                              float)
         acc_dset.attrs["Units"] = "cm/s/s"
         acc_dset[:] = rotdpp["Pseudo-Acceleration"]
         self._add_periods()
@@ -737,16 +1107,9 @@ class AddGMRotIppSpectrum(AddResponseSpectrum):
         :param float percentile:
             Percentile (pp)
         """
-        if len(self.periods) == 0:
-            self.periods = self.fle["IMS/X/Spectra/Response/Periods"][1:]
-
-        x_acc = self.fle["Time Series/X/Original Record/Acceleration"]
-        y_acc = self.fle["Time Series/Y/Original Record/Acceleration"]
-        sa_hor = ims.gmrotipp(x_acc[:], x_acc.attrs["Time-step"],
-                              y_acc[:], y_acc.attrs["Time-step"],
-                              self.periods, percentile, self.damping)
+        sa_hor = self.get_response().gmrotipp(percentile)
         nvals = len(sa_hor["Acceleration"])
-        dstring = "damping_" + str(int(100.0 * self.damping)).zfill(2)
+        dstring = utils.get_damping_string(100.0 * self.damping)
         # Acceleration
         self._build_group("IMS/H/Spectra/Response", "Acceleration", 
                           "Acceleration", sa_hor, nvals, "cm/s/s", dstring)
@@ -773,10 +1136,12 @@ SPECTRUM_COMBINATION = {"Geometric": AddResponseSpectrum,
 
 
 def add_horizontal_im(database, intensity_measures, component="Geometric",
-        damping="05", periods=[]):
+        damping="05", periods=[], workers=None, layout=None, processes=None,
+        checkpoint=None):
     """
     For a database this adds the resultant horizontal components to the
-    hdf databse for each record
+    hdf databse for each record. The intensity measures already in a record
+    are not computed again, so that an interrupted run can be resumed
     :param database:
         Strong motion databse as instance of :class:
         smtk.sm_database.GroundMotionDatabase
@@ -788,48 +1153,197 @@ def add_horizontal_im(database, intensity_measures, component="Geometric",
         Percentile damping
     :param list/np.ndarray periods:
         Periods
+    :param int workers:
+        Number of threads reading the record files into the OS cache ahead
+        of the calculation (default smtk.sm_utils.IO_WORKERS)
+    :param layout:
+        Storage layout of the new datasets, as instance of :class:
+        smtk.sm_utils.HDF5Layout
+    :param int processes:
+        Number of processes computing the intensity measures (default None:
+        computed in this process). Each record file is read and written by
+        a single process
+    :param str checkpoint:
+        Path to a checkpoint file listing the records completed (default
+        None: no checkpoint). The records listed by an existing checkpoint
+        of the same calculation are skipped
     """
+    settings = {"intensity_measures": list(intensity_measures),
+                "component": component,
+                "damping": damping,
+                "periods": [float(period) for period in periods]}
+    completed = set()
+    if checkpoint:
+        completed = _read_horizontal_im_checkpoint(checkpoint, settings)
+        if completed:
+            print("Resuming from checkpoint %s (%s records completed)"
+                  % (checkpoint, len(completed)))
+    records = [record for record in database.records
+               if record.datafile not in completed]
     nrecs = len(database.records)
-    for iloc, record in enumerate(database.records):
-        print("Processing %s (Record %s of %s)" % (record.datafile, 
-                                                   iloc + 1,
-                                                   nrecs))
-        fle = h5py.File(record.datafile, "r+")
-        add_recursive_nameset(fle, "IMS/H/Spectra/Response")
-        fle["IMS/H/"].create_group("Scalar")
-        for intensity_measure in intensity_measures:
-            if len(intensity_measure.split("GMRotI")) > 1:
-                # GMRotIpp
-                percentile = float(intensity_measure.split("GMRotI")[1])
-                i_m = AddGMRotIppSpectrum(fle, intensity_measure, periods, 
-                                          float(damping) / 100.)
-                i_m.add_data(percentile)
-            elif len(intensity_measure.split("GMRotD")) > 1:
-                # GMRotDpp
-                percentile = float(intensity_measure.split("GMRotD")[1])
-                i_m = AddGMRotDppSpectrum(fle, intensity_measure, periods, 
-                                          float(damping) / 100.)
-                i_m.add_data(percentile)
-            elif len(intensity_measure.split("RotD")) > 1:
-                # RotDpp
-                percentile = float(intensity_measure.split("RotD")[1])
-                i_m = AddRotDppSpectrum(fle, intensity_measure, periods, 
-                                          float(damping) / 100.)
-                i_m.add_data(percentile)
-            elif intensity_measure in SCALAR_IMS:
-                # Is a scalar value
-                i_m = SCALAR_IM_COMBINATION[intensity_measure](fle,
-                    component,
-                    periods,
-                    float(damping) / 100.)
-                i_m.add_data()
-            elif intensity_measure in SPECTRAL_IMS:
-                # Is a normal spectrum combination
-                i_m = SPECTRUM_COMBINATION[intensity_measure](fle,
-                    component,
-                    periods,
-                    float(damping) / 100.)
-                i_m.add_data()
-            else:
-                raise ValueError("Unrecognised Intensity Measure!")
+    args = (intensity_measures, component, damping, periods, layout)
+    log = _open_horizontal_im_checkpoint(checkpoint, settings, completed)
+    try:
+        if processes and processes > 1 and len(records) > 1:
+            with ProcessPoolExecutor(processes) as executor:
+                futures = [executor.submit(_add_horizontal_im_to_record,
+                                           record.datafile, *args)
+                           for record in records]
+                for iloc, future in enumerate(as_completed(futures)):
+                    datafile = future.result()
+                    print("Processed %s (Record %s of %s)" % (
+                        datafile, len(completed) + iloc + 1, nrecs))
+                    _log_completed(log, datafile)
+            return
+        # Record files are read ahead by a pool of threads, so that they are
+        # in the OS cache when updated in place
+        datafiles = utils.iter_prefetched(
+            utils.cache_file, [record.datafile for record in records],
+            workers)
+        for iloc, datafile in enumerate(datafiles):
+            print("Processing %s (Record %s of %s)" % (
+                datafile, len(completed) + iloc + 1, nrecs))
+            _add_horizontal_im_to_record(datafile, *args)
+            _log_completed(log, datafile)
+    finally:
+        if log is not None:
+            log.close()
+
+
+def _add_horizontal_im_to_record(datafile, intensity_measures, component,
+                                 damping, periods, layout):
+    """
+    Adds the horizontal intensity measures missing in a record file (see
+    `add_horizontal_im`), updating the file in place, and returns its path
+    """
+    fle = h5py.File(datafile, "r+")
+    missing = [intensity_measure for intensity_measure in intensity_measures
+               if not has_horizontal_im(fle, intensity_measure, component,
+                                        damping)]
+    if not missing:
         fle.close()
+        return datafile
+    add_recursive_nameset(fle, "IMS/H/Spectra/Response")
+    fle["IMS/H/"].require_group("Scalar")
+    # The oscillator responses to the x and y components are computed once,
+    # by the first spectral IM, and shared by the others
+    response = None
+    for intensity_measure in missing:
+        if len(intensity_measure.split("GMRotI")) > 1:
+            # GMRotIpp
+            percentile = float(intensity_measure.split("GMRotI")[1])
+            i_m = AddGMRotIppSpectrum(fle, intensity_measure, periods,
+                                      float(damping) / 100., layout, response)
+            i_m.add_data(percentile)
+        elif len(intensity_measure.split("GMRotD")) > 1:
+            # GMRotDpp
+            percentile = float(intensity_measure.split("GMRotD")[1])
+            i_m = AddGMRotDppSpectrum(fle, intensity_measure, periods,
+                                      float(damping) / 100., layout, response)
+            i_m.add_data(percentile)
+        elif len(intensity_measure.split("RotD")) > 1:
+            # RotDpp
+            percentile = float(intensity_measure.split("RotD")[1])
+            i_m = AddRotDppSpectrum(fle, intensity_measure, periods,
+                                    float(damping) / 100., layout, response)
+            i_m.add_data(percentile)
+        elif intensity_measure in SCALAR_IMS:
+            # Is a scalar value
+            i_m = SCALAR_IM_COMBINATION[intensity_measure](
+                fle, component, periods, float(damping) / 100., layout,
+                response)
+            i_m.add_data()
+        elif intensity_measure in SPECTRAL_IMS:
+            # Is a normal spectrum combination
+            i_m = SPECTRUM_COMBINATION[intensity_measure](
+                fle, component, periods, float(damping) / 100., layout,
+                response)
+            i_m.add_data()
+        else:
+            fle.close()
+            raise ValueError("Unrecognised Intensity Measure!")
+        response = i_m.response
+    fle.close()
+    return datafile
+
+
+def has_horizontal_im(fle, intensity_measure, component="Geometric",
+                      damping="05"):
+    """
+    Returns True if the horizontal intensity measure, as defined in
+    `add_horizontal_im`, is already in the record file
+    :param fle:
+        Instance of :class: h5py.File
+    """
+    dstring = utils.get_damping_string(damping)
+    location = "IMS/H/Spectra/Response/Acceleration/%s/" + dstring
+    for prefix in ["GMRotI", "GMRotD", "RotD"]:
+        if len(intensity_measure.split(prefix)) > 1:
+            if prefix == "GMRotI":
+                name = intensity_measure
+            else:
+                percentile = float(intensity_measure.split(prefix)[1])
+                name = prefix + str(int(percentile)).zfill(2)
+            return (location % name) in fle
+    if intensity_measure in SCALAR_IMS:
+        return "IMS/H/Scalar" in fle and\
+            utils.has_scalar_im(fle["IMS/H/Scalar"], intensity_measure)
+    if intensity_measure in SPECTRAL_IMS:
+        return (location % component) in fle
+    return False
+
+
+def _read_horizontal_im_checkpoint(checkpoint, settings):
+    """
+    Returns the set of the record files completed according to a
+    checkpoint file of `add_horizontal_im`. The first line of the file is
+    the json of the settings of the calculation, followed by one record file
+    per line. A checkpoint of a different calculation is ignored
+    """
+    if not os.path.exists(checkpoint):
+        return set()
+    with open(checkpoint, "r") as f:
+        lines = f.read().splitlines()
+    try:
+        if not lines or json.loads(lines[0]) != settings:
+            print("Checkpoint %s refers to a different calculation - "
+                  "ignoring it" % checkpoint)
+            return set()
+    except ValueError:
+        print("Checkpoint %s not readable - ignoring it" % checkpoint)
+        return set()
+    return set(line for line in lines[1:] if line)
+
+
+def _open_horizontal_im_checkpoint(checkpoint, settings, completed):
+    """
+    Opens the checkpoint file of `add_horizontal_im` for appending the
+    records completed, rewriting it if it is new or was ignored
+    """
+    if not checkpoint:
+        return None
+    if completed:
+        return open(checkpoint, "a")
+    log = open(checkpoint, "w")
+    log.write(json.dumps(settings) + "\n")
+    log.flush()
+    return log
+
+
+def _log_completed(log, datafile):
+    """
+    Appends a completed record file to the checkpoint file (if any)
+    """
+    if log is not None:
+        log.write(datafile + "\n")
+        log.flush()
+
+
+def _write_file(filename, data):
+    """
+    Replaces the content of a file with the given bytes
+    """
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "wb") as fle:
+        fle.write(data)
+    os.replace(tmp_filename, filename)
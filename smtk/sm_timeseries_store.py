@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright (C) 2014-2018 GEM Foundation and G. Weatherill
+#
+# OpenQuake is free software: you can redistribute it and/or modify it
+# under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OpenQuake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with OpenQuake. If not, see <http://www.gnu.org/licenses/>.
+"""
+Packed storage of the time series of a strong motion database.
+
+The time series of all the records and components are written end to end
+into a single contiguous binary file of float32 values, together with an
+index table of the record id, component, offset, number of steps and
+time-step of each time series. The binary file is memory mapped when read,
+so that each time series is served as a slice of the map (no copy) and the
+whole database can be streamed sequentially, in storage order.
+"""
+import os
+import numpy as np
+import h5py
+
+# Binary file of the values and index table of a packed store
+TIME_SERIES_DATA = "time_series.bin"
+TIME_SERIES_INDEX = "time_series_index.npy"
+
+TIME_SERIES_DTYPE = np.float32
+
+# Location of the time series in the hdf5 file of a record
+TIME_SERIES_PATH = "Time Series/%s/Original Record/%s"
+
+
+class PackedTimeSeriesWriter(object):
+    """
+    Appends time series to a packed store. The files are written under
+    temporary names and moved in place by :meth:`close`, so that an
+    existing store is replaced only by a complete one. Use as context
+    manager:
+
+    with PackedTimeSeriesWriter(directory) as writer:
+        writer.add(record_id, "X", values, time_step)
+
+    :param str directory:
+        Path to the directory of the store (created if missing)
+    """
+    def __init__(self, directory):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self._data_file = os.path.join(directory, TIME_SERIES_DATA + ".tmp")
+        self._fle = open(self._data_file, "wb")
+        self.offset = 0
+        self.rows = []
+
+    def add(self, record_id, component, values, time_step):
+        """
+        Appends a time series to the store
+        :param str record_id:
+            Record id
+        :param str component:
+            Component (e.g. "X", "Y", "V")
+        :param numpy.ndarray values:
+            Time series
+        :param float time_step:
+            Time-step (s)
+        """
+        values = np.ascontiguousarray(values, dtype=TIME_SERIES_DTYPE)
+        self._fle.write(values.tobytes())
+        self.rows.append((str(record_id), str(component), self.offset,
+                          len(values), float(time_step)))
+        self.offset += len(values)
+
+    def close(self):
+        """
+        Writes the index table and moves the files in place
+        """
+        self._fle.close()
+        id_size = max([len(row[0]) for row in self.rows] + [1])
+        comp_size = max([len(row[1]) for row in self.rows] + [1])
+        index = np.array(self.rows, dtype=[("record_id", "U%d" % id_size),
+                                           ("component", "U%d" % comp_size),
+                                           ("offset", np.int64),
+                                           ("length", np.int64),
+                                           ("time_step", np.float64)])
+        index_file = os.path.join(self.directory, TIME_SERIES_INDEX)
+        with open(index_file + ".tmp", "wb") as f:
+            np.save(f, index)
+        os.replace(self._data_file,
+                   os.path.join(self.directory, TIME_SERIES_DATA))
+        os.replace(index_file + ".tmp", index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave any existing store untouched
+            self._fle.close()
+            os.remove(self._data_file)
+
+
+class PackedTimeSeriesStore(object):
+    """
+    Reader of a packed time series store
+    :param str directory:
+        Path to the directory of the store
+    :param numpy.ndarray index:
+        Index table with fields "record_id", "component", "offset",
+        "length" and "time_step", in storage order
+    :param numpy.memmap data:
+        Memory map of the values of all the time series (None if the store
+        is empty)
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        index_file = os.path.join(directory, TIME_SERIES_INDEX)
+        if not os.path.exists(index_file):
+            raise IOError("Packed time series store not found in %s"
+                          % directory)
+        self.index = np.load(index_file)
+        if len(self.index) and np.sum(self.index["length"]):
+            self.data = np.memmap(os.path.join(directory, TIME_SERIES_DATA),
+                                  dtype=TIME_SERIES_DTYPE, mode="r")
+        else:
+            self.data = None
+        self._lookup = dict(
+            ((row["record_id"], row["component"]), i)
+            for i, row in enumerate(self.index))
+
+    def __len__(self):
+        """
+        Returns the number of time series
+        """
+        return len(self.index)
+
+    def __contains__(self, key):
+        """
+        Returns True if the tuple (record_id, component) is in the store
+        """
+        return tuple(key) in self._lookup
+
+    def get_time_series(self, record_id, component):
+        """
+        Returns the time series of a record component as the tuple (values,
+        time-step). The values are a read-only view of the memory map
+        """
+        try:
+            i = self._lookup[(record_id, component)]
+        except KeyError:
+            raise ValueError("Component %s of record %s not in store"
+                             % (component, record_id))
+        return self._get_row(i)
+
+    def _get_row(self, i):
+        """
+        Returns the time series of the i-th row of the index
+        """
+        row = self.index[i]
+        if self.data is None:
+            return np.zeros(0, dtype=TIME_SERIES_DTYPE), row["time_step"]
+        return (self.data[row["offset"]:row["offset"] + row["length"]],
+                row["time_step"])
+
+    def get_components(self, record_id):
+        """
+        Returns the components of the record in the store
+        """
+        return [row["component"] for row in self.index
+                if row["record_id"] == record_id]
+
+    def iter_time_series(self, components=None):
+        """
+        Yields the tuple (record id, component, values, time-step) of each
+        time series, in storage order (i.e. reading the binary file
+        sequentially)
+        :param list components:
+            Components to yield (default None: all)
+        """
+        for i, row in enumerate(self.index):
+            if components is not None and row["component"] not in components:
+                continue
+            values, time_step = self._get_row(i)
+            yield row["record_id"], row["component"], values, time_step
+
+
+def pack_time_series(database, directory, components=("X", "Y", "V"),
+                     quantity="Acceleration"):
+    """
+    Builds a packed store of the time series in the hdf5 files of the
+    records of a database, reading one record at a time
+    :param database:
+        Strong motion database as instance of :class:
+        smtk.sm_database.GroundMotionDatabase
+    :param str directory:
+        Path to the directory of the store
+    :param components:
+        Components to store (those missing in a record are skipped)
+    :param str quantity:
+        Time series to store ("Acceleration", "Velocity" or "Displacement")
+    :returns:
+        The store as instance of :class: PackedTimeSeriesStore
+    """
+    with PackedTimeSeriesWriter(directory) as writer:
+        for record in database.records:
+            if not record.datafile or not os.path.exists(record.datafile):
+                print("Record %s has no data file - skipping" % record.id)
+                continue
+            with h5py.File(record.datafile, "r") as fle:
+                for component in components:
+                    location = TIME_SERIES_PATH % (component, quantity)
+                    if location not in fle:
+                        continue
+                    dset = fle[location]
+                    writer.add(record.id, component, dset[:],
+                               dset.attrs["Time-step"])
+    return PackedTimeSeriesStore(directory)
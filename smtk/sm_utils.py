@@ -25,6 +25,10 @@ Strong motion utilities.
 import os
 import sys
 import re
+import threading
+from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.integrate import cumulative_trapezoid
 from scipy.constants import g
@@ -187,3 +191,348 @@ def get_interpolated_period(target_period, periods, values):
             np.log10(values[lval]) +
             (np.log10(target_period) - np.log10(periods[lval])) * d_y / d_x
     )
+
+
+def get_interpolated_periods(target_periods, periods, values):
+    """
+    Returns the spectra interpolated in loglog space at several periods at
+    once (vectorised version of :func:`get_interpolated_period`)
+
+    :param np.ndarray target_periods: Periods required for interpolation
+    :param np.ndarray periods: Spectral Periods, in ascending order
+    :param np.ndarray values: Ground motion values, along the first axis
+        (further axes, e.g. one per record, are interpolated at once)
+    """
+    target_periods = np.asarray(target_periods, dtype=float)
+    periods = np.asarray(periods)
+    values = np.asarray(values)
+    outside = (target_periods < np.min(periods)) |\
+        (target_periods > np.max(periods))
+    if np.any(outside):
+        raise ValueError("Period not within calculated range: %s" %
+                         str(target_periods[outside][0]))
+    lval = np.searchsorted(periods, target_periods, side="right") - 1
+    uval = np.searchsorted(periods, target_periods, side="left")
+    output = values[lval].astype(float)
+    idx = uval != lval
+    if np.any(idx):
+        lval, uval = lval[idx], uval[idx]
+        shape = (-1,) + (1,) * (values.ndim - 1)
+        d_y = np.log10(values[uval]) - np.log10(values[lval])
+        d_x = (np.log10(periods[uval]) - np.log10(periods[lval])).reshape(
+            shape)
+        output[idx] = 10.0 ** (
+            np.log10(values[lval]) +
+            (np.log10(target_periods[idx]) -
+             np.log10(periods[lval])).reshape(shape) * d_y / d_x)
+    return output
+
+
+# Default number of threads reading record files concurrently (1 to read them
+# sequentially in the calling thread)
+IO_WORKERS = 4
+
+
+def iter_prefetched(function, items, workers=None, queue_size=None):
+    """
+    Yields `function(item)` for each item, in the order of the items. The
+    results are computed by a pool of threads ahead of the consumer, so that
+    file reads (the typical `function`) overlap with the processing of the
+    results already yielded
+
+    :param function: function of one argument
+    :param items: iterable of arguments
+    :param int workers: number of threads (default `IO_WORKERS`). With 1 or
+        less the results are computed in the calling thread, when requested
+    :param int queue_size: maximum number of results computed ahead of the
+        consumer (default twice the number of workers)
+    """
+    if workers is None:
+        workers = IO_WORKERS
+    if workers <= 1:
+        for item in items:
+            yield function(item)
+        return
+    queue_size = max(queue_size or 2 * workers, 1)
+    pending = deque()
+    with ThreadPoolExecutor(workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+                if len(pending) >= queue_size:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Consumer stopped early or an error occurred
+            for future in pending:
+                future.cancel()
+
+
+class BackgroundWriter(object):
+    """
+    Dedicated thread calling `function(*args)` for each tuple of arguments
+    put in its queue, in order, so that the writing of files overlaps with
+    the work of the producer. Use as context manager:
+
+    with BackgroundWriter(write_record) as writer:
+        writer.put(record, values)
+
+    The first error raised by `function` is raised again by :meth:`put` or
+    :meth:`close`
+
+    :param function: function writing a result
+    :param int queue_size: maximum number of pending results
+    """
+    def __init__(self, function, queue_size=64):
+        self.function = function
+        self._queue = Queue(max(queue_size, 1))
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            args = self._queue.get()
+            if args is None:
+                return
+            if self._error is None:
+                try:
+                    self.function(*args)
+                except Exception as err:
+                    # Stop writing, the error is raised in the producer
+                    self._error = err
+
+    def put(self, *args):
+        """
+        Queues the arguments of a call to the writing function
+        """
+        if self._error is not None:
+            raise self._error
+        self._queue.put(args)
+
+    def close(self):
+        """
+        Waits until all the queued results are written
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Let the writer finish, the producer error prevails
+            self._queue.put(None)
+            self._thread.join()
+
+
+def read_file(filename):
+    """
+    Returns the content of a file as bytes
+    """
+    with open(filename, "rb") as fle:
+        return fle.read()
+
+
+def cache_file(filename, block_size=1 << 20):
+    """
+    Reads a file through, so that its content is in the OS cache, and
+    returns its path
+    """
+    with open(filename, "rb") as fle:
+        while fle.read(block_size):
+            pass
+    return filename
+
+
+def get_damping_string(damping):
+    """
+    Returns the name of the datasets of the response spectra of a damping
+    in the record files, e.g. "damping_05"
+    :param damping:
+        Damping in percent, as number or string (e.g. "05" or 2.5)
+    """
+    # Rounded so that fractions scaled to percent (0.29 * 100) give the
+    # same name
+    whole, _, decimals = ("%g" % round(float(damping), 6)).partition(".")
+    return "damping_" + whole.zfill(2) + ("." + decimals if decimals else "")
+
+
+# Name of the compound dataset holding all the scalar IMs of a component, in
+# the "Scalar" group of a record hdf5 file (see `HDF5Layout`)
+SCALAR_COMPOUND = "Scalars"
+
+HDF5_COMPRESSION = [None, "gzip", "lzf"]
+
+
+class HDF5Layout(object):
+    """
+    Storage layout of the datasets of the record hdf5 files. The default
+    layout is that of contiguous, uncompressed datasets and one dataset per
+    scalar IM
+    :param str compression:
+        Compression filter of the array datasets: None, "gzip" or "lzf"
+    :param int compression_opts:
+        Compression level (gzip only)
+    :param bool shuffle:
+        Apply the shuffle filter before the compression
+    :param chunks:
+        Chunk length of the array datasets: None (chunked only if
+        compressed, with the chunk size guessed by h5py), True (chunk size
+        guessed by h5py) or int
+    :param bool compound_scalars:
+        Store the scalar IMs of a component as fields of a single compound
+        dataset (`SCALAR_COMPOUND`) rather than one dataset of shape (1,)
+        each
+    """
+    def __init__(self, compression=None, compression_opts=None,
+                 shuffle=False, chunks=None, compound_scalars=False):
+        if compression not in HDF5_COMPRESSION:
+            raise ValueError("Compression %s not supported (one of %s)"
+                             % (compression, HDF5_COMPRESSION))
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.chunks = chunks
+        self.compound_scalars = compound_scalars
+
+    def __repr__(self):
+        return "HDF5Layout(compression=%s, shuffle=%s, chunks=%s, "\
+            "compound_scalars=%s)" % (self.compression, self.shuffle,
+                                      self.chunks, self.compound_scalars)
+
+    def get_dataset_options(self, shape):
+        """
+        Returns the keyword arguments of `h5py.Group.create_dataset` for a
+        dataset of the given shape. Datasets with less than two values are
+        always contiguous
+        """
+        if int(np.prod(shape)) < 2:
+            return {}
+        options = {}
+        if self.chunks is True or (self.chunks is None and self.compression):
+            options["chunks"] = True
+        elif self.chunks:
+            options["chunks"] = (min(int(self.chunks), shape[0]),) +\
+                tuple(shape[1:])
+        if self.compression:
+            options["compression"] = self.compression
+            if self.compression_opts is not None:
+                options["compression_opts"] = self.compression_opts
+        if self.shuffle and "chunks" in options:
+            options["shuffle"] = True
+        return options
+
+    def create_dataset(self, group, name, shape, dtype="f"):
+        """
+        Creates an array dataset in the given hdf5 group
+        """
+        return group.create_dataset(name, shape, dtype=dtype,
+                                    **self.get_dataset_options(shape))
+
+    def create_scalars(self, group, scalars, dtype="f"):
+        """
+        Stores scalar IMs in the "Scalar" group of a component
+        :param group:
+            The hdf5 group
+        :param list scalars:
+            List of tuples (IM name, value, dict of attributes). Missing
+            values (None) are stored as nan
+        """
+        if not self.compound_scalars:
+            for name, value, attrs in scalars:
+                dset = group.create_dataset(name, (1,), dtype=dtype)
+                for key in attrs:
+                    dset.attrs[key] = attrs[key]
+                dset[:] = np.nan if value is None else value
+            return
+        if SCALAR_COMPOUND in group:
+            # Rewrite the compound dataset with the new fields
+            dset = group[SCALAR_COMPOUND]
+            existing = [(name, dset[name][0],
+                         _get_field_attributes(dset, name))
+                        for name in dset.dtype.names
+                        if name not in [scalar[0] for scalar in scalars]]
+            del group[SCALAR_COMPOUND]
+            scalars = existing + list(scalars)
+        if not len(scalars):
+            return
+        data = np.array([tuple(np.nan if value is None else value
+                               for _, value, _ in scalars)],
+                        dtype=[(name, dtype) for name, _, _ in scalars])
+        dset = group.create_dataset(SCALAR_COMPOUND, data=data)
+        for name, _, attrs in scalars:
+            for key in attrs:
+                dset.attrs["%s:%s" % (name, key)] = attrs[key]
+
+
+def _get_field_attributes(dset, name):
+    """
+    Returns the attributes of a field of a compound scalar dataset
+    """
+    prefix = name + ":"
+    return dict((key[len(prefix):], dset.attrs[key]) for key in dset.attrs
+                if key.startswith(prefix))
+
+
+DEFAULT_HDF5_LAYOUT = HDF5Layout()
+
+
+def has_scalar_im(group, i_m):
+    """
+    Returns True if the scalar IM is in the "Scalar" group of a record
+    component (as dataset or as field of the compound dataset)
+    """
+    if i_m in group:
+        return True
+    return SCALAR_COMPOUND in group and\
+        i_m in group[SCALAR_COMPOUND].dtype.names
+
+
+def get_scalar_names(group):
+    """
+    Returns the names of the scalar IMs in the "Scalar" group of a record
+    component (as datasets or as fields of the compound dataset)
+    """
+    names = [name for name in group if name != SCALAR_COMPOUND]
+    if SCALAR_COMPOUND in group:
+        names.extend(name for name in group[SCALAR_COMPOUND].dtype.names
+                     if name not in names)
+    return names
+
+
+def get_scalar_ims(group, ims):
+    """
+    Returns the values of a list of scalar IMs from the "Scalar" group of a
+    record component (see `has_scalar_im`). The compound dataset, if any, is
+    read once for all IMs
+    """
+    if SCALAR_COMPOUND in group:
+        row = group[SCALAR_COMPOUND][0]
+        names = row.dtype.names
+    else:
+        row, names = None, ()
+    values = []
+    for i_m in ims:
+        if i_m in names:
+            values.append(row[i_m])
+        elif i_m in group:
+            values.append(group[i_m][0])
+        else:
+            raise KeyError("Scalar IM %s not in %s" % (i_m, group.name))
+    return values
+
+
+def get_scalar_im(group, i_m):
+    """
+    Returns the value of a scalar IM from the "Scalar" group of a record
+    component (see `has_scalar_im`)
+    """
+    return get_scalar_ims(group, [i_m])[0]
@@ -61,16 +61,27 @@ class SMRecordSelector(object):
         """
         """
         self.database = database
-        self.record_ids = self._get_record_ids()
-        self.event_ids = self.database._get_event_id_list()
-        self.event_ids = self.event_ids.tolist()
-        self.site_ids = [record.site.id for record in self.database.records]
+        record_index = self.database.record_index
+        self.record_ids = [record_index.keys[code]
+                           for code in record_index.codes]
+        self.event_ids = list(self.database.event_index.keys)
+        site_index = self.database.site_index
+        self.site_ids = [site_index.keys[code] for code in site_index.codes]
 
     def _get_record_ids(self):
         """
         Returns a list of record IDs
         """
         return [record.id for record in self.database.records]
+
+    def _select_from_index(self, index, keys, as_db=False):
+        """
+        Selects the records whose key is found in the given keys, using one
+        of the indices of the database
+        """
+        idx = [index.get_group(key) for key in keys if key in index]
+        idx = np.sort(np.concatenate(idx)) if idx else []
+        return self.select_records(idx, as_db)
     
     def select_records(self, idx, as_db=False):
         """
@@ -99,8 +110,9 @@ class SMRecordSelector(object):
         """
         Selects a record according to its waveform id
         """
-        if record_id in self.record_ids:
-            return self.database.records[self.record_ids.index(record_id)]
+        record_index = self.database.record_index
+        if record_id in record_index:
+            return self.database.records[record_index.get_group(record_id)[0]]
         else:
             raise ValueError(
                 "Record {:s} is not in database".format(record_id))
@@ -109,62 +121,47 @@ class SMRecordSelector(object):
         """
         Selects records from a list of IDs
         """
-        idx = []
+        record_index = self.database.record_index
         for record_id in record_ids:
-            if not record_id in self.record_ids:
+            if not record_id in record_index:
                 print("Record {:s} is not in database".format(record_id))
-        for iloc, record in enumerate(self.database.records):
-            if record.id in record_ids:
-                idx.append(iloc)
-        return self.select_records(idx, as_db)
+        return self._select_from_index(record_index, set(record_ids), as_db)
 
     def select_from_site_id(self, site_id, as_db=False):
         """
         Select records corresponding to a particular site ID
         """
-        idx = []
-        for iloc, record in enumerate(self.database.records):
-            if record.site.id == site_id:
-                idx.append(iloc)
-        return self.select_records(idx, as_db)
+        return self._select_from_index(self.database.site_index, [site_id],
+                                       as_db)
 
     def select_from_site_ids(self, site_ids, as_db=False):
         """
         Selects records corresponding to a set of site IDs
         """
+        site_index = self.database.site_index
         for site_id in site_ids:
-            if not site_id in self.site_ids:
-                print("Site {:w is not in database" % site_id)
-        idx = []
-        for iloc, record in enumerate(self.database.records):
-            if record.site.id in site_ids:
-                idx.append(iloc)
-        return self.select_records(idx, as_db)
+            if not site_id in site_index:
+                print("Site %s is not in database" % site_id)
+        return self._select_from_index(site_index, set(site_ids), as_db)
 
     def select_from_event_id(self, event_id, as_db=False):
         """
         Returns a set of records from a common event
         """
-        if not event_id in self.event_ids:
+        if not event_id in self.database.event_index:
             raise ValueError("Event %s not found in database" % event_id)
-        idx = []
-        for iloc, record in enumerate(self.database.records):
-            if record.event.id == event_id:
-                idx.append(iloc)
-        return self.select_records(idx, as_db)
+        return self._select_from_index(self.database.event_index, [event_id],
+                                       as_db)
 
     def select_from_event_ids(self, event_ids, as_db=False):
         """
         Returns records from events whose IDs are found in the list
         """
+        event_index = self.database.event_index
         for event_id in event_ids:
-            if not event_id in self.event_ids:
+            if not event_id in event_index:
                 print("Event {:s} not found in database".format(event_id))
-        idx = []
-        for iloc, record in enumerate(self.database.records):
-            if record.event.id in event_ids:
-                idx.append(iloc)
-        return self.select_records(idx, as_db)
+        return self._select_from_index(event_index, set(event_ids), as_db)
 
     def select_within_time(self, start_time=None, end_time=None, as_db=False):
         """
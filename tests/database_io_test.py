@@ -24,7 +24,10 @@ import sys
 import json
 import pprint
 import unittest
-from smtk.sm_database import load_database
+import numpy as np
+from smtk.sm_database import load_database, save_database, LazyRecordList,\
+    GroundMotionDatabase, save_sharded_database, iter_shards, load_manifest,\
+    get_shard
 from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
 
 if sys.version_info[0] >= 3:
@@ -91,6 +94,176 @@ class DatabaseLoadingTestCase(unittest.TestCase):
         # Now compare files
         self.assertTrue(compare_two_json_files(file1, file2))
 
+    def test_columnar_io_roundtrip(self):
+        # Load the db from pickle and export to the columnar format
+        db = load_database(self.pkl_dir)
+        save_database(db, self.json_dir, "hdf5")
+        db1 = load_database(self.json_dir)
+        self.assertIsInstance(db1.records, LazyRecordList)
+        self.assertEqual(len(db1), len(db))
+        # No record is built before being accessed
+        self.assertEqual(db1.records.number_loaded(), 0)
+        self.assertEqual(db1.records[3].id, db.records[3].id)
+        self.assertEqual(db1.records.number_loaded(), 1)
+        # Compare the json exports
+        file1 = os.path.join(self.json_dir, "columnar_pkl.json")
+        with open(file1, "w") as fi1:
+            fi1.write(db.to_json())
+        file2 = os.path.join(self.json_dir, "columnar_hdf5.json")
+        with open(file2, "w") as fi2:
+            fi2.write(db1.to_json())
+        self.assertTrue(compare_two_json_files(file1, file2))
+        os.remove(os.path.join(self.json_dir, "metadatafile.hdf5"))
+
+    def test_empty_columnar_io_roundtrip(self):
+        """
+        Tests the columnar binary storage of an empty database
+        """
+        empty_dir = os.path.join(self.json_dir, "empty")
+        os.mkdir(empty_dir)
+        save_database(GroundMotionDatabase("x", "y"), empty_dir, "hdf5")
+        db1 = load_database(empty_dir)
+        self.assertEqual(db1.id, "x")
+        self.assertEqual(len(db1), 0)
+        shutil.rmtree(empty_dir)
+
+    def test_shared_events_and_sites(self):
+        db = load_database(self.pkl_dir)
+        file1 = os.path.join(self.json_dir, "shared.json")
+        with open(file1, "w") as fi1:
+            fi1.write(db.to_json())
+        db1 = GroundMotionDatabase.from_json(file1)
+        for database in [db, db1]:
+            events = {}
+            sites = {}
+            for rec in database:
+                self.assertIs(events.setdefault(rec.event.id, rec.event),
+                              rec.event)
+                self.assertIs(sites.setdefault(rec.site.id, rec.site),
+                              rec.site)
+            self.assertLess(len(events), len(database))
+        # Events are written once in the json
+        with open(file1, "r") as f:
+            raw = json.load(f)
+        self.assertEqual(len(raw["events"]), len(events))
+        self.assertTrue(all(isinstance(rec["event"], str)
+                            for rec in raw["records"]))
+
+    def test_compact_record_pickling(self):
+        db = load_database(self.pkl_dir)
+        record = db.records[0]
+        # Extra attributes are still supported
+        record.site.arc_location = "Forearc"
+        record_dict = record.to_dict()
+        self.assertEqual(record_dict["site"]["arc_location"], "Forearc")
+        record1 = pickle.loads(pickle.dumps(record))
+        self.assertEqual(record1.to_dict(), record_dict)
+        # State as pickled from the former dict based classes
+        site = record.site.__class__.__new__(record.site.__class__)
+        site.__setstate__(dict(record_dict["site"]))
+        self.assertEqual(site.to_dict(), record_dict["site"])
+        self.assertFalse(hasattr(record.event, "arc_location"))
+
+    def test_record_indices(self):
+        """
+        Tests the event and site indices of the database and that they are
+        rebuilt when the records change
+        """
+        db = load_database(self.pkl_dir)
+        events = {}
+        for iloc, record in enumerate(db.records):
+            events.setdefault(record.event.id, []).append(iloc)
+        groups = list(db.get_event_and_records())
+        self.assertEqual([evt_id for evt_id, _ in groups], list(events))
+        for evt_id, records in groups:
+            self.assertEqual(records.indices.tolist(), events[evt_id])
+            self.assertTrue(all(rec.event.id == evt_id for rec in records))
+        self.assertEqual(db._get_event_id_list().tolist(), list(events))
+        site_index = db.site_index
+        for site_id, indices in site_index.groups():
+            self.assertTrue(all(db.records[i].site.id == site_id
+                                for i in indices))
+        # The index is built once and rebuilt after the records change
+        self.assertIs(db.event_index, db.event_index)
+        evt_id = db.records[0].event.id
+        nrecs = len(db.event_index.get_group(evt_id))
+        db.records.append(db.records[0])
+        self.assertEqual(len(db.event_index.get_group(evt_id)), nrecs + 1)
+        del db.records[-1]
+        self.assertEqual(len(db.event_index.get_group(evt_id)), nrecs)
+
+    def test_context_arrays(self):
+        """
+        Tests that the contexts built from the database arrays are the same
+        for the pickle and columnar metadata, and for a plain list of records
+        """
+        db = load_database(self.pkl_dir)
+        save_database(db, self.json_dir, "hdf5")
+        db1 = load_database(self.json_dir)
+        # The event index is built from the columns, without the records
+        self.assertEqual(db1._get_event_id_list().tolist(),
+                         db._get_event_id_list().tolist())
+        self.assertEqual(db1.records.number_loaded(), 0)
+        attnames = db.sites_context_attrs + db.distances_context_attrs
+        for dic, dic1 in zip(db.get_contexts(), db1.get_contexts()):
+            self.assertEqual(dic["EventID"], dic1["EventID"])
+            records = [db.records[i] for i in db.event_index.get_group(
+                dic["EventID"])]
+            ctx2 = dic1["Ctx"].__class__()
+            db.update_context(ctx2, records)
+            for attname in attnames:
+                self.assertEqual(hasattr(dic["Ctx"], attname),
+                                 hasattr(dic1["Ctx"], attname))
+                self.assertEqual(hasattr(dic["Ctx"], attname),
+                                 hasattr(ctx2, attname))
+                if hasattr(dic["Ctx"], attname):
+                    value = getattr(dic["Ctx"], attname)
+                    for other in [dic1["Ctx"], ctx2]:
+                        self.assertEqual(getattr(other, attname).dtype,
+                                         value.dtype)
+                        np.testing.assert_array_equal(
+                            getattr(other, attname), value)
+        os.remove(os.path.join(self.json_dir, "metadatafile.hdf5"))
+
+    def test_sharded_database(self):
+        """
+        Tests the storage of the database in shards partitioned by event
+        """
+        db = load_database(self.pkl_dir)
+        db.site_ids = sorted(set(rec.site.id for rec in db))
+        shard_dir = os.path.join(self.json_dir, "sharded")
+        save_sharded_database(db, shard_dir, 3, "hdf5")
+        manifest = load_manifest(shard_dir)
+        self.assertEqual(len(manifest["shards"]), 3)
+        self.assertEqual(sum(shard["records"] for shard in manifest["shards"]),
+                         len(db))
+        record_ids = []
+        for ishard, shard in enumerate(iter_shards(shard_dir)):
+            # Shards are loaded lazily, from their own metadata
+            self.assertIsInstance(shard.records, LazyRecordList)
+            self.assertEqual(shard.records.number_loaded(), 0)
+            self.assertEqual(len(shard), manifest["shards"][ishard]["records"])
+            for evt_id in shard._get_event_id_list():
+                self.assertEqual(get_shard(evt_id, 3), ishard)
+                # All the records of an event are in the same shard
+                self.assertEqual(len(shard.event_index.get_group(evt_id)),
+                                 len(db.event_index.get_group(evt_id)))
+            record_ids.extend(rec.id for rec in shard)
+        self.assertEqual(sorted(record_ids), sorted(rec.id for rec in db))
+        self.assertEqual(len(load_database(shard_dir, 1)),
+                         manifest["shards"][1]["records"])
+        # The whole database
+        db1 = load_database(shard_dir)
+        self.assertEqual(db1.id, db.id)
+        self.assertEqual(sorted(rec.id for rec in db1), sorted(record_ids))
+        # Sites shared by the shards are merged
+        self.assertEqual(sorted(db1.site_ids), sorted(db.site_ids))
+        with self.assertRaises(ValueError):
+            load_database(shard_dir, 3)
+        with self.assertRaises(ValueError):
+            load_database(self.pkl_dir, 0)
+        shutil.rmtree(shard_dir)
+
     @classmethod
     def tearDownClass(cls):
         # Remove the directories
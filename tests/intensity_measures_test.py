@@ -158,6 +158,62 @@ class ResponseSpectrumTestCase(BaseIMSTestCase):
         self._compare_sa_sets(gmroti50, "TEST1/GMRotI50/spectra")
 
 
+class HorizontalResponseTestCase(unittest.TestCase):
+    """
+    Tests the horizontal combinations derived from the shared oscillator
+    responses against those of the rotated time series
+    """
+    def setUp(self):
+        rng = np.random.RandomState(42)
+        self.time_step = 0.01
+        time = np.arange(0., 10., self.time_step)
+        envelope = np.exp(-((time - 4.) / 2.) ** 2.)
+        self.acc_x = 100. * envelope * rng.randn(len(time))
+        # Components of different length
+        self.acc_y = np.hstack([80. * envelope * rng.randn(len(time)),
+                                rng.randn(20)])
+        self.periods = np.array([0.05, 0.1, 0.2, 0.5, 1.0, 2.0])
+        self.response = ims.HorizontalResponse(self.acc_x, self.time_step,
+                                               self.acc_y, self.time_step,
+                                               self.periods)
+
+    def _compare(self, values, expected):
+        for key in expected:
+            if key in ["Period", "angles", "periods"]:
+                continue
+            np.testing.assert_allclose(values[key], expected[key],
+                                       rtol=1E-10)
+
+    def test_rotdpp(self):
+        for percentile in [0., 50., 100.]:
+            expected = ims.rotdpp(self.acc_x, self.time_step, self.acc_y,
+                                  self.time_step, self.periods, percentile)
+            values = self.response.rotdpp(percentile)
+            self._compare(values[0], expected[0])
+            np.testing.assert_allclose(values[1], expected[1], rtol=1E-10)
+
+    def test_gmrotdpp_gmrotipp(self):
+        for percentile in [50., 100.]:
+            self._compare(self.response.gmrotdpp(percentile),
+                          ims.gmrotdpp(self.acc_x, self.time_step,
+                                       self.acc_y, self.time_step,
+                                       self.periods, percentile))
+            self._compare(self.response.gmrotipp(percentile),
+                          ims.gmrotipp(self.acc_x, self.time_step,
+                                       self.acc_y, self.time_step,
+                                       self.periods, percentile))
+
+    def test_spectrum_pair(self):
+        sax, say = ims.get_response_spectrum_pair(self.acc_x, self.time_step,
+                                                  self.acc_y, self.time_step,
+                                                  self.periods)
+        self._compare(self.response.get_spectrum_pair()[0], sax)
+        self._compare(self.response.get_spectrum_pair()[1], say)
+        with self.assertRaises(ValueError):
+            ims.HorizontalResponse(self.acc_x, self.time_step, self.acc_y,
+                                   2. * self.time_step, self.periods)
+
+
 class ScalarIntensityMeasureTestCase(BaseIMSTestCase):
     """
     Tests the functions returning scalar intensity measures
@@ -1,6 +1,10 @@
 import os
 import unittest
-from smtk.parsers.asa_database_parser import ASADatabaseMetadataReader
+import tempfile
+import numpy as np
+from smtk.parsers.asa_database_parser import ASADatabaseMetadataReader,\
+    ASATimeSeriesParser
+from smtk.parsers.base_database_parser import read_numeric_block
 from openquake.hazardlib import valid
 
 
@@ -76,3 +80,62 @@ class ASA_MetadataParsertest(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         cls.database = None
+
+
+class ASA_TimeSeriesParserTest(unittest.TestCase):
+    """
+    Tests that the 3 components are parsed from the columns of their names
+    """
+    def test_components(self):
+        ifile = os.path.join(BASE_DATA_PATH, "correct_ASA_files",
+                             "ACAC8903.101")
+        # Columns "V", "N90E" and "N00E"
+        data = np.genfromtxt(ifile, skip_header=109, encoding="iso-8859-1")
+        time_series = ASATimeSeriesParser([ifile] * 3).parse_records()
+        for component, column in [("X", 1), ("Y", 2), ("V", 0)]:
+            output = time_series[component]["Original"]
+            np.testing.assert_array_equal(output["Acceleration"],
+                                          data[:, column])
+            self.assertEqual(output["Number Steps"], data.shape[0])
+            self.assertAlmostEqual(output["Time-step"], 0.01)
+
+
+class ReadNumericBlockTestCase(unittest.TestCase):
+    """
+    Tests the reader of the numeric blocks of the ASCII files against
+    np.genfromtxt
+    """
+    def test_asa_files(self):
+        filepath = os.path.join(BASE_DATA_PATH, "correct_ASA_files")
+        for fname in sorted(os.listdir(filepath)):
+            ifile = os.path.join(filepath, fname)
+            expected = np.genfromtxt(ifile, skip_header=109,
+                                     encoding="iso-8859-1")
+            np.testing.assert_array_equal(
+                read_numeric_block(ifile, skip_header=109), expected)
+            np.testing.assert_array_equal(
+                read_numeric_block(ifile, skip_header=109, usecols=2),
+                expected[:, 2])
+
+    def test_fortran_exponents(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt",
+                                         delete=False) as f:
+            f.write("HEADER\n1.0D+02 -2.5E-01\n 3.0d-1 4.0D2\n")
+        try:
+            np.testing.assert_allclose(read_numeric_block(f.name, 1),
+                                       [[100., -0.25], [0.3, 400.]])
+            np.testing.assert_allclose(read_numeric_block(f.name, 1, 0),
+                                       [100., 0.3])
+        finally:
+            os.remove(f.name)
+
+    def test_adjacent_negative_columns(self):
+        # Fixed width columns without separator are not read as exponents
+        with tempfile.NamedTemporaryFile("w", suffix=".txt",
+                                         delete=False) as f:
+            f.write("HEADER\n12.5-30\n-1.5-20\n")
+        try:
+            with self.assertRaises(ValueError):
+                read_numeric_block(f.name, 1)
+        finally:
+            os.remove(f.name)
@@ -21,9 +21,13 @@ Tests for execution of ESM Flatfile Parser
 """
 import os
 import sys
+import csv
 import shutil
 import unittest
-from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
+import h5py
+import numpy as np
+from linecache import getline
+from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser, ESMColumnPlan
 
 if sys.version_info[0] >= 3:
     import pickle
@@ -104,6 +108,62 @@ class ESMFlatfileParserTestCase(unittest.TestCase):
         self.assertListEqual([rec.id for rec in db], TARGET_IDS)
         del parser
 
+    def test_chunked_parsing(self):
+        """
+        Tests that the parsing of the flatfile in blocks by a pool of
+        processes gives the records of the sequential parsing
+        """
+        databases = []
+        for workers in [None, 2]:
+            location = self.db_file + "_%s" % workers
+            os.makedirs(os.path.join(location, "records"))
+            parser = ESMFlatfileParser("000", "ESM Test", self.datafile)
+            parser.parse(location=location, workers=workers, chunk_size=15)
+            databases.append(parser.database)
+        seq_db, db = databases
+        try:
+            self.assertListEqual([rec.id for rec in db], TARGET_IDS)
+            # Events and sites are shared across the blocks
+            events = dict((rec.event.id, rec.event) for rec in db)
+            for rec, seq_rec in zip(db, seq_db):
+                self.assertIs(rec.event, events[rec.event.id])
+                self.assertEqual(rec.event.to_dict(),
+                                 seq_rec.event.to_dict())
+                self.assertEqual(rec.site.to_dict(), seq_rec.site.to_dict())
+            self.assertEqual(len(set(id(rec.event) for rec in db)),
+                             len(set(id(rec.event) for rec in seq_db)))
+            loc = "IMS/H/Spectra/Response/Acceleration/Geometric/damping_05"
+            for rec, seq_rec in zip(db, seq_db):
+                with h5py.File(rec.datafile, "r") as fle1,\
+                        h5py.File(seq_rec.datafile, "r") as fle2:
+                    np.testing.assert_array_equal(fle1[loc][:],
+                                                  fle2[loc][:])
+        finally:
+            for workers in [None, 2]:
+                shutil.rmtree(self.db_file + "_%s" % workers)
+
+    def test_column_plan(self):
+        """
+        Tests the mapping of the ground motion columns
+        """
+        headers = getline(self.datafile, 1).rstrip("\n").split(";")
+        plan = ESMColumnPlan(headers)
+        self.assertListEqual([scalar for scalar, _ in plan.scalars["U"]],
+                             ["pga", "pgv", "pgd", "T90", "housner", "CAV",
+                              "ia"])
+        spectra_headers, periods = plan.spectra["U"]
+        self.assertTrue(np.all(np.diff(periods) > 0.))
+        self.assertNotIn("U_T90", spectra_headers)
+        with open(self.datafile, "r") as f:
+            row = next(csv.DictReader(f, delimiter=";"))
+        scalars, spectra = plan.decode(row)
+        self.assertAlmostEqual(scalars["U"]["pga"],
+                               abs(float(row["U_pga"])))
+        i = spectra_headers.index("U_T1_000")
+        self.assertAlmostEqual(spectra["U"]["Values"][i],
+                               abs(float(row["U_T1_000"])))
+        self.assertAlmostEqual(periods[i], 1.0)
+
     @classmethod
     def tearDownClass(cls):
         """
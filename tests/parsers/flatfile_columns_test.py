@@ -0,0 +1,116 @@
+"""
+Tests the columnar ingestion of the flatfiles
+"""
+import os
+import csv
+import unittest
+import tempfile
+import numpy as np
+from smtk.parsers.base_database_parser import FlatfileColumns, get_float
+from smtk.parsers import valid
+from smtk.parsers.esm_flatfile_parser import ESMColumnPlan, ESMGroundMotion,\
+    ESMMetadata
+from smtk.parsers.general_flatfile_parser import GeneralFlatfileParser
+
+ESM_FLATFILE = os.path.join(os.path.dirname(__file__), "..", "file_samples",
+                            "esm_sa_flatfile_2018.csv")
+
+EVENT_HEADERS = ["Record Sequence Number", "Year", "Month", "Day",
+                 "Epicenter Longitude (deg; positive E)",
+                 "Epicenter Latitude (deg; positive N)",
+                 "Hypocenter Depth (km)", "Magnitude", "PGA", "SA(1.0)"]
+
+
+class FlatfileColumnsTestCase(unittest.TestCase):
+    """
+    Tests the columnar reading and validation of the flatfiles against the
+    row by row reading
+    """
+    def setUp(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv",
+                                         delete=False) as f:
+            writer = csv.writer(f)
+            writer.writerow(EVENT_HEADERS)
+            # Valid record
+            writer.writerow(["1", "2000", "1", "1", "10.", "45.", "10.",
+                             "5.0", "0.1", "0.01"])
+            # Null ground motion
+            writer.writerow(["2", "2000", "1", "1", "10.", "45.", "10.",
+                             "5.0", "", "-1"])
+            # Invalid month
+            writer.writerow(["3", "2000", "13", "1", "10.", "45.", "10.",
+                             "5.0", "0.1", "0.01"])
+            # Missing magnitude and invalid depth (short row)
+            writer.writerow(["4", "2000", "1", "1", "10.", "45.", "x", ""])
+        self.filename = f.name
+
+    def test_columns(self):
+        columns = FlatfileColumns(self.filename)
+        self.assertEqual(len(columns), 4)
+        with open(self.filename, "r") as f:
+            rows = list(csv.DictReader(f, restval=""))
+        self.assertListEqual([columns.get_row(i) for i in range(4)], rows)
+        np.testing.assert_array_equal(
+            columns.get_floats("Hypocenter Depth (km)"),
+            [10., 10., 10., np.nan])
+        self.assertEqual(columns.get_floats(["PGA", "SA(1.0)"]).shape,
+                         (4, 2))
+
+    def test_general_flatfile_validation(self):
+        parser = GeneralFlatfileParser("1", "test", self.filename)
+        columns = FlatfileColumns(self.filename)
+        np.testing.assert_array_equal(parser._sanitise_columns(columns),
+                                      [True, False, True, False])
+        np.testing.assert_array_equal(parser._verify_event_columns(columns),
+                                      [True, True, False, False])
+
+    def test_float_rows(self):
+        parser = GeneralFlatfileParser("1", "test", self.filename)
+        parser.FLOAT_COLUMNS = ["Hypocenter Depth (km)", "Magnitude"]
+        columns = FlatfileColumns(self.filename)
+        values = parser._get_float_rows(columns)
+        for irow in range(len(columns)):
+            row = columns.get_row(irow)
+            self.assertDictEqual(
+                values[irow],
+                dict((header, get_float(row[header]))
+                     for header in parser.FLOAT_COLUMNS))
+        self.assertIsNone(values[3]["Magnitude"])
+
+    def test_esm_ground_motion(self):
+        columns = FlatfileColumns(ESM_FLATFILE, delimiter=";")
+        plan = ESMColumnPlan(columns.headers)
+        ground_motion = ESMGroundMotion(plan, columns)
+        for irow in range(len(columns)):
+            scalars, spectra = plan.decode(columns.get_row(irow))
+            col_scalars, col_spectra = ground_motion.get_row(irow)
+            self.assertEqual(col_scalars, scalars)
+            for imt in spectra:
+                np.testing.assert_array_equal(col_spectra[imt]["Values"],
+                                              spectra[imt]["Values"])
+                np.testing.assert_array_equal(col_spectra[imt]["Periods"],
+                                              spectra[imt]["Periods"])
+
+    def test_esm_metadata(self):
+        columns = FlatfileColumns(ESM_FLATFILE, delimiter=";")
+        # Missing epicentral distance and invalid depth: rows not parsable
+        columns.data[1, columns.headers.index("epi_dist")] = ""
+        columns.data[2, columns.headers.index("ev_depth_km")] = "x"
+        metadata = ESMMetadata(columns)
+        np.testing.assert_array_equal(np.where(metadata.errors)[0], [1, 2])
+        # Other rows converted as by the row by row validation
+        row = columns.get_row(0)
+        values = metadata.get_row(0)
+        self.assertEqual(values["event_time"],
+                         valid.date_time(row["event_time"]))
+        self.assertEqual(values["ev_latitude"],
+                         valid.latitude(row["ev_latitude"]))
+        self.assertEqual(values["epi_dist"],
+                         valid.positive_float(row["epi_dist"], "epi_dist"))
+        self.assertEqual(values["Rx_dist"],
+                         valid.vfloat(row["Rx_dist"], "Rx_dist"))
+        self.assertEqual(values["vs30_m_sec"],
+                         valid.vfloat(row["vs30_m_sec"], "vs30_m_sec"))
+
+    def tearDown(self):
+        os.remove(self.filename)
@@ -0,0 +1,106 @@
+"""
+Tests the ContextDB reading the records directly from the flatfiles
+"""
+import os
+import shutil
+import unittest
+import numpy as np
+from smtk.sm_database import load_database
+from smtk.sm_utils import convert_accel_units
+from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
+from smtk.residuals.flatfile_context_db import FlatfileContextDB, \
+    get_flatfile_format
+
+
+SAMPLES_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                            "file_samples")
+
+IMTS = ["PGA", "PGV", "SA(0.2)", "SA(1.0)"]
+
+
+class FlatfileContextDBTestCase(unittest.TestCase):
+    """
+    Tests the FlatfileContextDB against the database built from the same
+    flatfile
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.esm_file = os.path.join(SAMPLES_PATH, "esm_sa_flatfile_2018.csv")
+        cls.nga_file = os.path.join(SAMPLES_PATH, "ngawest2_flatfile.csv")
+        cls.template_file = os.path.join(SAMPLES_PATH,
+                                         "template_basic_flatfile.csv")
+        cls.out_location = os.path.join(os.path.dirname(__file__),
+                                        "flatfile_context_db")
+        ESMFlatfileParser.autobuild("000", "ESM", cls.out_location,
+                                    cls.esm_file)
+
+    def test_flatfile_format(self):
+        self.assertEqual(get_flatfile_format(self.esm_file), "esm2018")
+        self.assertEqual(get_flatfile_format(self.nga_file), "ngawest2")
+        self.assertEqual(get_flatfile_format(self.template_file), "template")
+        with self.assertRaises(ValueError):
+            FlatfileContextDB(self.esm_file, "esm2019")
+
+    def test_esm_contexts(self):
+        """
+        Tests that contexts and observations are the same as those of the
+        database built from the ESM flatfile
+        """
+        database = load_database(self.out_location)
+        flatfile_db = FlatfileContextDB(self.esm_file)
+        self.assertEqual(len(flatfile_db), len(database))
+        self.assertEqual(flatfile_db.columns["record_id"],
+                         [rec.id for rec in database])
+        contexts = list(database.get_contexts(imts=IMTS))
+        flatfile_contexts = list(flatfile_db.get_contexts(imts=IMTS))
+        self.assertEqual(len(contexts), len(flatfile_contexts))
+        for dic, flatfile_dic in zip(contexts, flatfile_contexts):
+            self.assertEqual(dic["EventID"], flatfile_dic["EventID"])
+            self.assertEqual(dic["Num. Sites"], flatfile_dic["Num. Sites"])
+            ctx, flatfile_ctx = vars(dic["Ctx"]), vars(flatfile_dic["Ctx"])
+            self.assertEqual(sorted(ctx), sorted(flatfile_ctx))
+            for attname in ctx:
+                np.testing.assert_allclose(
+                    np.asarray(flatfile_ctx[attname], dtype=float),
+                    np.asarray(ctx[attname], dtype=float), rtol=1E-6)
+            for imtx in IMTS:
+                np.testing.assert_allclose(
+                    flatfile_dic["Observations"][imtx],
+                    dic["Observations"][imtx], rtol=1E-5)
+
+    def test_single_component_flatfiles(self):
+        """
+        Tests the NGA-West2 flatfile and the template flatfile (same
+        records)
+        """
+        nga_db = FlatfileContextDB(self.nga_file)
+        template_db = FlatfileContextDB(self.template_file)
+        self.assertEqual(list(nga_db.observations), ["RotD50"])
+        # The single component is returned for the default component
+        nga = nga_db.get_stacked_context(imts=IMTS)
+        template = template_db.get_stacked_context(imts=IMTS,
+                                                   component="RotD50")
+        nrecs = len(nga_db)
+        self.assertEqual(nga["Num. Sites"], nrecs)
+        self.assertEqual(len(nga["EventID"]),
+                         len(set(nga_db.columns["event_id"])))
+        # Accelerations converted from g
+        self.assertAlmostEqual(nga["Observations"][0, 0],
+                               convert_accel_units(0.15702, "g"))
+        np.testing.assert_allclose(template["Observations"][:nrecs, 1:],
+                                   nga["Observations"][:, 1:])
+        for attname in ["mag", "vs30", "rjb", "rrup", "rx"]:
+            np.testing.assert_allclose(
+                getattr(template["Ctx"], attname)[:nrecs],
+                getattr(nga["Ctx"], attname))
+        # Unless the component is given
+        rotd50_db = FlatfileContextDB(self.nga_file, component="RotD50")
+        np.testing.assert_allclose(
+            rotd50_db.get_observation_column("PGA", "RotD50"),
+            nga_db.get_observation_column("PGA"))
+        with self.assertRaises(ValueError):
+            rotd50_db.get_observation_column("PGA", "Geometric")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.out_location)
@@ -5,6 +5,10 @@ import os
 import sys
 import shutil
 import unittest
+import warnings
+from collections import OrderedDict
+import numpy as np
+from openquake.hazardlib import const, imt
 from smtk.parsers.esm_flatfile_parser import ESMFlatfileParser
 import smtk.residuals.gmpe_residuals as res
 
@@ -74,6 +78,114 @@ class ResidualsTestCase(unittest.TestCase):
         self.assertListEqual([rec.id for rec in self.database],
                              EXPECTED_IDS)
 
+    def test_observation_matrix(self):
+        """
+        Verifies that the observations extracted in a single pass match
+        those read one IMT at a time
+        """
+        imts = ["PGA", "SA(0.2)", "SA(1.0)", "PGV", "SA(0.2)"]
+        expected = OrderedDict()
+        for evt_id, records in self.database.get_event_and_records():
+            expected[evt_id] = dict(
+                (imtx, self.database.get_observations(imtx, list(records)))
+                for imtx in imts)
+        for ctx in self.database.get_contexts(imts=imts):
+            self.assertListEqual(list(ctx["Observations"]), imts[:4])
+            for imtx, values in ctx["Observations"].items():
+                np.testing.assert_array_equal(
+                    values, expected[ctx["EventID"]][imtx])
+        self.assertIsNone(self.database._observations)
+
+    def test_observation_cache(self):
+        """
+        Verifies that the observations are read from the cache file unless
+        the record files change
+        """
+        database = pickle.loads(pickle.dumps(self.database))
+        self.assertEqual(database.directory, self.out_location)
+        cache_file = os.path.join(self.out_location,
+                                  "observations_Geometric.hdf5")
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        imts = ["PGA", "SA(1.0)"]
+        expected = database.get_database_observations(imts)
+        self.assertTrue(os.path.exists(cache_file))
+        # Count the records read from their files
+        read_records = []
+        get_observation_matrix = database.get_observation_matrix
+
+        def counted(imtx, records, component="Geometric"):
+            read_records.extend(rec.id for rec in records)
+            return get_observation_matrix(imtx, records, component)
+        database.get_observation_matrix = counted
+        np.testing.assert_array_equal(
+            database.get_database_observations(imts), expected)
+        self.assertListEqual(read_records, [])
+        # A new imt is read for all the records
+        values = database.get_database_observations(["SA(0.2)", "PGA"])
+        np.testing.assert_array_equal(values[:, 1], expected[:, 0])
+        self.assertEqual(len(read_records), len(database))
+        # Only the changed record is read again
+        del read_records[:]
+        record = database.records[5]
+        stat = os.stat(record.datafile)
+        os.utime(record.datafile, ns=(stat.st_atime_ns,
+                                      stat.st_mtime_ns + 10 ** 9))
+        np.testing.assert_array_equal(
+            database.get_database_observations(imts), expected)
+        self.assertListEqual(read_records, [record.id])
+
+    def test_corrupt_observation_cache(self):
+        """
+        Verifies that a corrupt cache file is reported and rebuilt
+        """
+        database = pickle.loads(pickle.dumps(self.database))
+        cache_file = os.path.join(self.out_location,
+                                  "observations_Geometric.hdf5")
+        imts = ["PGA", "SA(1.0)"]
+        expected = database.get_observation_matrix(imts, database.records)
+        with open(cache_file, "wb") as f:
+            f.write(b"not an hdf5 file")
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            np.testing.assert_array_equal(
+                database.get_database_observations(imts), expected)
+        self.assertTrue(any("not readable" in str(warning.message)
+                            for warning in caught))
+        # Read back from the rebuilt cache
+        database.get_observation_matrix = None
+        np.testing.assert_array_equal(
+            database.get_database_observations(imts), expected)
+
+    def test_stacked_context(self):
+        """
+        Verifies that the stacked context gives the same expected motions
+        and observations as the contexts of the single events
+        """
+        gsim = res.Residuals(self.gsims, self.imts).gmpe_list["ChiouYoungs2014"]
+        stddev_types = [const.StdDev.TOTAL]
+        contexts = list(self.database.get_contexts(imts=self.imts))
+        stacked = self.database.get_stacked_context(imts=self.imts)
+        self.assertListEqual(stacked["EventID"],
+                             [ctx["EventID"] for ctx in contexts])
+        self.assertEqual(stacked["Num. Sites"], 41)
+        self.assertListEqual(stacked["IMTs"], self.imts)
+        ctx = stacked["Ctx"]
+        for i, imtx in enumerate(self.imts):
+            mean, _ = gsim.get_mean_and_stddevs(ctx, ctx, ctx,
+                                                imt.from_string(imtx),
+                                                stddev_types)
+            for j, context in enumerate(contexts):
+                idx = stacked["Event Index"] == j
+                np.testing.assert_array_equal(
+                    stacked["Observations"][idx, i],
+                    context["Observations"][imtx])
+                ectx = context["Ctx"]
+                emean, _ = gsim.get_mean_and_stddevs(ectx, ectx, ectx,
+                                                     imt.from_string(imtx),
+                                                     stddev_types)
+                np.testing.assert_allclose(mean[idx], emean)
+
     def _check_residual_dictionary_correctness(self, res_dict):
         """
         Basic check for correctness of the residual dictionary
@@ -0,0 +1,493 @@
+"""
+Tests the construction and the update of a database with the
+SMDatabaseBuilder
+"""
+import os
+import csv
+import shutil
+import unittest
+import h5py
+import numpy as np
+from smtk.sm_utils import HDF5Layout, SCALAR_COMPOUND, convert_accel_units
+from smtk.sm_database import load_database, build_im_store, IMStore, IM_STORE
+from smtk.sm_database_builder import SMDatabaseBuilder, SOURCE_MANIFEST,\
+    add_horizontal_im, has_horizontal_im
+from smtk.parsers.base_database_parser import SMDatabaseReader
+from smtk.parsers.sigma_database_parser import SigmaDatabaseMetadataReader,\
+    SigmaRecordParser, SigmaSpectraParser
+
+
+BASE_DATA_PATH = os.path.join(os.path.dirname(__file__), "hazard", "data",
+                              "LAquila_Good_Records")
+
+
+class DatabaseUpdateTestCase(unittest.TestCase):
+    """
+    Tests the update of an existing database with new and changed records
+    """
+    def setUp(self):
+        self.record_dir = "laquila_records"
+        self.db_dir = "laquila_db"
+        record_ids = sorted(os.listdir(BASE_DATA_PATH))
+        os.mkdir(self.record_dir)
+        for record_id in record_ids[:10]:
+            shutil.copytree(os.path.join(BASE_DATA_PATH, record_id),
+                            os.path.join(self.record_dir, record_id))
+        self.new_ids = record_ids[10:]
+
+    def _build(self, update=False):
+        """
+        Builds the database and returns the ids of the records parsed
+        """
+        builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, self.db_dir,
+                                    update=update)
+        builder.build_database("001", "LAquila", self.record_dir)
+        parsed = []
+        build_time_series_hdf5 = builder.build_time_series_hdf5
+
+        def build(record, sm_data, record_dir):
+            parsed.append(record.id)
+            return build_time_series_hdf5(record, sm_data, record_dir)
+        builder.build_time_series_hdf5 = build
+        builder.parse_records(SigmaRecordParser, SigmaSpectraParser)
+        return parsed
+
+    def test_update(self):
+        self.assertEqual(len(self._build()), 10)
+        with self.assertRaises(IOError):
+            SMDatabaseBuilder(SigmaDatabaseMetadataReader, self.db_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.db_dir,
+                                                    SOURCE_MANIFEST)))
+        # Nothing changed: no record is parsed
+        self.assertEqual(self._build(update=True), [])
+        self.assertEqual(len(load_database(self.db_dir)), 10)
+        # New records and a changed record
+        for record_id in self.new_ids:
+            shutil.copytree(os.path.join(BASE_DATA_PATH, record_id),
+                            os.path.join(self.record_dir, record_id))
+        changed = sorted(os.listdir(self.record_dir))[0]
+        with open(os.path.join(self.record_dir, changed,
+                               changed + "_H1.cor.acc"), "a") as f:
+            f.write("\n")
+        parsed = self._build(update=True)
+        self.assertEqual(sorted(parsed), sorted([changed] + self.new_ids))
+        database = load_database(self.db_dir)
+        self.assertEqual(len(database), 10 + len(self.new_ids))
+        for rec in database:
+            self.assertTrue(os.path.exists(rec.datafile))
+
+    def tearDown(self):
+        shutil.rmtree(self.record_dir)
+        if os.path.exists(self.db_dir):
+            shutil.rmtree(self.db_dir)
+
+
+class ParallelParsingTestCase(unittest.TestCase):
+    """
+    Tests the parsing of the records in a pool of processes
+    """
+    def setUp(self):
+        self.record_dir = "laquila_parallel_records"
+        os.mkdir(self.record_dir)
+        self.record_ids = sorted(os.listdir(BASE_DATA_PATH))[:4]
+        for record_id in self.record_ids:
+            shutil.copytree(os.path.join(BASE_DATA_PATH, record_id),
+                            os.path.join(self.record_dir, record_id))
+        self.db_dirs = []
+
+    def _build(self, workers, skip_failed=False):
+        db_dir = "laquila_parallel_db_%d" % len(self.db_dirs)
+        self.db_dirs.append(db_dir)
+        builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, db_dir)
+        builder.build_database("001", "LAquila", self.record_dir)
+        builder.parse_records(SigmaRecordParser, SigmaSpectraParser,
+                              workers=workers, skip_failed=skip_failed)
+        return load_database(db_dir)
+
+    def test_parallel_parsing(self):
+        sequential = self._build(None)
+        parallel = self._build(2)
+        self.assertEqual([rec.id for rec in parallel],
+                         [rec.id for rec in sequential])
+        for rec, seq_rec in zip(parallel, sequential):
+            self.assertEqual(os.path.basename(rec.datafile),
+                             os.path.basename(seq_rec.datafile))
+            with h5py.File(rec.datafile, "r") as fle,\
+                    h5py.File(seq_rec.datafile, "r") as seq_fle:
+                for loc in ["Time Series/X/Original Record/Acceleration",
+                            "IMS/X/Spectra/Response/Acceleration/damping_05"]:
+                    np.testing.assert_array_equal(fle[loc][:],
+                                                  seq_fle[loc][:])
+
+    def test_failed_record(self):
+        failed = self.record_ids[1]
+        with open(os.path.join(self.record_dir, failed,
+                               failed + "_H1.cor.acc"), "w") as f:
+            f.write("not a record\n")
+        # By default the error is raised
+        for workers in [None, 2]:
+            with self.assertRaises(Exception):
+                self._build(workers)
+        # Otherwise the corrupted record is reported and left out of the
+        # database
+        database = self._build(2, skip_failed=True)
+        self.assertEqual(sorted(rec.id for rec in database),
+                         [rec_id for rec_id in self.record_ids
+                          if rec_id != failed])
+        self.assertFalse(os.path.exists(
+            os.path.join(self.db_dirs[-1], "records", failed + ".hdf5")))
+
+    def tearDown(self):
+        shutil.rmtree(self.record_dir)
+        for db_dir in self.db_dirs:
+            if os.path.exists(db_dir):
+                shutil.rmtree(db_dir)
+
+
+def get_datasets(fle, location):
+    """
+    Returns a dictionary of the values of all the datasets under a location
+    of a hdf5 file
+    """
+    values = {}
+    fle[location].visititems(
+        lambda name, obj: values.update({name: obj[()]})
+        if isinstance(obj, h5py.Dataset) else None)
+    return values
+
+
+class HorizontalIMTestCase(unittest.TestCase):
+    """
+    Tests the resumable and parallel calculation of the horizontal
+    intensity measures
+    """
+    IMS = ["PGA", "PGV", "Geometric", "RotD50", "GMRotD50", "GMRotI50"]
+
+    PERIODS = np.array([0.1, 0.2, 0.5, 1.0])
+
+    def setUp(self):
+        self.record_dir = "laquila_horizontal_records"
+        os.mkdir(self.record_dir)
+        for record_id in sorted(os.listdir(BASE_DATA_PATH))[:3]:
+            shutil.copytree(os.path.join(BASE_DATA_PATH, record_id),
+                            os.path.join(self.record_dir, record_id))
+        self.db_dirs = []
+        self.checkpoint = "horizontal_im_checkpoint.txt"
+
+    def _build(self):
+        db_dir = "laquila_horizontal_db_%d" % len(self.db_dirs)
+        self.db_dirs.append(db_dir)
+        builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, db_dir)
+        builder.build_database("001", "LAquila", self.record_dir)
+        builder.parse_records(SigmaRecordParser, SigmaSpectraParser)
+        return load_database(db_dir)
+
+    def test_resumed_parallel_run(self):
+        serial = self._build()
+        # Without the read-ahead of the record files
+        add_horizontal_im(serial, self.IMS, periods=self.PERIODS, workers=1)
+        database = self._build()
+        # An earlier run with fewer IMs
+        add_horizontal_im(database, ["PGA"])
+        # Interrupted after the first record
+        partial = load_database(self.db_dirs[-1])
+        partial.records = partial.records[:1]
+        add_horizontal_im(partial, self.IMS, periods=self.PERIODS,
+                          checkpoint=self.checkpoint)
+        with open(self.checkpoint, "r") as f:
+            self.assertEqual(len(f.read().splitlines()), 2)
+        # Resumed on all records
+        add_horizontal_im(database, self.IMS, periods=self.PERIODS,
+                          processes=2, checkpoint=self.checkpoint)
+        with open(self.checkpoint, "r") as f:
+            self.assertEqual(len(f.read().splitlines()), 4)
+        # Nothing left to compute
+        add_horizontal_im(database, self.IMS, periods=self.PERIODS)
+        for rec, serial_rec in zip(database, serial):
+            with h5py.File(rec.datafile, "r") as fle,\
+                    h5py.File(serial_rec.datafile, "r") as serial_fle:
+                for i_m in self.IMS:
+                    self.assertTrue(has_horizontal_im(fle, i_m))
+                values = get_datasets(fle, "IMS/H")
+                serial_values = get_datasets(serial_fle, "IMS/H")
+                self.assertEqual(sorted(values), sorted(serial_values))
+                for key in values:
+                    np.testing.assert_array_equal(values[key],
+                                                  serial_values[key])
+
+    def test_non_integer_damping(self):
+        database = self._build()
+        ims = ["Geometric", "RotD50"]
+        for damping in ["2.5", "29"]:
+            add_horizontal_im(database, ims, damping=damping,
+                              periods=self.PERIODS)
+        loc = "IMS/H/Spectra/Response/Acceleration/Geometric/"
+        for rec in database:
+            with h5py.File(rec.datafile, "r") as fle:
+                # Found again when resuming, and not confused with 2 %
+                for i_m in ims:
+                    self.assertTrue(has_horizontal_im(fle, i_m,
+                                                      damping="2.5"))
+                    self.assertTrue(has_horizontal_im(fle, i_m,
+                                                      damping="29"))
+                    self.assertFalse(has_horizontal_im(fle, i_m,
+                                                       damping="2"))
+                self.assertTrue(np.all(fle[loc + "damping_02.5"][:] >
+                                       fle[loc + "damping_29"][:]))
+
+    def tearDown(self):
+        shutil.rmtree(self.record_dir)
+        for db_dir in self.db_dirs:
+            if os.path.exists(db_dir):
+                shutil.rmtree(db_dir)
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+
+class SpectraFlatfileTestCase(unittest.TestCase):
+    """
+    Tests the construction of the record spectra from a flatfile
+    """
+    def setUp(self):
+        self.db_dirs = []
+        self.flatfile = "laquila_spectra_flatfile.csv"
+        self.record_ids = sorted(os.listdir(BASE_DATA_PATH))
+        self.spectra = np.outer(np.arange(1., len(self.record_ids) + 1.),
+                                [0.1, 0.2, 0.05])
+        with open(self.flatfile, "w") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Record Sequence Number", "PGA (g)",
+                             "PGV (cm/s)", "SA(0.1)", "SA(0.5)", "SA(1.0)"])
+            # Record not in the database
+            writer.writerow(["99999", "0.1", "1.0", "0.1", "0.1", "0.1"])
+            for i, record_id in enumerate(self.record_ids):
+                writer.writerow([record_id, self.spectra[i, 0],
+                                 "" if i == 0 else 2. * i] +
+                                list(self.spectra[i]))
+
+    def _build(self, consolidated):
+        db_dir = "laquila_spectra_db_%d" % len(self.db_dirs)
+        self.db_dirs.append(db_dir)
+        builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, db_dir)
+        builder.build_database("001", "LAquila", BASE_DATA_PATH)
+        builder.dbreader.filename = self.flatfile
+        builder.build_spectra_from_flatfile("Geometric", units="g",
+                                            consolidated=consolidated)
+        return db_dir
+
+    def test_record_files(self):
+        database = load_database(self._build(False))
+        self.assertEqual(len(database), len(self.record_ids))
+        for rec in database:
+            i = self.record_ids.index(rec.id)
+            with h5py.File(rec.datafile, "r") as fle:
+                np.testing.assert_allclose(
+                    fle["IMS/H/Spectra/Response/Acceleration/Geometric/"
+                        "damping_05"][:],
+                    convert_accel_units(self.spectra[i], "g"), rtol=1E-6)
+                pgv = fle["IMS/H/Scalar/PGV"][0]
+                if i == 0:
+                    self.assertTrue(np.isnan(pgv))
+                else:
+                    self.assertAlmostEqual(pgv, 2. * i, 5)
+
+    def test_consolidated(self):
+        db_dir = self._build(True)
+        with h5py.File(os.path.join(db_dir, IM_STORE), "r") as fle:
+            self.assertEqual([rec_id.decode("utf-8")
+                              for rec_id in fle["record_id"][:]],
+                             self.record_ids)
+            np.testing.assert_allclose(fle["periods"][:], [0.1, 0.5, 1.0])
+            np.testing.assert_allclose(
+                fle["spectra/Geometric/damping_05"][:],
+                convert_accel_units(self.spectra, "g"), rtol=1E-6)
+            np.testing.assert_allclose(
+                fle["scalar/Geometric/PGA"][:],
+                convert_accel_units(self.spectra[:, 0], "g"), rtol=1E-6)
+        # The observations are read from the store (no record files)
+        database = load_database(db_dir)
+        order = [self.record_ids.index(rec.id) for rec in database]
+        np.testing.assert_allclose(
+            database.get_observation_matrix(["PGA", "SA(0.5)"],
+                                            database.records),
+            convert_accel_units(self.spectra[order, :2], "g"), rtol=1E-6)
+        # IMTs not in the store cannot be read from record files
+        with self.assertRaises(ValueError):
+            database.get_database_observations(["PGA"], "RotD50")
+
+    def tearDown(self):
+        os.remove(self.flatfile)
+        for db_dir in self.db_dirs:
+            if os.path.exists(db_dir):
+                shutil.rmtree(db_dir)
+
+
+class HDF5LayoutTestCase(unittest.TestCase):
+    """
+    Tests that the compressed and compound layouts of the record files
+    store the same values as the default layout
+    """
+    IMTS = ["PGA", "PGV", "SA(0.2)", "SA(1.0)"]
+
+    def setUp(self):
+        self.record_dir = "laquila_layout_records"
+        os.mkdir(self.record_dir)
+        for record_id in sorted(os.listdir(BASE_DATA_PATH))[:3]:
+            shutil.copytree(os.path.join(BASE_DATA_PATH, record_id),
+                            os.path.join(self.record_dir, record_id))
+        self.db_dirs = []
+
+    def _build(self, layout):
+        """
+        Builds the database of three of the L'Aquila records with the given
+        layout, adding the horizontal IMs
+        """
+        db_dir = "laquila_db_%d" % len(self.db_dirs)
+        self.db_dirs.append(db_dir)
+        builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, db_dir,
+                                    layout=layout)
+        builder.build_database("001", "LAquila", self.record_dir)
+        builder.parse_records(SigmaRecordParser, SigmaSpectraParser)
+        database = load_database(db_dir)
+        add_horizontal_im(database, ["PGA", "PGV", "Geometric"],
+                          periods=np.array([0.1, 0.2, 0.5, 1.0, 2.0]),
+                          layout=layout)
+        database.cache_observations = False
+        return database
+
+    def test_layouts(self):
+        database = self._build(None)
+        expected = database.get_observation_matrix(self.IMTS,
+                                                   database.records)
+        for layout in [HDF5Layout("gzip", 4, shuffle=True),
+                       HDF5Layout("lzf", compound_scalars=True)]:
+            layout_db = self._build(layout)
+            np.testing.assert_allclose(
+                layout_db.get_observation_matrix(self.IMTS,
+                                                 layout_db.records),
+                expected)
+            with h5py.File(layout_db.records[0].datafile, "r") as fle:
+                acc = fle["Time Series/X/Original Record/Acceleration"]
+                self.assertEqual(acc.compression, layout.compression)
+                self.assertEqual(SCALAR_COMPOUND in fle["IMS/H/Scalar"],
+                                 layout.compound_scalars)
+                self.assertAlmostEqual(
+                    layout_db.get_scalar(fle, "PGA"),
+                    expected[0, 0], 4)
+                with self.assertRaises(ValueError):
+                    layout_db.get_scalar(fle, "CAV")
+        with self.assertRaises(ValueError):
+            HDF5Layout("szip")
+
+    def test_im_store(self):
+        database = self._build(None)
+        expected = database.get_observation_matrix(self.IMTS,
+                                                   database.records)
+        self.assertIsNone(database.get_im_store())
+        build_im_store(database)
+        store = database.get_im_store()
+        self.assertIsInstance(store, IMStore)
+        self.assertEqual(store.record_ids,
+                         [rec.id for rec in database.records])
+        self.assertTrue(store.has_imts(self.IMTS, "Geometric"))
+        self.assertFalse(store.has_imts(["CAV"], "Geometric"))
+        np.testing.assert_allclose(
+            database.get_store_observations(self.IMTS, database.records),
+            expected, rtol=1E-5)
+        np.testing.assert_allclose(
+            database.get_database_observations(self.IMTS), expected,
+            rtol=1E-5)
+        # IMTs not in the store are read from the record files
+        self.assertIsNone(database.get_store_observations(
+            ["PGA"], database.records, "rotD50"))
+        # A record file changed since the store was built: store outdated
+        datafile = database.records[1].datafile
+        stat = os.stat(datafile)
+        os.utime(datafile, ns=(stat.st_atime_ns,
+                               stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(database.get_store_observations(
+            self.IMTS, database.records))
+        np.testing.assert_allclose(
+            database.get_database_observations(self.IMTS), expected)
+        # IMs missing in a record file are not stored
+        with h5py.File(datafile, "r+") as fle:
+            del fle["IMS/H/Spectra/Response/Acceleration/Geometric"]
+            del fle["IMS/H/Scalar/PGV"]
+        build_im_store(database)
+        store = database.get_im_store()
+        self.assertTrue(store.has_imts(["PGA"], "Geometric"))
+        self.assertFalse(store.has_imts(["PGV"], "Geometric"))
+        self.assertFalse(store.has_imts(["SA(1.0)"], "Geometric"))
+        # Spectra of the records on different periods: warned, scalars
+        # still stored
+        loc = "IMS/H/Spectra/Response/"
+        with h5py.File(database.records[2].datafile, "r+") as fle:
+            for name in ["Periods", "Acceleration/Geometric/damping_05"]:
+                values = fle[loc + name][:-1]
+                del fle[loc + name]
+                fle[loc + name] = values
+        with self.assertWarns(UserWarning):
+            build_im_store(database)
+        store = database.get_im_store()
+        self.assertTrue(store.has_imts(["PGA"], "Geometric"))
+
+    def tearDown(self):
+        shutil.rmtree(self.record_dir)
+        for db_dir in self.db_dirs:
+            if os.path.exists(db_dir):
+                shutil.rmtree(db_dir)
+
+
+class ParseOnlyReader(SMDatabaseReader):
+    """
+    Reader implementing only `parse`, as the readers predating
+    `iter_records`
+    """
+    def parse(self):
+        self.database = SigmaDatabaseMetadataReader(
+            self.id, self.name, self.filename).parse()
+        return self.database
+
+
+class StreamingBuildTestCase(unittest.TestCase):
+    """
+    Tests the streaming of the records from the reader to the builder
+    """
+    def setUp(self):
+        self.db_dir = "laquila_streaming_db"
+
+    def test_iter_records(self):
+        reader = SigmaDatabaseMetadataReader("001", "LAquila", BASE_DATA_PATH)
+        records = reader.iter_records()
+        # Lazy: nothing is read before the first record is requested
+        self.assertIsNone(reader.database)
+        ids = [rec.id for rec in records]
+        self.assertEqual(len(reader.database), 0)
+        database = SigmaDatabaseMetadataReader(
+            "001", "LAquila", BASE_DATA_PATH).parse()
+        self.assertListEqual([rec.id for rec in database], ids)
+
+    def test_record_filter(self):
+        def near(record):
+            return record.distance.repi < 50.
+        builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader, self.db_dir)
+        builder.build_database("001", "LAquila", BASE_DATA_PATH,
+                               record_filter=near)
+        database = load_database(self.db_dir)
+        self.assertGreater(len(database), 0)
+        self.assertListEqual(
+            [rec.id for rec in database],
+            [rec.id for rec in SigmaDatabaseMetadataReader(
+                "001", "LAquila", BASE_DATA_PATH).parse() if near(rec)])
+
+    def test_parse_only_reader(self):
+        builder = SMDatabaseBuilder(ParseOnlyReader, self.db_dir)
+        builder.build_database("001", "LAquila", BASE_DATA_PATH)
+        self.assertListEqual(
+            [rec.id for rec in load_database(self.db_dir)],
+            [rec.id for rec in SigmaDatabaseMetadataReader(
+                "001", "LAquila", BASE_DATA_PATH).parse()])
+
+    def tearDown(self):
+        if os.path.exists(self.db_dir):
+            shutil.rmtree(self.db_dir)
@@ -0,0 +1,77 @@
+"""
+Tests the packed time series store
+"""
+import os
+import shutil
+import unittest
+import numpy as np
+import h5py
+from smtk.sm_database_builder import SMDatabaseBuilder
+from smtk.sm_timeseries_store import PackedTimeSeriesStore,\
+    PackedTimeSeriesWriter
+from smtk.parsers.sigma_database_parser import SigmaDatabaseMetadataReader,\
+    SigmaRecordParser, SigmaSpectraParser
+
+
+BASE_DATA_PATH = os.path.join(os.path.dirname(__file__), "hazard", "data",
+                              "LAquila_Good_Records")
+
+
+class PackedTimeSeriesStoreTestCase(unittest.TestCase):
+    """
+    Tests the packed store against the hdf5 files of the records
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.db_dir = "laquila_packed_db"
+        cls.builder = SMDatabaseBuilder(SigmaDatabaseMetadataReader,
+                                        cls.db_dir)
+        cls.builder.build_database("001", "LAquila", BASE_DATA_PATH)
+        cls.builder.parse_records(SigmaRecordParser, SigmaSpectraParser)
+
+    def test_packed_store(self):
+        store = self.builder.pack_time_series()
+        self.assertEqual(len(store), 3 * len(self.builder.database))
+        for record in self.builder.database:
+            self.assertEqual(store.get_components(record.id),
+                             ["X", "Y", "V"])
+            with h5py.File(record.datafile, "r") as fle:
+                for comp in ["X", "Y", "V"]:
+                    dset = fle["Time Series/%s/Original Record/Acceleration"
+                               % comp]
+                    values, time_step = store.get_time_series(record.id,
+                                                              comp)
+                    # Memory mapped, no copy
+                    self.assertIsInstance(values.base, np.memmap)
+                    np.testing.assert_array_equal(values, dset[:])
+                    self.assertEqual(time_step, dset.attrs["Time-step"])
+        # Sequential iteration
+        self.assertEqual(store.index["offset"][0], 0)
+        for i, (rec_id, comp, values, _) in enumerate(
+                store.iter_time_series(["X"])):
+            self.assertEqual(comp, "X")
+            self.assertEqual(rec_id, self.builder.database.records[i].id)
+        self.assertEqual(i + 1, len(self.builder.database))
+        with self.assertRaises(ValueError):
+            store.get_time_series("XXX", "X")
+        # Reopened from disk
+        store1 = PackedTimeSeriesStore(store.directory)
+        np.testing.assert_array_equal(store1.index, store.index)
+
+    def test_failed_write(self):
+        directory = os.path.join(self.db_dir, "failed_store")
+        with PackedTimeSeriesWriter(directory) as writer:
+            writer.add("A", "X", np.arange(10.), 0.01)
+        with self.assertRaises(ZeroDivisionError):
+            with PackedTimeSeriesWriter(directory) as writer:
+                writer.add("B", "X", np.arange(5.), 0.01)
+                1 / 0
+        # The existing store is left untouched
+        store = PackedTimeSeriesStore(directory)
+        self.assertEqual(store.index["record_id"].tolist(), ["A"])
+        np.testing.assert_array_equal(store.get_time_series("A", "X")[0],
+                                      np.arange(10.))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.db_dir)
@@ -28,7 +28,8 @@ import unittest
 import numpy as np
 from scipy.constants import g
 
-from smtk.sm_utils import convert_accel_units, SCALAR_XY
+from smtk.sm_utils import convert_accel_units, SCALAR_XY,\
+    get_interpolated_period, get_interpolated_periods, iter_prefetched
 
 
 # OLD IMPLEMENTATION OF CONVERT ACCELERATION UNITS. USED HERE
@@ -106,6 +107,38 @@ class SmUtilsTestCase(unittest.TestCase):
             with self.assertRaises(ValueError):  # invalid units 'a':
                 func(acc, 'a')
 
+    def test_interpolated_periods(self):
+        """
+        Tests the vectorised interpolation against the scalar one
+        """
+        periods = np.array([0.01, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 4.0])
+        values = np.array([150., 300., 420., 380., 200., 90., 30., 8.])
+        targets = [0.01, 0.03, 0.1, 0.15, 0.75, 1.0, 3.3, 4.0]
+        expected = [get_interpolated_period(target, periods, values)
+                    for target in targets]
+        self.assertNEqual(get_interpolated_periods(targets, periods, values),
+                          np.array(expected))
+        with self.assertRaises(ValueError):
+            get_interpolated_periods([0.1, 5.0], periods, values)
+
+    def test_iter_prefetched(self):
+        """
+        Tests that the prefetched results are yielded in order
+        """
+        items = list(range(50))
+        for workers in [None, 1, 3]:
+            for queue_size in [None, 1, 4]:
+                self.assertListEqual(
+                    list(iter_prefetched(lambda x: x ** 2, items, workers,
+                                         queue_size)),
+                    [x ** 2 for x in items])
+        # Errors are raised at the position of the failing item
+        results = iter_prefetched(lambda x: 1. / x, [1., 2., 0., 4.], 2)
+        self.assertEqual(next(results), 1.)
+        self.assertEqual(next(results), 0.5)
+        with self.assertRaises(ZeroDivisionError):
+            next(results)
+
     def tst_scalar_xy(self):
         '''Commented out: it tested whether SCALAR_XY supported numpy
         array, it does not'''